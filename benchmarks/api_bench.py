@@ -0,0 +1,241 @@
+"""
+Load test / benchmark for every route of src/app.py.
+
+Seeds a database (SQLite by default, or any DATABASE_URL such as a local PostgreSQL)
+with configurable volumes and then drives each route:
+
+    - client:   in-process through the Flask test client (no network, one request at a time)
+    - gunicorn: against a real `gunicorn wsgi --chdir ./src/` (same as the Procfile), with
+                --concurrency client threads using keep-alive connections
+
+The report (JSON, stdout or --output) has throughput, latency percentiles, SQL
+statements per request (from the Server-Timing header) and peak RSS per mode, plus
+the git commit, so runs can be compared commit to commit:
+
+    python benchmarks/api_bench.py --users 1000 --catalog 5000 --favorites 20 --output before.json
+    python benchmarks/api_bench.py --mode gunicorn --workers 4 --concurrency 32
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import common  # noqa: E402
+
+
+def scenarios(args):
+    """
+    (name, method, path(i), body(i)) for every route, i being the request number.
+    Write scenarios come in add/remove pairs over the same (user, item) sequence, so the
+    database ends each run in the seeded state.
+    """
+    users, catalog, favorites = args.users, args.catalog, args.favorites
+    first_free = favorites // 2 + 2
+    free_items = catalog - first_free + 1
+
+    def item_id(i):
+        return first_free + i % free_items
+
+    def email(i):
+        return {"email": "user" + str(i % users + 1) + "@bench.dev"}
+
+    def batch(action):
+        def body(i):
+            ids = [first_free + (i * 10 + j) % free_items for j in range(10)]
+            data = email(i)
+            data[action] = {"planets": ids, "people": ids}
+            return data
+        return body
+
+    return [
+        ("GET /", "GET", lambda i: "/", None),
+        ("GET /people", "GET", lambda i: "/people", None),
+        ("GET /people?limit=100", "GET", lambda i: "/people?limit=100&after=" + str(i % catalog), None),
+        ("GET /people/<id>", "GET", lambda i: "/people/" + str(i % catalog + 1), None),
+        ("GET /planets", "GET", lambda i: "/planets", None),
+        ("GET /planets?limit=100", "GET", lambda i: "/planets?limit=100&after=" + str(i % catalog), None),
+        ("GET /planets/<id>", "GET", lambda i: "/planets/" + str(i % catalog + 1), None),
+        ("GET /users", "GET", lambda i: "/users", None),
+        ("GET /users?limit=100", "GET", lambda i: "/users?limit=100&after=" + str(i % users), None),
+        ("GET /users/favorites/<id>", "GET", lambda i: "/users/favorites/" + str(i % users + 1), None),
+        ("POST /favorite/planet/<id>", "POST", lambda i: "/favorite/planet/" + str(item_id(i)), email),
+        ("DELETE /favorite/planet/<id>", "DELETE", lambda i: "/favorite/planet/" + str(item_id(i)), email),
+        ("POST /favorite/people/<id>", "POST", lambda i: "/favorite/people/" + str(item_id(i)), email),
+        ("DELETE /favorite/people/<id>", "DELETE", lambda i: "/favorite/people/" + str(item_id(i)), email),
+        ("POST /favorites/batch (add 20)", "POST", lambda i: "/favorites/batch", batch("add")),
+        ("POST /favorites/batch (remove 20)", "POST", lambda i: "/favorites/batch", batch("remove")),
+    ]
+
+
+def _summary(name, mode, latencies, statuses, queries, elapsed):
+    return {
+        "route": name,
+        "mode": mode,
+        "requests": len(latencies),
+        "seconds": elapsed,
+        "throughput_rps": len(latencies) / elapsed if elapsed > 0 else 0,
+        "latency_ms": common.latency_stats(latencies),
+        "queries_per_request": (sum(queries) / len(queries)) if queries else None,
+        "status_codes": {str(k): v for k, v in sorted(statuses.items())},
+    }
+
+
+# -----------------------------------Flask test client--------------------------------------------------
+
+def run_client(app, args, selected):
+    client = app.test_client()
+    results = []
+    for name, method, path, body in selected:
+        # sin warmup en las escrituras, romperia los pares agregar/eliminar
+        for i in range(args.warmup if method == "GET" else 0):
+            client.open(path(i), method=method)
+
+        latencies, queries, statuses = [], [], Counter()
+        started = time.perf_counter()
+        for i in range(args.requests):
+            request_started = time.perf_counter()
+            response = client.open(path(i), method=method, json=body(i) if body else None)
+            response.get_data()
+            latencies.append(time.perf_counter() - request_started)
+            statuses[response.status_code] += 1
+            count = common.queries_from_server_timing(response.headers.get("Server-Timing"))
+            if count is not None:
+                queries.append(count)
+        results.append(_summary(name, "client", latencies, statuses, queries, time.perf_counter() - started))
+        print("client   {:<36} {:>9.1f} req/s".format(name, results[-1]["throughput_rps"]), file=sys.stderr)
+    return {"results": results, "peak_rss_kb": common.self_peak_rss_kb()}
+
+
+# -----------------------------------HTTP (gunicorn / uvicorn)--------------------------------------------------
+
+def drive_http(port, args, selected, mode):
+    """Runs every scenario over HTTP with args.concurrency threads and keep-alive connections."""
+    results = []
+    for name, method, path, body in selected:
+        counter = itertools.count()
+        warmup = itertools.count() if method == "GET" else itertools.repeat(args.warmup)
+        lock = threading.Lock()
+        latencies, queries, statuses = [], [], Counter()
+
+        def worker():
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+            local_latencies, local_queries, local_statuses = [], [], Counter()
+
+            def call(i):
+                payload = json.dumps(body(i)) if body else None
+                headers = {"Content-Type": "application/json"} if payload else {}
+                connection.request(method, path(i), body=payload, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                return response
+
+            while next(warmup) < args.warmup:
+                call(0)
+            while True:
+                i = next(counter)
+                if i >= args.requests:
+                    break
+                request_started = time.perf_counter()
+                try:
+                    response = call(i)
+                except (OSError, http.client.HTTPException):
+                    local_statuses["error"] += 1
+                    connection.close()
+                    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+                    continue
+                local_latencies.append(time.perf_counter() - request_started)
+                local_statuses[response.status] += 1
+                count = common.queries_from_server_timing(response.getheader("Server-Timing"))
+                if count is not None:
+                    local_queries.append(count)
+            connection.close()
+            with lock:
+                latencies.extend(local_latencies)
+                queries.extend(local_queries)
+                statuses.update(local_statuses)
+
+        threads = [threading.Thread(target=worker) for n in range(args.concurrency)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        results.append(_summary(name, mode, latencies, statuses, queries, time.perf_counter() - started))
+        print("{:<8} {:<36} {:>9.1f} req/s".format(mode, name, results[-1]["throughput_rps"]), file=sys.stderr)
+    return results
+
+
+def server_peak_rss(process):
+    pids = [process.pid] + common.child_pids(process.pid)
+    per_process = {str(pid): common.process_peak_rss_kb(pid) for pid in pids}
+    return per_process
+
+
+def run_gunicorn(args, selected):
+    port = common.free_port()
+    env = dict(os.environ, DATABASE_URL=args.database_url)
+    command = [sys.executable, "-m", "gunicorn", "wsgi", "--chdir", "./src/",
+               "--bind", "127.0.0.1:" + str(port), "--workers", str(args.workers)]
+    process = common.start_server(command, port, env)
+    try:
+        results = drive_http(port, args, selected, "gunicorn")
+        rss = server_peak_rss(process)
+    finally:
+        common.stop_server(process)
+    return {"results": results, "peak_rss_kb": rss, "workers": args.workers, "concurrency": args.concurrency}
+
+
+def parse_args(argv=None, description=__doc__, **defaults):
+    """Command line shared by the benchmarks, other scripts can change the defaults."""
+    parser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=os.environ.get("BENCH_DATABASE_URL", common.DEFAULT_DATABASE_URL),
+                        help="Database to seed and benchmark (it is dropped and recreated!)")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--catalog", type=int, default=2000, help="Planets and characters to create (each)")
+    parser.add_argument("--favorites", type=int, default=20, help="Favorites per user")
+    parser.add_argument("--requests", type=int, default=500, help="Measured requests per route")
+    parser.add_argument("--warmup", type=int, default=20, help="Unmeasured requests per route")
+    parser.add_argument("--mode", choices=["client", "gunicorn", "both"], default="client")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent HTTP clients")
+    parser.add_argument("--only", action="append", default=[], help="Run only routes containing this text")
+    parser.add_argument("--no-seed", action="store_true", help="Reuse the data already in the database")
+    parser.add_argument("--output", default="-", help="JSON report file ('-' for stdout)")
+    parser.set_defaults(**defaults)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    app, db, models = common.load_app(args.database_url)
+
+    seed_seconds = None
+    if not args.no_seed:
+        seed_seconds = common.seed(app, db, models, args.users, args.catalog, args.favorites)
+        print("seeded in {:.2f}s".format(seed_seconds), file=sys.stderr)
+
+    selected = [s for s in scenarios(args) if not args.only or any(text in s[0] for text in args.only)]
+
+    report = {
+        "meta": common.report_meta(args.database_url, users=args.users, catalog=args.catalog,
+                                   favorites_per_user=args.favorites, requests_per_route=args.requests,
+                                   seed_seconds=seed_seconds),
+        "modes": {},
+    }
+    if args.mode in ("client", "both"):
+        report["modes"]["client"] = run_client(app, args, selected)
+    if args.mode in ("gunicorn", "both"):
+        report["modes"]["gunicorn"] = run_gunicorn(args, selected)
+
+    common.write_report(report, args.output)
+
+
+if __name__ == "__main__":
+    main()
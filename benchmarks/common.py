@@ -0,0 +1,204 @@
+"""
+Shared helpers for the benchmark scripts: database seeding, gunicorn process handling,
+latency statistics and the JSON report.
+
+The scripts import the application from ./src exactly like gunicorn does, so
+DATABASE_URL must be set before `load_app()` is called.
+"""
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC = os.path.join(ROOT, "src")
+
+DEFAULT_DATABASE_URL = "sqlite:////tmp/bench.db"
+
+
+def load_app(database_url):
+    """Imports src/app.py against database_url and returns (app, db, models module)."""
+    os.environ["DATABASE_URL"] = database_url
+    if SRC not in sys.path:
+        sys.path.insert(0, SRC)
+    import app as app_module
+    import models
+    return app_module.create_app(migrations=False), models.db, models
+
+
+def seed(app, db, models, users, catalog, favorites, chunk_size=5000):
+    """
+    Recreates all tables and inserts `users` users, `catalog` planets and `catalog`
+    characters, and `favorites` favorites per user (half planets, half characters, always
+    the lowest ids, so the write benchmarks can use ids above favorites // 2 + 1).
+    """
+    from sqlalchemy import insert
+
+    if favorites // 2 + 1 >= catalog:
+        raise SystemExit("--catalog must be bigger than --favorites / 2 + 1")
+
+    started = time.perf_counter()
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        def bulk(model, rows):
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= chunk_size:
+                    db.session.execute(insert(model), batch)
+                    batch = []
+            if batch:
+                db.session.execute(insert(model), batch)
+            db.session.commit()
+
+        bulk(models.Planet, ({"id_planet": i, "name": "planet-" + str(i)} for i in range(1, catalog + 1)))
+        bulk(models.Character, ({"id_character": i, "name": "character-" + str(i)} for i in range(1, catalog + 1)))
+        bulk(models.User, ({"id": i, "email": "user" + str(i) + "@bench.dev", "password": "bench",
+                            "is_active": True} for i in range(1, users + 1)))
+
+        half = favorites // 2
+        bulk(models.Favorite, (
+            row for user_id in range(1, users + 1) for row in (
+                [{"user_id": user_id, "planet_id": i} for i in range(1, favorites - half + 1)]
+                + [{"user_id": user_id, "character_id": i} for i in range(1, half + 1)])))
+
+    # lo sembrado no debe quedar en la cache de respuestas del proceso
+    app.extensions["response_cache"].clear()
+    return time.perf_counter() - started
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(q * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+def latency_stats(seconds):
+    values = sorted(seconds)
+    if not values:
+        return {}
+    return {
+        "mean": 1000 * sum(values) / len(values),
+        "p50": 1000 * percentile(values, 0.50),
+        "p95": 1000 * percentile(values, 0.95),
+        "p99": 1000 * percentile(values, 0.99),
+        "max": 1000 * values[-1],
+    }
+
+
+def queries_from_server_timing(header):
+    """Reads the statement count from the Server-Timing header added by instrumentation.py."""
+    if not header or 'desc="' not in header:
+        return None
+    try:
+        return int(header.split('desc="', 1)[1].split(" ", 1)[0])
+    except ValueError:
+        return None
+
+
+def self_peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def process_peak_rss_kb(pid):
+    """VmHWM (peak RSS) of a process, Linux only."""
+    try:
+        with open("/proc/" + str(pid) + "/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def process_memory_kb(pid):
+    """{"rss", "pss", "shared", "private"} in KB from /proc/<pid>/smaps_rollup, Linux only."""
+    fields = {"Rss:": "rss", "Pss:": "pss", "Shared_Clean:": "shared", "Shared_Dirty:": "shared",
+              "Private_Clean:": "private", "Private_Dirty:": "private"}
+    memory = {}
+    try:
+        with open("/proc/" + str(pid) + "/smaps_rollup") as rollup:
+            for line in rollup:
+                parts = line.split()
+                if parts and parts[0] in fields:
+                    memory[fields[parts[0]]] = memory.get(fields[parts[0]], 0) + int(parts[1])
+    except OSError:
+        pass
+    return memory
+
+
+def child_pids(pid):
+    try:
+        with open("/proc/" + str(pid) + "/task/" + str(pid) + "/children") as children:
+            return [int(x) for x in children.read().split()]
+    except OSError:
+        return []
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(command, port, env, timeout=30):
+    """Starts a server process (gunicorn/uvicorn command list) and waits until the port accepts connections."""
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("server exited: " + process.stderr.read().decode(errors="replace")[-2000:])
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("server did not start in " + str(timeout) + "s")
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report_meta(database_url, **extra):
+    meta = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "database": database_url.split("://", 1)[0],
+    }
+    meta.update(extra)
+    return meta
+
+
+def write_report(report, output):
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if output in (None, "-"):
+        print(text)
+    else:
+        with open(output, "w") as stream:
+            stream.write(text + "\n")
+        print("report written to " + output, file=sys.stderr)
@@ -0,0 +1,143 @@
+"""
+CPU time vs bytes of the response compression (src/content_encoding.py).
+
+    - codecs:   compresses the real body of each list route with every available coding
+                and level: size, ratio, median compression time and MB/s
+    - requests: throughput of each route through the Flask test client without
+                compression, compressing on every request (compressed cache off) and
+                with the compressed cache warm (the default behaviour)
+
+    python benchmarks/compression_bench.py --catalog 5000 --favorites 50
+    python benchmarks/compression_bench.py --levels gzip=1,6,9 --levels br=1,5,11 --output compression.json
+
+brotli / zstd are only measured when their packages are installed.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import common  # noqa: E402
+
+ROUTES = ["/people", "/planets", "/users", "/users/favorites/1"]
+
+DEFAULT_LEVELS = {
+    "gzip": [1, 6, 9],
+    "br": [1, 5, 9, 11],
+    "zstd": [1, 3, 9, 19],
+}
+
+
+def parse_levels(values):
+    levels = dict(DEFAULT_LEVELS)
+    for value in values:
+        coding, _, numbers = value.partition("=")
+        levels[coding] = [int(number) for number in numbers.split(",") if number]
+    return levels
+
+
+def bench_codecs(content_encoding, payloads, levels, repeat):
+    results = []
+    for route, data in payloads.items():
+        for coding in content_encoding.CODINGS:
+            for level in levels.get(coding, []):
+                timings = []
+                for _ in range(repeat):
+                    started = time.perf_counter()
+                    body = content_encoding.compress(data, coding, level)
+                    timings.append(time.perf_counter() - started)
+                seconds = statistics.median(timings)
+                results.append({
+                    "route": route,
+                    "coding": coding,
+                    "level": level,
+                    "bytes": len(data),
+                    "compressed_bytes": len(body),
+                    "ratio": len(data) / len(body),
+                    "compress_ms": seconds * 1000,
+                    "mb_per_s": len(data) / seconds / 1e6 if seconds > 0 else None,
+                })
+                print("{:<22} {:<5} {:>2}  {:>9} -> {:>8} bytes  {:>8.3f} ms".format(
+                    route, coding, level, len(data), len(body), seconds * 1000), file=sys.stderr)
+    return results
+
+
+def bench_requests(app, content_encoding, coding, requests):
+    client = app.test_client()
+    variants = {
+        "identity": ({}, None),
+        coding + " (compress every request)": ({"Accept-Encoding": coding}, 0),
+        coding + " (compressed cache)": ({"Accept-Encoding": coding}, content_encoding.DEFAULT_CACHE_ENTRIES),
+    }
+    results = []
+    for route in ROUTES:
+        for name, (headers, cache_entries) in variants.items():
+            if cache_entries is not None:
+                content_encoding.compressed_cache.clear()
+                content_encoding.compressed_cache.max_entries = cache_entries
+            client.get(route, headers=headers)
+            latencies = []
+            size = 0
+            started = time.perf_counter()
+            for _ in range(requests):
+                request_started = time.perf_counter()
+                response = client.get(route, headers=headers)
+                size = len(response.get_data())
+                latencies.append(time.perf_counter() - request_started)
+            elapsed = time.perf_counter() - started
+            results.append({
+                "route": route,
+                "variant": name,
+                "response_bytes": size,
+                "throughput_rps": requests / elapsed if elapsed > 0 else 0,
+                "latency_ms": common.latency_stats(latencies),
+            })
+            print("{:<22} {:<34} {:>9.1f} req/s {:>9} bytes".format(
+                route, name, results[-1]["throughput_rps"], size), file=sys.stderr)
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=os.environ.get("BENCH_DATABASE_URL", common.DEFAULT_DATABASE_URL),
+                        help="Database to seed and benchmark (it is dropped and recreated!)")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--catalog", type=int, default=2000, help="Planets and characters to create (each)")
+    parser.add_argument("--favorites", type=int, default=20, help="Favorites per user")
+    parser.add_argument("--levels", action="append", default=[], help="coding=l1,l2,... e.g. gzip=1,6,9")
+    parser.add_argument("--repeat", type=int, default=20, help="Compressions per payload, coding and level")
+    parser.add_argument("--requests", type=int, default=300, help="Measured requests per route and variant")
+    parser.add_argument("--coding", default="gzip", help="Coding used for the request benchmark")
+    parser.add_argument("--no-seed", action="store_true", help="Reuse the data already in the database")
+    parser.add_argument("--output", default="-", help="JSON report file ('-' for stdout)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    app, db, models = common.load_app(args.database_url)
+    import content_encoding
+
+    if args.coding not in content_encoding.CODINGS:
+        sys.exit("coding not available in this environment: " + args.coding)
+    if not args.no_seed:
+        common.seed(app, db, models, args.users, args.catalog, args.favorites)
+
+    client = app.test_client()
+    payloads = {route: client.get(route).get_data() for route in ROUTES}
+
+    report = {
+        "meta": common.report_meta(args.database_url, users=args.users, catalog=args.catalog,
+                                   favorites_per_user=args.favorites, codings=sorted(content_encoding.CODINGS),
+                                   min_size=content_encoding._settings["min_size"]),
+        "codecs": bench_codecs(content_encoding, payloads, parse_levels(args.levels), args.repeat),
+        "requests": bench_requests(app, content_encoding, args.coding, args.requests),
+    }
+    common.write_report(report, args.output)
+
+
+if __name__ == "__main__":
+    main()
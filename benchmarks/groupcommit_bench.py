@@ -0,0 +1,138 @@
+"""
+Favorite toggles with one commit each (current path) vs the group commit queue
+(src/writebehind.py, WRITE_BEHIND_ENABLED=1).
+
+--threads client threads each run --requests toggles through the Flask test client:
+POST then DELETE of its own (user, planet) pairs, so the database ends every run in the
+seeded state. For every mode and thread count the report has toggles/sec, database
+commits/sec (SQLAlchemy "commit" events), commits per toggle and latency percentiles.
+
+    python benchmarks/groupcommit_bench.py --threads 1 --threads 8 --threads 32
+    python benchmarks/groupcommit_bench.py --database-url postgresql://localhost/bench --max-delay-ms 5
+
+SQLite serializes every writer of the file, run it against a local PostgreSQL for
+numbers closer to production (each commit waits for the WAL flush there).
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import common  # noqa: E402
+
+MODES = ("direct", "group-commit")
+
+
+def run(app, args, threads, first_item):
+    """One run of `threads` threads. Returns (latencies, statuses, elapsed)."""
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+    free_items = args.catalog - first_item + 1
+    barrier = threading.Barrier(threads)
+
+    def worker(number):
+        client = app.test_client()
+        local_latencies, local_statuses = [], Counter()
+        body = {"email": "user" + str(number % args.users + 1) + "@bench.dev"}
+        barrier.wait()
+        for i in range(args.requests // 2):
+            path = "/favorite/planet/" + str(first_item + (number // args.users + i * threads) % free_items)
+            for method in ("POST", "DELETE"):
+                started = time.perf_counter()
+                response = client.open(path, method=method, json=body)
+                local_latencies.append(time.perf_counter() - started)
+                local_statuses[response.status_code] += 1
+        with lock:
+            latencies.extend(local_latencies)
+            statuses.update(local_statuses)
+
+    workers = [threading.Thread(target=worker, args=(number,)) for number in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return latencies, statuses, time.perf_counter() - started
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=os.environ.get("BENCH_DATABASE_URL", common.DEFAULT_DATABASE_URL),
+                        help="Database to seed and benchmark (it is dropped and recreated!)")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--catalog", type=int, default=2000, help="Planets and characters to create (each)")
+    parser.add_argument("--favorites", type=int, default=10, help="Favorites per user")
+    parser.add_argument("--threads", type=int, action="append", default=[], help="Client threads (repeatable)")
+    parser.add_argument("--requests", type=int, default=200, help="Toggles per thread")
+    parser.add_argument("--max-batch", type=int, default=200, help="WRITE_BEHIND_MAX_BATCH")
+    parser.add_argument("--max-delay-ms", type=float, default=2, help="WRITE_BEHIND_MAX_DELAY_MS")
+    parser.add_argument("--no-seed", action="store_true", help="Reuse the data already in the database")
+    parser.add_argument("--output", default="-", help="JSON report file ('-' for stdout)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    thread_counts = args.threads or [1, 8, 32]
+    # el limite de admission.py cortaria los lotes, aca medimos solo el camino de escritura
+    os.environ.update({
+        "WRITE_BEHIND_ENABLED": "1",
+        "WRITE_BEHIND_MAX_BATCH": str(args.max_batch),
+        "WRITE_BEHIND_MAX_DELAY_MS": str(args.max_delay_ms),
+        "WRITE_BEHIND_MAX_PENDING": str(max(thread_counts) * 2),
+        "RATE_LIMIT_ENABLED": "0",
+        "WRITE_SHEDDING_ENABLED": "0",
+        "SLOW_QUERY_MS": "60000",
+    })
+    app, db, models = common.load_app(args.database_url)
+    import writebehind
+    from sqlalchemy import event
+
+    if not args.no_seed:
+        common.seed(app, db, models, args.users, args.catalog, args.favorites)
+
+    commits = [0]
+    with app.app_context():
+        event.listen(db.engine, "commit", lambda connection: commits.__setitem__(0, commits[0] + 1))
+
+    results = []
+    for mode in MODES:
+        writebehind._settings["enabled"] = mode == "group-commit"
+        for threads in thread_counts:
+            batches_before = writebehind._stats["batches"]
+            commits[0] = 0
+            latencies, statuses, elapsed = run(app, args, threads, args.favorites // 2 + 2)
+            toggles = len(latencies)
+            results.append({
+                "mode": mode,
+                "threads": threads,
+                "toggles": toggles,
+                "seconds": elapsed,
+                "toggles_per_s": toggles / elapsed if elapsed > 0 else 0,
+                "commits": commits[0],
+                "commits_per_s": commits[0] / elapsed if elapsed > 0 else 0,
+                "commits_per_toggle": commits[0] / toggles if toggles else None,
+                "batches": writebehind._stats["batches"] - batches_before,
+                "latency_ms": common.latency_stats(latencies),
+                "status_codes": {str(k): v for k, v in sorted(statuses.items())},
+            })
+            print("{:<13} {:>3} threads {:>9.1f} toggles/s {:>9.1f} commits/s  p99 {:>7.2f} ms".format(
+                mode, threads, results[-1]["toggles_per_s"], results[-1]["commits_per_s"],
+                results[-1]["latency_ms"]["p99"]), file=sys.stderr)
+
+    report = {
+        "meta": common.report_meta(args.database_url, users=args.users, catalog=args.catalog,
+                                   requests_per_thread=args.requests, max_batch=args.max_batch,
+                                   max_delay_ms=args.max_delay_ms),
+        "results": results,
+    }
+    common.write_report(report, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+Memory per gunicorn worker and latency of /planets/<id> and /people/<id> with and without
+the memory-mapped catalog snapshot (src/catalogsnapshot.py, CATALOG_SNAPSHOT_ENABLED=1).
+
+For each mode it starts `gunicorn wsgi --chdir ./src/` with --workers workers, reads
+Rss / Pss / shared / private memory of every worker (/proc/<pid>/smaps_rollup) right after
+startup ("before"), sends --requests requests over every id of both catalogs from
+--concurrency client threads, and reads the memory again ("after"). Pss splits the
+shared pages between the processes that map them, so the sum of Pss is the real cost of
+the workers.
+
+    python benchmarks/snapshot_bench.py --catalog 100000 --workers 4
+    python benchmarks/snapshot_bench.py --database-url postgresql://localhost/bench --requests 50000
+"""
+import argparse
+import http.client
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import common  # noqa: E402
+
+MODES = ("database", "snapshot")
+
+
+def worker_memory(process):
+    return {str(pid): common.process_memory_kb(pid) for pid in common.child_pids(process.pid)}
+
+
+def totals(memory):
+    total = Counter()
+    for values in memory.values():
+        total.update(values)
+    return dict(total)
+
+
+def drive(port, args):
+    paths = ["/planets/" + str(i) for i in range(1, args.catalog + 1)]
+    paths += ["/people/" + str(i) for i in range(1, args.catalog + 1)]
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+    per_thread = args.requests // args.concurrency
+
+    def worker(number):
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        local_latencies, local_statuses = [], Counter()
+        for i in range(per_thread):
+            path = paths[(number + i * args.concurrency) * 7919 % len(paths)]
+            started = time.perf_counter()
+            try:
+                connection.request("GET", path)
+                response = connection.getresponse()
+                response.read()
+                local_statuses[response.status] += 1
+                if response.getheader("Connection", "").lower() == "close":
+                    connection.close()
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+                local_statuses["error"] += 1
+            local_latencies.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(local_latencies)
+            statuses.update(local_statuses)
+
+    threads = [threading.Thread(target=worker, args=(number,)) for number in range(args.concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": len(latencies),
+        "throughput_rps": len(latencies) / elapsed if elapsed > 0 else 0,
+        "latency_ms": common.latency_stats(latencies),
+        "status_codes": {str(k): v for k, v in sorted(statuses.items())},
+    }
+
+
+def run_mode(args, mode, snapshot_dir):
+    port = common.free_port()
+    env = dict(os.environ, DATABASE_URL=args.database_url, CATALOG_SNAPSHOT_ENABLED="1" if mode == "snapshot" else "0",
+               CATALOG_SNAPSHOT_DIR=snapshot_dir, RATE_LIMIT_ENABLED="0", SLOW_QUERY_MS="60000")
+    command = [sys.executable, "-m", "gunicorn", "wsgi", "--chdir", "./src/",
+               "--bind", "127.0.0.1:" + str(port), "--workers", str(args.workers)]
+    process = common.start_server(command, port, env)
+    try:
+        time.sleep(1)
+        before = worker_memory(process)
+        if mode == "snapshot":
+            # el primer request pide la generacion, la esperamos antes de medir
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+            connection.request("GET", "/planets/1")
+            connection.getresponse().read()
+            deadline = time.monotonic() + 60
+            while not any(name.endswith(".current") for name in os.listdir(snapshot_dir)) \
+                    and time.monotonic() < deadline:
+                time.sleep(0.1)
+            time.sleep(1.5)
+        result = drive(port, args)
+        after = worker_memory(process)
+    finally:
+        common.stop_server(process)
+
+    result.update({
+        "mode": mode,
+        "memory_kb": {"before": before, "after": after},
+        "memory_total_kb": {"before": totals(before), "after": totals(after)},
+    })
+    return result
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=os.environ.get("BENCH_DATABASE_URL", common.DEFAULT_DATABASE_URL),
+                        help="Database to seed and benchmark (it is dropped and recreated!)")
+    parser.add_argument("--catalog", type=int, default=50000, help="Planets and characters to create (each)")
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn workers")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent HTTP clients")
+    parser.add_argument("--requests", type=int, default=20000, help="Requests per mode")
+    parser.add_argument("--no-seed", action="store_true", help="Reuse the data already in the database")
+    parser.add_argument("--output", default="-", help="JSON report file ('-' for stdout)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not args.no_seed:
+        app, db, models = common.load_app(args.database_url)
+        seconds = common.seed(app, db, models, 10, args.catalog, 2)
+        print("seeded in {:.2f}s".format(seconds), file=sys.stderr)
+
+    snapshot_dir = tempfile.mkdtemp(prefix="swapi-catalog-bench-")
+    results = []
+    try:
+        for mode in MODES:
+            results.append(run_mode(args, mode, snapshot_dir))
+            total = results[-1]["memory_total_kb"]
+            print("{:<9} {:>9.1f} req/s  p99 {:>7.2f} ms  Pss before {:>8} KB  after {:>8} KB  Rss after {:>8} KB".format(
+                mode, results[-1]["throughput_rps"], results[-1]["latency_ms"].get("p99", 0),
+                total["before"].get("pss"), total["after"].get("pss"), total["after"].get("rss")), file=sys.stderr)
+    finally:
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+
+    report = {
+        "meta": common.report_meta(args.database_url, catalog=args.catalog, workers=args.workers,
+                                   concurrency=args.concurrency, requests=args.requests),
+        "results": results,
+    }
+    common.write_report(report, args.output)
+
+
+if __name__ == "__main__":
+    main()
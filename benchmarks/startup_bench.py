@@ -0,0 +1,187 @@
+"""
+Cold start of the application: import cost and time to the first answered request.
+
+    - imports:       `python -X importtime -c "import wsgi"` in a fresh interpreter, total
+                     time (sum of the top level imports) and the most expensive packages
+    - in-process:    fresh interpreter, `from wsgi import application` and the first
+                     request through the test client (what a worker without --preload pays)
+    - gunicorn:      from spawning the Procfile command (gunicorn.conf.py, preload on) to
+                     the first 200 from one of its workers (what a deploy / restart pays)
+
+Every measure runs with ADMIN_ENABLED=0 and ADMIN_ENABLED=1 and keeps the median of
+--repeat runs. The guards compare the ADMIN_ENABLED=0 medians and exit with 1 when they
+are exceeded, so CI can catch an import that sneaks back into the startup path:
+
+    python benchmarks/startup_bench.py --repeat 5
+    python benchmarks/startup_bench.py --max-import-ms 600 --max-first-request-ms 900 --skip-gunicorn
+
+No data is written: /health does not touch the database.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import common  # noqa: E402
+
+FIRST_REQUEST = """
+import json, time
+started = time.perf_counter()
+from wsgi import application
+imported = time.perf_counter()
+response = application.test_client().get({path!r})
+finished = time.perf_counter()
+print(json.dumps({{"status": response.status_code, "import_ms": (imported - started) * 1000,
+                  "first_request_ms": (finished - started) * 1000}}))
+"""
+
+
+def variant_env(database_url, admin):
+    env = dict(os.environ)
+    env.update({"DATABASE_URL": database_url, "ADMIN_ENABLED": "1" if admin else "0", "FLASK_DEBUG": "0"})
+    return env
+
+
+def parse_importtime(output):
+    """
+    Reads the -X importtime output. Returns (total ms, {package: cumulative ms}): the total
+    is the sum of the top level imports, the packages are the first import of every
+    top level package (flask_admin, sqlalchemy, ...) with everything it imported.
+    """
+    total = 0.0
+    packages = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        milliseconds = int(cumulative_us) / 1000
+        # los imports anidados llevan sangria, el total suma solo los de primer nivel
+        if name[1:2] != " ":
+            total += milliseconds
+        package = name.strip().split(".", 1)[0]
+        packages[package] = max(packages.get(package, 0.0), milliseconds)
+    return total, packages
+
+
+def bench_imports(env, module, repeat):
+    totals = []
+    packages = {}
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                                cwd=common.SRC, env=env, capture_output=True, text=True, check=True)
+        total, packages = parse_importtime(result.stderr)
+        totals.append(total)
+    packages.pop(module, None)
+    return statistics.median(totals), packages
+
+
+def bench_in_process(env, path, repeat):
+    runs = []
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, "-c", FIRST_REQUEST.format(path=path)],
+                                cwd=common.SRC, env=env, capture_output=True, text=True, check=True)
+        run = json.loads(result.stdout.strip().splitlines()[-1])
+        if run["status"] != 200:
+            raise RuntimeError(path + " answered " + str(run["status"]))
+        runs.append(run)
+    return {
+        "import_ms": statistics.median(run["import_ms"] for run in runs),
+        "first_request_ms": statistics.median(run["first_request_ms"] for run in runs),
+    }
+
+
+def bench_gunicorn(env, path, workers, repeat, timeout=30):
+    timings = []
+    for _ in range(repeat):
+        port = common.free_port()
+        command = ["gunicorn", "wsgi", "--chdir", "./src/", "--bind", "127.0.0.1:" + str(port),
+                   "--workers", str(workers)]
+        started = time.perf_counter()
+        process = subprocess.Popen(command, cwd=common.ROOT, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            deadline = time.monotonic() + timeout
+            while True:
+                if process.poll() is not None:
+                    raise RuntimeError("gunicorn exited with " + str(process.returncode))
+                if time.monotonic() > deadline:
+                    raise RuntimeError("gunicorn did not answer in " + str(timeout) + "s")
+                try:
+                    with urllib.request.urlopen("http://127.0.0.1:" + str(port) + path, timeout=1) as response:
+                        if response.status == 200:
+                            break
+                except (urllib.error.URLError, ConnectionError):
+                    time.sleep(0.01)
+            timings.append((time.perf_counter() - started) * 1000)
+        finally:
+            common.stop_server(process)
+    return statistics.median(timings)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=os.environ.get("BENCH_DATABASE_URL", common.DEFAULT_DATABASE_URL),
+                        help="DATABASE_URL given to the application (nothing is written)")
+    parser.add_argument("--module", default="wsgi", help="Module imported by the importtime run")
+    parser.add_argument("--path", default="/health", help="Route of the first request")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per measure, the median is reported")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    parser.add_argument("--top", type=int, default=15, help="Most expensive imports to report")
+    parser.add_argument("--skip-gunicorn", action="store_true")
+    parser.add_argument("--max-import-ms", type=float, default=None,
+                        help="Fail if the import of --module takes longer (ADMIN_ENABLED=0)")
+    parser.add_argument("--max-first-request-ms", type=float, default=None,
+                        help="Fail if the in-process first request takes longer (ADMIN_ENABLED=0)")
+    parser.add_argument("--output", default="-", help="JSON report file ('-' for stdout)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    variants = {}
+    for admin in (False, True):
+        name = "admin" if admin else "default"
+        env = variant_env(args.database_url, admin)
+        import_ms, packages = bench_imports(env, args.module, args.repeat)
+        top = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:args.top]
+        result = {
+            "import_ms": import_ms,
+            "top_imports_ms": dict(top),
+            "in_process": bench_in_process(env, args.path, args.repeat),
+        }
+        if not args.skip_gunicorn:
+            result["gunicorn_first_response_ms"] = bench_gunicorn(env, args.path, args.workers, args.repeat)
+        variants[name] = result
+        print("{:<8} import {:>8.1f} ms  first request {:>8.1f} ms  gunicorn {}".format(
+            name, import_ms, result["in_process"]["first_request_ms"],
+            "{:.1f} ms".format(result["gunicorn_first_response_ms"]) if "gunicorn_first_response_ms" in result
+            else "-"), file=sys.stderr)
+
+    report = {
+        "meta": common.report_meta(args.database_url, module=args.module, path=args.path, repeat=args.repeat,
+                                   workers=args.workers),
+        "variants": variants,
+    }
+    common.write_report(report, args.output)
+
+    failures = []
+    default = variants["default"]
+    if args.max_import_ms is not None and default["import_ms"] > args.max_import_ms:
+        failures.append("import {:.1f} ms > {:.1f} ms".format(default["import_ms"], args.max_import_ms))
+    if args.max_first_request_ms is not None \
+            and default["in_process"]["first_request_ms"] > args.max_first_request_ms:
+        failures.append("first request {:.1f} ms > {:.1f} ms".format(
+            default["in_process"]["first_request_ms"], args.max_first_request_ms))
+    if failures:
+        sys.exit("startup regression: " + "; ".join(failures))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,18 @@
+"""
+gunicorn settings, read from the directory gunicorn is started in (see Procfile).
+
+preload_app: the master imports the code and runs create_app() once, then forks the
+workers, so every worker starts already initialized and the imported modules are shared
+copy-on-write instead of being loaded again per worker. create_app() does not open
+database connections; post_fork still drops any pooled connection inherited from the
+master so no socket is shared between processes. GUNICORN_PRELOAD=0 turns it off.
+"""
+import os
+
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") != "0"
+
+
+def post_fork(server, worker):
+    if preload_app:
+        from database import dispose_engines
+        dispose_engines()
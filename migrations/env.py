@@ -32,6 +32,21 @@ target_db = current_app.extensions['migrate'].db
 # ... etc.
 
 
+# Indices de expresion que crea la migracion 9d4f2c6a8e13 solo en PostgreSQL y que los
+# modelos no declaran (lower(name) COLLATE "C" y gin_trgm_ops): autogenerate no debe
+# borrarlos, /search y el filtro "starts with" del admin dependen de ellos
+UNMANAGED_INDEXES = {
+    'ix_planet_name_prefix', 'ix_planet_name_trgm',
+    'ix_character_name_prefix', 'ix_character_name_trgm',
+}
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    if type_ == 'index' and reflected and compare_to is None and name in UNMANAGED_INDEXES:
+        return False
+    return True
+
+
 def get_metadata():
     if hasattr(target_db, 'metadatas'):
         return target_db.metadatas[None]
@@ -52,7 +67,8 @@ def run_migrations_offline():
     """
     url = config.get_main_option("sqlalchemy.url")
     context.configure(
-        url=url, target_metadata=get_metadata(), literal_binds=True
+        url=url, target_metadata=get_metadata(), literal_binds=True,
+        include_object=include_object
     )
 
     with context.begin_transaction():
@@ -84,6 +100,7 @@ def run_migrations_online():
             connection=connection,
             target_metadata=get_metadata(),
             process_revision_directives=process_revision_directives,
+            include_object=include_object,
             **current_app.extensions['migrate'].configure_args
         )
 
@@ -0,0 +1,44 @@
+"""favorite indexes and unique (user, planet) / (user, character)
+
+Revision ID: 3c9d1e7f2b40
+Revises: abfbdf5a3526
+Create Date: 2026-10-18 10:12:31.418204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c9d1e7f2b40'
+down_revision = 'abfbdf5a3526'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Borramos los favoritos duplicados (nos quedamos con el mas antiguo) antes de crear los indices unicos
+    op.execute(
+        "DELETE FROM favorite WHERE planet_id IS NOT NULL AND id_fav NOT IN "
+        "(SELECT MIN(id_fav) FROM favorite WHERE planet_id IS NOT NULL GROUP BY user_id, planet_id)")
+    op.execute(
+        "DELETE FROM favorite WHERE character_id IS NOT NULL AND id_fav NOT IN "
+        "(SELECT MIN(id_fav) FROM favorite WHERE character_id IS NOT NULL GROUP BY user_id, character_id)")
+
+    op.create_index('ix_favorite_user_id', 'favorite', ['user_id'], unique=False)
+    op.create_index('ix_favorite_planet_id', 'favorite', ['planet_id'], unique=False)
+    op.create_index('ix_favorite_character_id', 'favorite', ['character_id'], unique=False)
+    op.create_index('uq_favorite_user_planet', 'favorite', ['user_id', 'planet_id'], unique=True,
+                    postgresql_where=sa.text('planet_id IS NOT NULL'),
+                    sqlite_where=sa.text('planet_id IS NOT NULL'))
+    op.create_index('uq_favorite_user_character', 'favorite', ['user_id', 'character_id'], unique=True,
+                    postgresql_where=sa.text('character_id IS NOT NULL'),
+                    sqlite_where=sa.text('character_id IS NOT NULL'))
+
+
+def downgrade():
+    op.drop_index('uq_favorite_user_character', table_name='favorite')
+    op.drop_index('uq_favorite_user_planet', table_name='favorite')
+    op.drop_index('ix_favorite_character_id', table_name='favorite')
+    op.drop_index('ix_favorite_planet_id', table_name='favorite')
+    op.drop_index('ix_favorite_user_id', table_name='favorite')
@@ -0,0 +1,37 @@
+"""favorite_count counters per planet / character
+
+Revision ID: 4e8b1f0c6d27
+Revises: 9d4f2c6a8e13
+Create Date: 2026-10-18 20:14:31.508642
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4e8b1f0c6d27'
+down_revision = '9d4f2c6a8e13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('favorite_count',
+    sa.Column('item_type', sa.String(length=10), nullable=False),
+    sa.Column('item_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('item_type', 'item_id')
+    )
+    op.create_index('ix_favorite_count_type_count', 'favorite_count', ['item_type', 'count'], unique=False)
+
+    # Contadores iniciales, despues los mantiene src/popularity.py (`flask favorites recount` los corrige)
+    op.execute("INSERT INTO favorite_count (item_type, item_id, count) "
+               "SELECT 'planets', planet_id, COUNT(*) FROM favorite WHERE planet_id IS NOT NULL GROUP BY planet_id")
+    op.execute("INSERT INTO favorite_count (item_type, item_id, count) "
+               "SELECT 'people', character_id, COUNT(*) FROM favorite WHERE character_id IS NOT NULL GROUP BY character_id")
+
+
+def downgrade():
+    op.drop_index('ix_favorite_count_type_count', table_name='favorite_count')
+    op.drop_table('favorite_count')
@@ -0,0 +1,30 @@
+"""user_favorites read model
+
+Revision ID: 7b2e4a9c1d55
+Revises: 3c9d1e7f2b40
+Create Date: 2026-10-18 16:40:12.903115
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7b2e4a9c1d55'
+down_revision = '3c9d1e7f2b40'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # La tabla queda vacia: se llena con `flask favorites rebuild` (ver src/readmodel.py)
+    op.create_table('user_favorites',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('document', sa.Text(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+
+
+def downgrade():
+    op.drop_table('user_favorites')
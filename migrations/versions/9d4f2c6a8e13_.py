@@ -0,0 +1,42 @@
+"""search indexes on planet / character names (PostgreSQL only)
+
+Revision ID: 9d4f2c6a8e13
+Revises: 7b2e4a9c1d55
+Create Date: 2026-10-18 18:05:47.220931
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d4f2c6a8e13'
+down_revision = '7b2e4a9c1d55'
+branch_labels = None
+depends_on = None
+
+TABLES = ('planet', 'character')
+
+
+def upgrade():
+    # En otras bases de datos /search usa el indice en memoria (ver src/search.py)
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for table in TABLES:
+        # prefijos: LIKE 'abc%' y ORDER BY sobre lower(name) con collation "C"
+        op.create_index('ix_' + table + '_name_prefix', table, [sa.text('lower(name) COLLATE "C"')])
+        # fuzzy: operador % y similarity() de pg_trgm
+        op.create_index('ix_' + table + '_name_trgm', table, [sa.text('lower(name) gin_trgm_ops')],
+                        postgresql_using='gin')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    for table in TABLES:
+        op.drop_index('ix_' + table + '_name_trgm', table_name=table)
+        op.drop_index('ix_' + table + '_name_prefix', table_name=table)
+    # la extension se deja instalada, otras bases / esquemas pueden usarla
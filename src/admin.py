@@ -1,18 +1,200 @@
+"""
+Flask-Admin views, written for tables with millions of rows:
+
+- list pages show a few columns and load the user / planet / character of the favorites
+  shown in the same query (joinedload), instead of one query per row;
+- without search or filters, the number of rows comes from the PostgreSQL estimate
+  (pg_class.reltuples, updated by VACUUM / ANALYZE) once it reaches
+  ADMIN_ESTIMATED_COUNT_THRESHOLD (100000); below it, or with filters, it is an exact
+  COUNT(*). With an estimate the page count can be off by a few pages;
+- sorting and filters only on indexed columns (primary keys, email, name, the foreign
+  keys of favorite). "starts with" on names uses the lower(name) COLLATE "C" index of
+  the migration 9d4f2c6a8e13;
+- the user / planet / character selects of the favorite form load ADMIN_LOOKUP_PAGE_SIZE
+  (10) matches per page by prefix, through AJAX, instead of every row of the table.
+"""
 import os
 from flask_admin import Admin
-from models import db, User, Planet, Character, Favorite
 from flask_admin.contrib.sqla import ModelView
+from flask_admin.contrib.sqla.ajax import QueryAjaxModelLoader
+from flask_admin.contrib.sqla.filters import BaseSQLAFilter, FilterEqual, IntEqualFilter, IntInListFilter
+from sqlalchemy import func, text
+from sqlalchemy.orm import joinedload
+from models import db, User, Planet, Character, Favorite
+
+DEFAULT_ESTIMATED_COUNT_THRESHOLD = 100000
+DEFAULT_LOOKUP_PAGE_SIZE = 10
+
+_settings = {"estimated_count_threshold": DEFAULT_ESTIMATED_COUNT_THRESHOLD,
+             "lookup_page_size": DEFAULT_LOOKUP_PAGE_SIZE}
+
+
+# -----------------------------------Counts--------------------------------------------------
+
+def estimated_count(session, model):
+    """Rows of the model's table according to the PostgreSQL statistics, None elsewhere or if never analyzed."""
+    bind = session.get_bind(mapper=model.__mapper__)
+    if bind.dialect.name != "postgresql":
+        return None
+    table = bind.dialect.identifier_preparer.format_table(model.__table__)
+    estimate = session.execute(text("SELECT reltuples::bigint FROM pg_class WHERE oid = CAST(:table AS regclass)"),
+                               {"table": table}).scalar()
+    # -1: la tabla nunca fue analizada
+    if estimate is None or estimate < 0:
+        return None
+    return estimate
+
+
+class EstimatedCountQuery:
+    """
+    Count query of a list page: scalar() returns the estimate for big tables. The search
+    and the filters call filter() / join(), which return the real query: an exact count.
+    """
+
+    def __init__(self, session, model, exact):
+        self.session = session
+        self.model = model
+        self.exact = exact
+
+    def scalar(self):
+        estimate = estimated_count(self.session, self.model)
+        if estimate is not None and estimate >= _settings["estimated_count_threshold"]:
+            return estimate
+        return self.exact.scalar()
+
+    def __getattr__(self, name):
+        return getattr(self.exact, name)
+
+
+# -----------------------------------Filters and lookups--------------------------------------------------
+
+def _name_key(column, session):
+    # misma expresion que el indice ix_<tabla>_name_prefix (solo existe en PostgreSQL)
+    key = func.lower(column)
+    if session.get_bind().dialect.name == "postgresql":
+        key = key.collate("C")
+    return key
+
+
+class NamePrefixFilter(BaseSQLAFilter):
+
+    def apply(self, query, value, alias=None):
+        key = _name_key(self.get_column(alias), query.session)
+        return query.filter(key.startswith(value.lower(), autoescape=True))
+
+    def operation(self):
+        return "starts with"
+
+
+class PrefixAjaxModelLoader(QueryAjaxModelLoader):
+    """Select2 lookup: rows whose field starts with the term, in index order, one page at a time."""
+
+    def __init__(self, name, model, field, lower=False):
+        super().__init__(name, db.session, model, fields=[field])
+        self.field = field
+        self.lower = lower
+
+    def format(self, model):
+        if not model:
+            return None
+        return getattr(model, self.pk), getattr(model, self.field)
+
+    def get_list(self, term, offset=0, limit=DEFAULT_LOOKUP_PAGE_SIZE):
+        column = getattr(self.model, self.field)
+        term = term or ""
+        if self.lower:
+            column = _name_key(column, self.session)
+            term = term.lower()
+        # el cliente elige limit, no lo dejamos pedir la tabla entera
+        limit = min(limit or DEFAULT_LOOKUP_PAGE_SIZE, _settings["lookup_page_size"])
+        return (self.get_query().filter(column.startswith(term, autoescape=True))
+                .order_by(column).offset(offset or 0).limit(limit).all())
+
+
+def _related(relationship, field):
+    """Column formatter: one field of a related row (loaded with the list query)."""
+    def formatter(view, context, model, name):
+        related = getattr(model, relationship)
+        return getattr(related, field) if related is not None else ""
+    return formatter
+
+
+# -----------------------------------Views--------------------------------------------------
+
+class ScalableModelView(ModelView):
+    can_set_page_size = False
+    page_size = 20
+
+    def get_count_query(self):
+        return EstimatedCountQuery(self.session, self.model, super().get_count_query())
+
+
+class UserView(ScalableModelView):
+    column_list = ("id", "email", "is_active")
+    column_display_pk = True
+    column_default_sort = ("id", True)
+    column_sortable_list = ("id", "email")
+    column_filters = (FilterEqual(User.email, "Email"),)
+    # la relacion favorites cargaria todos los favoritos del usuario en el formulario
+    form_excluded_columns = ("favorites",)
+
+
+class PlanetView(ScalableModelView):
+    column_list = ("id_planet", "name", "img_link")
+    column_display_pk = True
+    column_default_sort = ("id_planet", True)
+    column_sortable_list = ("id_planet", "name")
+    column_filters = (NamePrefixFilter(Planet.name, "Name"), FilterEqual(Planet.name, "Name"))
+
+
+class CharacterView(ScalableModelView):
+    column_list = ("id_character", "name", "img_link")
+    column_display_pk = True
+    column_default_sort = ("id_character", True)
+    column_sortable_list = ("id_character", "name")
+    column_filters = (NamePrefixFilter(Character.name, "Name"), FilterEqual(Character.name, "Name"))
+
+
+class FavoriteView(ScalableModelView):
+    column_list = ("id_fav", "user", "planet", "character")
+    column_display_pk = True
+    column_default_sort = ("id_fav", True)
+    column_sortable_list = ("id_fav", "user_id")
+    column_formatters = {
+        "user": _related("user", "email"),
+        "planet": _related("planet", "name"),
+        "character": _related("character", "name"),
+    }
+    column_filters = (
+        IntEqualFilter(Favorite.user_id, "User id"),
+        IntInListFilter(Favorite.user_id, "User id"),
+        IntEqualFilter(Favorite.planet_id, "Planet id"),
+        IntEqualFilter(Favorite.character_id, "Character id"),
+    )
+    form_ajax_refs = {
+        "user": PrefixAjaxModelLoader("user", User, "email"),
+        "planet": PrefixAjaxModelLoader("planet", Planet, "name", lower=True),
+        "character": PrefixAjaxModelLoader("character", Character, "name", lower=True),
+    }
+
+    def get_query(self):
+        # una sola consulta por pagina, con las columnas que se muestran de cada relacion
+        return super().get_query().options(
+            joinedload(Favorite.user).load_only(User.email),
+            joinedload(Favorite.planet).load_only(Planet.name),
+            joinedload(Favorite.character).load_only(Character.name),
+        )
 
 
 def setup_admin(app):
     app.secret_key = os.environ.get('FLASK_APP_KEY', 'sample key')
     app.config['FLASK_ADMIN_SWATCH'] = 'cerulean'
+    _settings["estimated_count_threshold"] = int(os.environ.get("ADMIN_ESTIMATED_COUNT_THRESHOLD",
+                                                                DEFAULT_ESTIMATED_COUNT_THRESHOLD))
+    _settings["lookup_page_size"] = int(os.environ.get("ADMIN_LOOKUP_PAGE_SIZE", DEFAULT_LOOKUP_PAGE_SIZE))
     admin = Admin(app, name='4Geeks Admin', template_mode='bootstrap3')
-
-    # Add your models here, for example this is how we add a the User model to the admin
-    admin.add_view(ModelView(User, db.session))
-
-    # You can duplicate that line to add mew models
-    admin.add_view(ModelView(Planet, db.session))
-    admin.add_view(ModelView(Character, db.session))
-    admin.add_view(ModelView(Favorite, db.session))
+    # Add your models here, sobre ScalableModelView: columnas, orden y filtros indexados
+    admin.add_view(UserView(User, db.session))
+    admin.add_view(PlanetView(Planet, db.session))
+    admin.add_view(CharacterView(Character, db.session))
+    admin.add_view(FavoriteView(Favorite, db.session))
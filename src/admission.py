@@ -0,0 +1,334 @@
+"""
+Admission control for the write endpoints (POST / DELETE /favorite/..., POST /favorites/batch),
+checked before the handler touches the database:
+
+    - rate limit: a token bucket per client, keyed by the remote address plus the "email"
+      of the JSON body (the email is not authenticated: alone it would let a client use
+      up somebody else's quota). RATE_LIMIT_RATE tokens per second (5) with bursts of
+      RATE_LIMIT_BURST (20); every request costs one token (one commit, so a batch
+      counts once). A second bucket per address, RATE_LIMIT_IP_FACTOR (4) times larger,
+      caps a client that sends a different email on every request. Over either
+      limit: 429 with Retry-After. Behind a proxy (Render) the remote address is the
+      proxy's for every client: TRUSTED_PROXY_HOPS (0) proxies are trusted to set
+      X-Forwarded-For (ProxyFix, see app.create_app), without it all the clients share
+      the same buckets.
+    - load shedding: at most WRITE_MAX_CONCURRENCY writes (DB_POOL_SIZE, 5) run at
+      once per worker and WRITE_MAX_QUEUE more (10) wait up to WRITE_QUEUE_TIMEOUT seconds
+      (1) for a slot. A full queue, a wait that times out, or a recent wait for a database
+      connection above WRITE_MAX_POOL_WAIT_MS (500, see database.recent_pool_wait) answer
+      503 with Retry-After: WRITE_RETRY_AFTER (1). Reads are never shed, they keep the
+      connections the writes would have queued for.
+
+The concurrency limit is per process: it matters with threaded / gevent workers, a sync
+gunicorn worker only runs one request at a time (its queue is the listen backlog).
+
+Buckets backends, RATE_LIMIT_BACKEND (memory, redis, local-shared) like cache.py:
+    - MemoryBuckets: per process (each worker gives the full rate), the default.
+    - RedisBuckets: one bucket per client for every worker and instance, an atomic Lua
+      script; needs the `redis` package and RATE_LIMIT_REDIS_URL (or CACHE_REDIS_URL).
+    - LocalSharedBuckets: in-memory fake of a shared store, for tests.
+If the store fails the request is let through (and logged): the limiter must not take
+the API down with it. RATE_LIMIT_ENABLED=0 / WRITE_SHEDDING_ENABLED=0 turn each layer off.
+"""
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import request
+
+from database import recent_pool_wait
+from utils import APIException
+
+log = logging.getLogger(__name__)
+
+DEFAULT_RATE = 5.0
+DEFAULT_BURST = 20
+DEFAULT_IP_FACTOR = 4
+DEFAULT_MAX_KEYS = 100000
+DEFAULT_MAX_CONCURRENCY = 5
+DEFAULT_MAX_QUEUE = 10
+DEFAULT_QUEUE_TIMEOUT = 1.0
+DEFAULT_MAX_POOL_WAIT_MS = 500
+DEFAULT_RETRY_AFTER = 1
+
+_settings = {
+    "rate_limit": True,
+    "rate": DEFAULT_RATE,
+    "burst": DEFAULT_BURST,
+    "ip_factor": DEFAULT_IP_FACTOR,
+    "shedding": True,
+    "max_pool_wait": DEFAULT_MAX_POOL_WAIT_MS / 1000,
+    "retry_after": DEFAULT_RETRY_AFTER,
+}
+
+# rechazos por motivo, para /metrics
+_rejected = {"rate_limit": 0, "queue_full": 0, "queue_timeout": 0, "pool_wait": 0}
+
+
+def take_token(state, now, rate, burst, cost):
+    """
+    Token bucket step. state is (tokens, updated) or None for a new (full) bucket.
+    Returns (new state, allowed, seconds until `cost` tokens are available).
+    """
+    tokens, updated = state if state is not None else (burst, now)
+    tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+    if tokens >= cost:
+        return (tokens - cost, now), True, 0.0
+    return (tokens, now), False, (cost - tokens) / rate
+
+
+# -----------------------------------Buckets backends--------------------------------------------------
+
+class BucketsBackend:
+    """Interface every backend implements: one atomic token bucket step per call."""
+
+    def take(self, key, rate, burst, cost=1):
+        """Returns (allowed, retry_after seconds)."""
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class MemoryBuckets(BucketsBackend):
+
+    def __init__(self, max_keys=DEFAULT_MAX_KEYS, clock=time.monotonic):
+        self.max_keys = max_keys
+        self.clock = clock
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, cost=1):
+        with self._lock:
+            state, allowed, retry_after = take_token(self._buckets.get(key), self.clock(), rate, burst, cost)
+            self._buckets[key] = state
+            self._buckets.move_to_end(key)
+            # el bucket expulsado es el menos usado, volvera lleno (lo mas probable es que ya lo estuviera)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed, retry_after
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class LocalSharedBuckets(BucketsBackend):
+    """
+    Fake of a shared store: the state is kept serialized like it would be on the wire,
+    with wall clock timestamps (the only clock several machines share), and each step
+    is atomic like the Lua script of RedisBuckets.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.store = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, cost=1):
+        with self._lock:
+            raw = self.store.get(key)
+            state = tuple(json.loads(raw)) if raw is not None else None
+            state, allowed, retry_after = take_token(state, self.clock(), rate, burst, cost)
+            self.store[key] = json.dumps(state)
+        return allowed, retry_after
+
+    def clear(self):
+        with self._lock:
+            self.store.clear()
+
+
+# Mismo algoritmo que take_token(), con el reloj de Redis para que todos los workers coincidan
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    retry_after = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(retry_after)}
+"""
+
+
+class RedisBuckets(BucketsBackend):
+
+    def __init__(self, url, prefix="swapi:rate:"):
+        import redis  # dependencia opcional, solo si se usa RATE_LIMIT_BACKEND=redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.script = self.client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def take(self, key, rate, burst, cost=1):
+        allowed, retry_after = self.script(keys=[self.prefix + key], args=[rate, burst, cost])
+        return bool(allowed), float(retry_after)
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + "*"):
+            self.client.delete(key)
+
+
+buckets = MemoryBuckets()
+
+
+# -----------------------------------Concurrency limiter--------------------------------------------------
+
+class ConcurrencyLimiter:
+    """At most max_active holders, max_queue more wait up to timeout seconds for a slot."""
+
+    def __init__(self, max_active=DEFAULT_MAX_CONCURRENCY, max_queue=DEFAULT_MAX_QUEUE,
+                 timeout=DEFAULT_QUEUE_TIMEOUT):
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """None when admitted (call release() afterwards), otherwise the rejection reason."""
+        with self._condition:
+            if self.active < self.max_active:
+                self.active += 1
+                return None
+            if self.waiting >= self.max_queue:
+                return "queue_full"
+            self.waiting += 1
+            try:
+                if not self._condition.wait_for(lambda: self.active < self.max_active, self.timeout):
+                    return "queue_timeout"
+                self.active += 1
+                return None
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+
+write_limiter = ConcurrencyLimiter()
+
+
+# -----------------------------------Checks--------------------------------------------------
+
+def _reject(reason):
+    _rejected[reason] += 1
+
+
+def check_rate_limit(email, remote_addr):
+    """Raises a 429 APIException when the client has no tokens left."""
+    if not _settings["rate_limit"]:
+        return
+    limits = [("ip:" + str(remote_addr), _settings["rate"], _settings["burst"])]
+    if isinstance(email, str) and email:
+        # la direccion va siempre en la clave: el email del body no esta autenticado
+        factor = _settings["ip_factor"]
+        limits = [("client:" + str(remote_addr) + ":" + email, _settings["rate"], _settings["burst"]),
+                  ("ip-all:" + str(remote_addr), _settings["rate"] * factor, _settings["burst"] * factor)]
+    try:
+        for key, rate, burst in limits:
+            allowed, retry_after = buckets.take(key, rate, burst)
+            if not allowed:
+                break
+    except Exception:
+        log.exception("rate limit store failed, request let through")
+        return
+    if not allowed:
+        _reject("rate_limit")
+        seconds = max(1, math.ceil(retry_after))
+        raise APIException("Demasiadas solicitudes, intente de nuevo en " + str(seconds) + " segundos",
+                           status_code=429, payload={"retry_after": seconds},
+                           headers={"Retry-After": str(seconds)})
+
+
+def _overloaded(reason):
+    _reject(reason)
+    seconds = _settings["retry_after"]
+    return APIException("Servidor ocupado, intente de nuevo en " + str(seconds) + " segundos",
+                        status_code=503, payload={"retry_after": seconds},
+                        headers={"Retry-After": str(seconds)})
+
+
+def admission_control(view):
+    """Rate limit + load shedding around a write view of app.py."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        data = request.get_json(silent=True)
+        check_rate_limit(data.get("email") if isinstance(data, dict) else None, request.remote_addr)
+
+        if not _settings["shedding"]:
+            return view(*args, **kwargs)
+        if _settings["max_pool_wait"] and recent_pool_wait() > _settings["max_pool_wait"]:
+            raise _overloaded("pool_wait")
+        reason = write_limiter.acquire()
+        if reason is not None:
+            raise _overloaded(reason)
+        try:
+            return view(*args, **kwargs)
+        finally:
+            write_limiter.release()
+    return wrapper
+
+
+# -----------------------------------Setup--------------------------------------------------
+
+def _collector():
+    lines = [
+        "# HELP admission_rejected_total Write requests rejected by admission.py",
+        "# TYPE admission_rejected_total counter",
+    ]
+    for reason, count in sorted(_rejected.items()):
+        lines.append('admission_rejected_total{reason="' + reason + '"} ' + str(count))
+    lines.append("# HELP admission_writes Write requests running and waiting for a slot in this worker")
+    lines.append("# TYPE admission_writes gauge")
+    lines.append('admission_writes{state="active"} ' + str(write_limiter.active))
+    lines.append('admission_writes{state="waiting"} ' + str(write_limiter.waiting))
+    return lines
+
+
+def make_backend(name):
+    if name == "redis":
+        return RedisBuckets(os.environ.get("RATE_LIMIT_REDIS_URL") or os.environ["CACHE_REDIS_URL"])
+    if name == "local-shared":
+        return LocalSharedBuckets()
+    return MemoryBuckets(int(os.environ.get("RATE_LIMIT_MAX_KEYS", DEFAULT_MAX_KEYS)))
+
+
+def setup_admission(app):
+    global buckets
+    _settings["rate_limit"] = os.environ.get("RATE_LIMIT_ENABLED", "1") != "0"
+    _settings["rate"] = float(os.environ.get("RATE_LIMIT_RATE", DEFAULT_RATE))
+    _settings["burst"] = float(os.environ.get("RATE_LIMIT_BURST", DEFAULT_BURST))
+    _settings["ip_factor"] = float(os.environ.get("RATE_LIMIT_IP_FACTOR", DEFAULT_IP_FACTOR))
+    _settings["shedding"] = os.environ.get("WRITE_SHEDDING_ENABLED", "1") != "0"
+    _settings["max_pool_wait"] = float(os.environ.get("WRITE_MAX_POOL_WAIT_MS", DEFAULT_MAX_POOL_WAIT_MS)) / 1000
+    _settings["retry_after"] = int(os.environ.get("WRITE_RETRY_AFTER", DEFAULT_RETRY_AFTER))
+    buckets = make_backend(os.environ.get("RATE_LIMIT_BACKEND", "memory"))
+
+    write_limiter.max_active = int(os.environ.get("WRITE_MAX_CONCURRENCY",
+                                                  os.environ.get("DB_POOL_SIZE", DEFAULT_MAX_CONCURRENCY)))
+    write_limiter.max_queue = int(os.environ.get("WRITE_MAX_QUEUE", DEFAULT_MAX_QUEUE))
+    write_limiter.timeout = float(os.environ.get("WRITE_QUEUE_TIMEOUT", DEFAULT_QUEUE_TIMEOUT))
+
+    if "metrics" in app.extensions:
+        app.extensions["metrics"].register_collector(_collector)
+    app.extensions["admission"] = write_limiter
@@ -1,46 +1,56 @@
 """
 This module takes care of starting the API Server, Loading the DB and Adding the endpoints
+
+The application is built by create_app(): `flask` finds it through FLASK_APP, wsgi.py and
+asgi.py call it once per process. Flask-Admin and Flask-Migrate are imported only when
+they are used (ADMIN_ENABLED, the `flask db` commands), see create_app().
 """
 import os
-from flask import Flask, request, jsonify, url_for
-from flask_migrate import Migrate
-from flask_swagger import swagger
+from flask import Blueprint, Flask, request, jsonify, url_for
 from flask_cors import CORS
-from utils import APIException, generate_sitemap
-from admin import setup_admin
+from werkzeug.middleware.proxy_fix import ProxyFix
+from sqlalchemy.orm import joinedload
+from utils import APIException
+from admission import admission_control, setup_admission
+from cache import setup_cache, cached_response
+from catalogsnapshot import setup_catalog_snapshot, snapshot_response
+from changefeed import setup_change_feed
+from commands import setup_commands
+from conditional import setup_conditional
+from content_encoding import setup_compression
+from database import database_url, engine_options, setup_database
+from instrumentation import setup_instrumentation
+from favorites import apply_batch, parse_batch
+from lookups import catalog_item_exists, forget, setup_lookups, user_id_for_email
 from models import db, User, Character, Planet, Favorite
+from popularity import setup_popularity
+from profiling import setup_profiling
+from readmodel import document_response, read_document, read_model_enabled, setup_read_model
+from serializers import USER, PLANET, CHARACTER, json_rows_response
+from search import setup_search
+from writebehind import add_favorite, remove_favorite, setup_write_behind
+from sitemap import document_response as sitemap_response, setup_sitemap
+from pagination import wants_page, wants_stream, page_args, keyset_page, page_response, stream_response
 
 # from models import Person
 
-app = Flask(__name__)
-app.url_map.strict_slashes = False
-
-db_url = os.getenv("DATABASE_URL")
-if db_url is not None:
-    app.config['SQLALCHEMY_DATABASE_URI'] = db_url.replace(
-        "postgres://", "postgresql://")
-else:
-    app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////tmp/test.db"
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Todas las rutas de la API, create_app() las registra en la aplicacion
+api = Blueprint("api", __name__)
 
-MIGRATE = Migrate(app, db)
-db.init_app(app)
-CORS(app)
-setup_admin(app)
 
 # Handle/serialize errors like a JSON object
 
 
-@app.errorhandler(APIException)
 def handle_invalid_usage(error):
-    return jsonify(error.to_dict()), error.status_code
+    return jsonify(error.to_dict()), error.status_code, error.headers or {}
 
 # generate sitemap with all your endpoints, devuelve todas las rutas del sitio cuando se entra a la ruta principal
 
 
-@app.route('/')
+@api.route('/')
 def sitemap():
-    return generate_sitemap(app)
+    # construido una sola vez en setup_sitemap()
+    return sitemap_response("html")
 
 
 # with app.app_context():
@@ -76,13 +86,26 @@ def sitemap():
     # -----------------------------------------Get Todas las Personas-----------------------------------------------------------------------------
 
 
-@app.route('/people', methods=['GET'])
+@api.route('/people', methods=['GET'])
+@cached_response('people')
 def get_all_people():
 
-    all_people = Character.query.all()
-    all_people = list(map(lambda x: x.serialize(), all_people))
-    # Otra alternativa para serializar, cuando se consulta al modelo no se pude transformar directamente a un json, por eso se serializa
-    # all_people = [person.serialize() for person in Person.query.all()]
+    # ?stream=json|ndjson exporta toda la tabla por chunks, ?limit=&after= devuelve una pagina
+    fmt = wants_stream()
+    if fmt:
+        return stream_response(CHARACTER, Character.id_character, fmt)
+
+    if wants_page():
+        after, limit = page_args()
+        people, next_cursor = keyset_page(
+            CHARACTER.query(), Character.id_character, after, limit)
+        if people or after is not None:
+            return page_response(CHARACTER, people, '.get_all_people', next_cursor, limit)
+        all_people = []
+    else:
+        # Solo consultamos las columnas que se devuelven, sin crear objetos Character (ver serializers.py)
+        # la salida es la misma que con Character.serialize()
+        all_people = CHARACTER.query().order_by(Character.id_character).all()
 
     if not all_people:
         response_body = {
@@ -90,12 +113,14 @@ def get_all_people():
         }
         return jsonify(response_body), 404
 
-    return jsonify(all_people), 200
+    return json_rows_response(CHARACTER, all_people)
 
 
 # -----------------------------------------Get People por id-------------------------------------------------------------------------------------
 
-@app.route('/people/<int:people_id>', methods=['GET'])
+@api.route('/people/<int:people_id>', methods=['GET'])
+@snapshot_response('people', 'people_id')
+@cached_response('people', id_arg='people_id')
 def get_people_by_id(people_id):
 
     people = Character.query.get(people_id)
@@ -112,13 +137,23 @@ def get_people_by_id(people_id):
 
 # -----------------------------------------Get Todos los Planetas-----------------------------------------------------------------------------
 
-@app.route('/planets', methods=['GET'])
+@api.route('/planets', methods=['GET'])
+@cached_response('planets')
 def get_planets():
 
-    all_planets = Planet.query.all()
-    all_planets = list(map(lambda x: x.serialize(), all_planets))
-    # Otra alternativa para serializar, cuando se consulta al modelo no se pude transformar directamente a un json, por eso se serializa
-    # all_people = [person.serialize() for person in Person.query.all()]
+    fmt = wants_stream()
+    if fmt:
+        return stream_response(PLANET, Planet.id_planet, fmt)
+
+    if wants_page():
+        after, limit = page_args()
+        planets, next_cursor = keyset_page(
+            PLANET.query(), Planet.id_planet, after, limit)
+        if planets or after is not None:
+            return page_response(PLANET, planets, '.get_planets', next_cursor, limit)
+        all_planets = []
+    else:
+        all_planets = PLANET.query().order_by(Planet.id_planet).all()
 
     if not all_planets:
         response_body = {
@@ -126,12 +161,14 @@ def get_planets():
         }
         return jsonify(response_body), 404
 
-    return jsonify(all_planets), 200
+    return json_rows_response(PLANET, all_planets)
 
 
 # -----------------------------------------Get Planet por id-------------------------------------------------------------------------------------
 
-@app.route('/planets/<int:planet_id>', methods=['GET'])
+@api.route('/planets/<int:planet_id>', methods=['GET'])
+@snapshot_response('planets', 'planet_id')
+@cached_response('planets', id_arg='planet_id')
 def get_planet_id(planet_id):
 
     planet = Planet.query.get(planet_id)
@@ -148,11 +185,22 @@ def get_planet_id(planet_id):
 
 # -----------------------------------------Get Todos los Usuarios-----------------------------------------------------------------------------
 
-@app.route('/users', methods=['GET'])
+@api.route('/users', methods=['GET'])
 def get_users():
 
-    all_users = User.query.all()
-    all_users = list(map(lambda x: x.serialize(), all_users))
+    fmt = wants_stream()
+    if fmt:
+        return stream_response(USER, User.id, fmt)
+
+    if wants_page():
+        after, limit = page_args()
+        users, next_cursor = keyset_page(USER.query(), User.id, after, limit)
+        if users or after is not None:
+            return page_response(USER, users, '.get_users', next_cursor, limit)
+        all_users = []
+    else:
+        # sin cargar password ni crear objetos User
+        all_users = USER.query().order_by(User.id).all()
 
     if not all_users:
         response_body = {
@@ -160,14 +208,20 @@ def get_users():
         }
         return jsonify(response_body), 404
 
-    return jsonify(all_users), 200
+    return json_rows_response(USER, all_users)
 
 
 # -----------------------------------------Get Todos los Favoritos de un usuari0-----------------------------------------------------------------------------
 
-@app.route('/users/favorites/<int:user_id>', methods=['GET'])
+@api.route('/users/favorites/<int:user_id>', methods=['GET'])
 def get_users_favorites(user_id):
 
+    # Con el read model activo la respuesta ya esta guardada: una lectura por primary key
+    if read_model_enabled():
+        document = read_document(user_id)
+        if document is not None:
+            return document_response(document)
+
     user = User.query.get(user_id)
 
     if user is None:
@@ -178,7 +232,12 @@ def get_users_favorites(user_id):
 
     all_user_favorites = []
 
-    for favorite in user.favorites:
+    # Cargamos planet y character en la misma consulta (LEFT OUTER JOIN), asi el numero de
+    # queries no crece con la cantidad de favoritos (antes era 1 query extra por cada favorito)
+    favorites = Favorite.query.filter_by(user_id=user.id).options(
+        joinedload(Favorite.planet), joinedload(Favorite.character)).order_by(Favorite.id_fav).all()
+
+    for favorite in favorites:
 
         data = {
             "id_favorite": favorite.id_fav,
@@ -200,7 +259,8 @@ def get_users_favorites(user_id):
 
 # -----------------------------------------Agrega un planet favorito al usuario actual con el id: planet_id, tambien elimina-----------------------------------------------------------------------------
 
-@app.route('/favorite/planet/<int:planet_id>', methods=['POST', 'DELETE'])
+@api.route('/favorite/planet/<int:planet_id>', methods=['POST', 'DELETE'])
+@admission_control
 def manage_favorite_planet(planet_id):
 
     # Obtenemos los datos de ambos metodos: POST y DELETE
@@ -212,46 +272,42 @@ def manage_favorite_planet(planet_id):
     if "email" not in data:
         return "Se debe especificar el email del usuario", 400
 
-    planet = Planet.query.get(planet_id)
-
-    if planet is None:
+    if not catalog_item_exists(Planet, planet_id):
         return "El id de planeta { " + str(planet_id) + " } no se encontró", 400
 
-    user = User.query.filter_by(email=data["email"]).first()
+    user_id = user_id_for_email(data["email"])
 
-    if user is None:
+    if user_id is None:
         return "El email enviado no fue encontrado", 400
 
     # Si es POST
     if request.method == 'POST':
 
-        favorite = Favorite()
-        favorite.user_id = user.id
-        favorite.planet_id = planet_id
+        if add_favorite(user_id, "planets", planet_id):
+            return "Planeta agregado como favorito al usuario: " + data["email"], 200
 
-        db.session.add(favorite)
-        db.session.commit()
-
-        return "Planeta agregado como favorito al usuario: " + user.email, 200
+        # el insert fallo: ya era favorito, o la cache tenia un usuario / planeta que se borro
+        # en otro worker (foreign key). Se vuelve a consultar la base de datos
+        forget(data["email"], Planet, planet_id)
+        if not catalog_item_exists(Planet, planet_id):
+            return "El id de planeta { " + str(planet_id) + " } no se encontró", 400
+        if user_id_for_email(data["email"]) is None:
+            return "El email enviado no fue encontrado", 400
+        return "El Planeta: " + str(planet_id) + " , ya es favorito del usuario: " + data["email"], 400
 
     # SI ES DELETE
     elif request.method == 'DELETE':
 
-        favorite = Favorite.query.filter_by(
-            planet_id=planet_id, user_id=user.id).first()
-
-        if favorite is None:
-            return "El Planeta: " + str(planet_id) + " , no fue encontrado para el usuario: " + user.email, 400
-
-        db.session.delete(favorite)
-        db.session.commit()
+        if not remove_favorite(user_id, "planets", planet_id):
+            return "El Planeta: " + str(planet_id) + " , no fue encontrado para el usuario: " + data["email"], 400
 
         return "Favorito eliminado exitosamente", 200
 
 
 # -----------------------------------------Agrega un people favorito al usuario actual con el id: people_id, tambien elimina-----------------------------------------------------------------------------
 
-@app.route('/favorite/people/<int:people_id>', methods=['POST', 'DELETE'])
+@api.route('/favorite/people/<int:people_id>', methods=['POST', 'DELETE'])
+@admission_control
 def manage_favorite_people(people_id):
 
    # Obtenemos los datos de ambos metodos: POST y DELETE
@@ -263,45 +319,123 @@ def manage_favorite_people(people_id):
     if "email" not in data:
         return "Se debe especificar el email del usuario", 400
 
-    people = Character.query.get(people_id)
-
-    if people is None:
+    if not catalog_item_exists(Character, people_id):
         return "El id del caracter { " + str(people_id) + " } no se encontró", 400
 
-    user = User.query.filter_by(email=data["email"]).first()
+    user_id = user_id_for_email(data["email"])
 
-    if user is None:
+    if user_id is None:
         return "El email enviado no fue encontrado", 400
 
     # Si es POST
     if request.method == 'POST':
 
-        favorite = Favorite()
-        favorite.user_id = user.id
-        favorite.character_id = people_id
-
-        db.session.add(favorite)
-        db.session.commit()
+        if add_favorite(user_id, "people", people_id):
+            return "People agregado como favorito al usuario: " + data["email"], 200
 
-        return "People agregado como favorito al usuario: " + user.email, 200
+        # igual que en planet: se descarta la cache y se confirma contra la base de datos
+        forget(data["email"], Character, people_id)
+        if not catalog_item_exists(Character, people_id):
+            return "El id del caracter { " + str(people_id) + " } no se encontró", 400
+        if user_id_for_email(data["email"]) is None:
+            return "El email enviado no fue encontrado", 400
+        return "People: " + str(people_id) + " , ya es favorito del usuario: " + data["email"], 400
 
     # SI ES DELETE
     elif request.method == 'DELETE':
 
-        favorite = Favorite.query.filter_by(
-            character_id=people_id, user_id=user.id).first()
+        if not remove_favorite(user_id, "people", people_id):
+            return "People: " + str(people_id) + " , no fue encontrado para el usuario: " + data["email"], 400
 
-        if favorite is None:
-            return "People: " + str(people_id) + " , no fue encontrado para el usuario: " + user.email, 400
+        return "Favorito eliminado exitosamente", 200
 
-        db.session.delete(favorite)
-        db.session.commit()
 
-        return "Favorito eliminado exitosamente", 200
+# -----------------------------------------Agrega y elimina varios favoritos del usuario en una sola solicitud-----------------------------------------------------------------------------
+
+@api.route('/favorites/batch', methods=['POST'])
+@admission_control
+def batch_favorites():
+    """
+    Body: {"email": "...", "add": {"planets": [1, 2], "people": [3]}, "remove": {"planets": [4]}}
+    Responde el resultado de cada item: added, removed, already_favorite, not_favorite, not_found, conflict, duplicate
+    """
+    email, add, remove = parse_batch(request.get_json(silent=True))
+
+    user_id = user_id_for_email(email)
+
+    if user_id is None:
+        raise APIException("El email enviado no fue encontrado", status_code=400)
+
+    results = apply_batch(user_id, add, remove)
+
+    return jsonify({"user_id": user_id, "results": results}), 200
+
+
+# -----------------------------------------Application factory-----------------------------------------------------------------------------
+
+def admin_enabled():
+    # El admin no tiene autenticacion: por defecto solo se monta en desarrollo (FLASK_DEBUG=1)
+    value = os.environ.get("ADMIN_ENABLED", os.environ.get("FLASK_DEBUG", "0"))
+    return value.lower() not in ("0", "false", "")
+
+
+def create_app(admin=None, migrations=True, minimal=False):
+    """
+    admin:      mount Flask-Admin on /admin, None reads ADMIN_ENABLED (default FLASK_DEBUG)
+    migrations: register Flask-Migrate for the `flask db` commands (the servers skip it)
+    minimal:    only the database and the migrations, for `flask db upgrade` on release
+    """
+    app = Flask(__name__)
+    app.url_map.strict_slashes = False
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+    # pool, pre-ping y statement timeout desde variables de entorno (ver database.py)
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+    db.init_app(app)
+    if migrations:
+        # alembic tarda en importarse y solo lo usan los comandos `flask db`
+        from flask_migrate import Migrate
+        Migrate(app, db)
+    if minimal:
+        return app
+
+    CORS(app)
+    # detras del proxy de Render remote_addr seria la del proxy para todos (ver admission.py)
+    proxy_hops = int(os.environ.get("TRUSTED_PROXY_HOPS", 0))
+    if proxy_hops:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxy_hops)
+    if admin_enabled() if admin is None else admin:
+        from admin import setup_admin
+        setup_admin(app)
+    setup_cache(app)
+    setup_lookups(app)
+    setup_read_model(app)
+    # antes que setup_conditional: los after_request corren en orden inverso y asi medimos todo
+    setup_instrumentation(app)
+    # despues de instrumentation (usa su /metrics), sus after_request tambien quedan dentro de la medicion
+    setup_profiling(app)
+    setup_database(app)
+    setup_admission(app)
+    setup_write_behind(app)
+    setup_change_feed(app)
+    setup_catalog_snapshot(app)
+    setup_compression(app)
+    setup_conditional(app)
+    setup_commands(app)
+    setup_search(app)
+    setup_popularity(app)
+
+    app.register_error_handler(APIException, handle_invalid_usage)
+    app.register_blueprint(api)
+    # al final: recorre todas las rutas registradas
+    setup_sitemap(app)
+    return app
 
 
 # --------------------------------------------------------------------------------------------------------------------------------------------------
 # this only runs if `$ python src/app.py` is executed
 if __name__ == '__main__':
     PORT = int(os.environ.get('PORT', 3000))
-    app.run(host='0.0.0.0', port=PORT, debug=False)
+    create_app().run(host='0.0.0.0', port=PORT, debug=False)
@@ -0,0 +1,428 @@
+"""
+Async (ASGI) entry point, an alternative to wsgi.py.
+
+The API routes of app.py run here as async views on an async SQLAlchemy engine
+(asyncpg for PostgreSQL, aiosqlite for SQLite), using the same models, projections
+(serializers.py) and favorite logic (favorites.py), so the responses are the same bytes
+the Flask app returns. A worker waiting on the database keeps serving other requests
+instead of blocking, so concurrency is no longer capped by the number of workers.
+
+Everything else (/, /admin, /metrics, ...) is passed to the Flask app through a WSGI
+adapter. The async routes do not go through the Flask hooks (response cache, ETags,
+Server-Timing); the writes do apply the rate limit of admission.py, the async engine pool
+queues them instead of the concurrency limiter. The Server-Sent Events change feed
+(/changes, changefeed.py) is only served here.
+
+Run it with (see docs/ASYNC.md):
+
+    gunicorn asgi:application --chdir ./src/ -k uvicorn.workers.UvicornWorker --workers 4
+"""
+import asyncio
+import json
+import os
+from contextlib import asynccontextmanager
+
+from a2wsgi import WSGIMiddleware
+from sqlalchemy import delete, insert, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import HTMLResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+
+from app import create_app
+from admission import check_rate_limit
+from catalogsnapshot import snapshot_body
+from changefeed import (change_feed, change_feed_enabled, check_capacity, favorite_event, listen, listen_enabled,
+                        parse_filters, record, stream_events)
+from database import database_url, engine_options, read_database_url
+from favorites import (CONFLICT_MESSAGE, ITEM_TYPES, batch_events, existing_ids_statement, favorites_by_item,
+                       parse_batch, plan_batch, requested_ids, user_favorites_statement)
+from lookups import (cached_user_id, forget, item_statement, known_item, remember_item,
+                     remember_user_id, user_id_statement)
+from models import User, Planet, Character, Favorite, UserFavorites
+from pagination import DEFAULT_LIMIT, MAX_LIMIT, STREAM_CHUNK_SIZE, STREAM_FORMATS
+from popularity import apply_deltas, batch_deltas
+from readmodel import favorites_statement, read_model_enabled, refresh_user, render_favorites
+from serializers import USER, PLANET, CHARACTER
+from utils import APIException
+
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def async_database_url(url):
+    """Same database as the Flask app, with the async driver."""
+    scheme, rest = url.split("://", 1)
+    dialect = scheme.split("+", 1)[0]
+    if dialect not in ASYNC_DRIVERS:
+        raise RuntimeError("No async driver configured for " + dialect)
+    return ASYNC_DRIVERS[dialect] + "://" + rest
+
+
+def async_engine_options(url, name="primary"):
+    # mismas variables DB_POOL_* que el engine de Flask, con el pool async por defecto de SQLAlchemy
+    options = engine_options(url, name)
+    options.pop("poolclass", None)
+    # engine_options pasa el statement_timeout como "options" de libpq: asyncpg no tiene ese
+    # argumento, lo recibe en server_settings (aiosqlite no tiene statement timeout)
+    options.pop("connect_args", None)
+    statement_timeout = os.environ.get("DB_STATEMENT_TIMEOUT_MS")
+    if statement_timeout and url.startswith("postgresql"):
+        options["connect_args"] = {"server_settings": {"statement_timeout": str(int(statement_timeout))}}
+    return options
+
+
+engine = create_async_engine(async_database_url(database_url()), **async_engine_options(database_url()))
+Session = async_sessionmaker(engine, expire_on_commit=False)
+
+# los GET van a la replica si DATABASE_READ_URL esta configurada (como RoutingSession en Flask)
+if read_database_url():
+    read_engine = create_async_engine(async_database_url(read_database_url()),
+                                      **async_engine_options(read_database_url(), "replica"))
+    ReadSession = async_sessionmaker(read_engine, expire_on_commit=False)
+else:
+    read_engine = None
+    ReadSession = Session
+
+# sirve todo lo que no tiene vista async (sitemap, admin, metrics...), sin Flask-Migrate
+flask_app = create_app(migrations=False)
+
+
+# -----------------------------------Helpers--------------------------------------------------
+
+def json_response(data, status=200, headers=None):
+    # mismo formato que jsonify: claves ordenadas, compacto, ASCII y salto de linea final
+    body = json.dumps(data, sort_keys=True, separators=(",", ":")) + "\n"
+    return Response(body, status_code=status, media_type="application/json", headers=headers)
+
+
+def rows_response(projection, rows, headers=None):
+    return Response(projection.encode(rows) + "\n", media_type="application/json", headers=headers)
+
+
+def _int_arg(request, name, minimum):
+    value = request.query_params.get(name)
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        raise APIException("'" + name + "' must be an integer", status_code=400)
+    if value < minimum:
+        raise APIException("'" + name + "' must be >= " + str(minimum), status_code=400)
+    return value
+
+
+def _stream_format(request):
+    fmt = request.query_params.get("stream")
+    if fmt is None:
+        return None
+    if fmt in ("", "1", "true"):
+        return "json"
+    if fmt not in STREAM_FORMATS:
+        raise APIException("'stream' must be one of: " + ", ".join(STREAM_FORMATS), status_code=400)
+    return fmt
+
+
+async def _stream(projection, key_column, fmt):
+    async with ReadSession() as session:
+        result = await session.stream(
+            select(*projection.columns).order_by(key_column).execution_options(yield_per=STREAM_CHUNK_SIZE))
+        if fmt == "json":
+            yield "["
+        first = True
+        async for partition in result.partitions():
+            if fmt == "ndjson":
+                yield "".join(projection.encode_row(row) + "\n" for row in partition)
+            else:
+                chunk = ",".join(projection.encode_row(row) for row in partition)
+                yield chunk if first else "," + chunk
+                first = False
+        if fmt == "json":
+            yield "]\n"
+
+
+async def list_view(request, projection, key_column, empty_msg):
+    """Same behaviour as the Flask list endpoints: full list, ?limit=&after= pages or ?stream=."""
+    fmt = _stream_format(request)
+    if fmt:
+        return StreamingResponse(_stream(projection, key_column, fmt), media_type=STREAM_FORMATS[fmt])
+
+    query = select(*projection.columns).order_by(key_column)
+    paginated = "limit" in request.query_params or "after" in request.query_params
+    if paginated:
+        limit = _int_arg(request, "limit", 1)
+        limit = DEFAULT_LIMIT if limit is None else min(limit, MAX_LIMIT)
+        after = _int_arg(request, "after", 0)
+        if after is not None:
+            query = query.where(key_column > after)
+        query = query.limit(limit + 1)
+
+    async with ReadSession() as session:
+        rows = (await session.execute(query)).all()
+
+    if paginated and (rows or after is not None):
+        headers = {}
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = rows[-1][0]
+            headers["Link"] = '<' + request.url.path + "?after=" + str(next_cursor) + "&limit=" + str(limit) + '>; rel="next"'
+            headers["X-Next-Cursor"] = str(next_cursor)
+        return rows_response(projection, rows, headers)
+
+    if not rows:
+        return json_response({"msg": empty_msg}, 404)
+    return rows_response(projection, rows)
+
+
+async def item_view(catalog, projection, key_column, item_id, missing_msg):
+    body = snapshot_body(catalog, item_id)
+    if body is not None:
+        return Response(body, media_type="application/json")
+    async with ReadSession() as session:
+        row = (await session.execute(select(*projection.columns).where(key_column == item_id))).first()
+    if row is None:
+        return json_response({"msg": missing_msg}, 404)
+    return json_response(projection.to_dict(row))
+
+
+# -----------------------------------Routes--------------------------------------------------
+
+async def get_all_people(request):
+    return await list_view(request, CHARACTER, Character.id_character, "Not people found")
+
+
+async def get_people_by_id(request):
+    people_id = request.path_params["people_id"]
+    return await item_view("people", CHARACTER, Character.id_character, people_id,
+                           "Not people with id: {" + str(people_id) + "} found")
+
+
+async def get_planets(request):
+    return await list_view(request, PLANET, Planet.id_planet, "Not planets found")
+
+
+async def get_planet_id(request):
+    planet_id = request.path_params["planet_id"]
+    return await item_view("planets", PLANET, Planet.id_planet, planet_id,
+                           "Not planet with id: {" + str(planet_id) + "} found")
+
+
+async def get_users(request):
+    return await list_view(request, USER, User.id, "Not users found")
+
+
+async def get_users_favorites(request):
+    user_id = request.path_params["user_id"]
+    async with ReadSession() as session:
+        if read_model_enabled():
+            document = (await session.execute(
+                select(UserFavorites.document).where(UserFavorites.user_id == user_id))).scalar()
+            if document is not None:
+                return Response(document + "\n", media_type="application/json")
+
+        user = (await session.execute(select(User.id).where(User.id == user_id))).first()
+        if user is None:
+            return json_response({"msg": "User  { " + str(user_id) + " } not found"}, 404)
+
+        # un solo join proyectando solo las columnas que se devuelven
+        rows = await session.execute(favorites_statement([user_id]))
+
+    return json_response(render_favorites(rows).get(user_id, []))
+
+
+async def _item_exists(session, model, item_id):
+    """lookups.catalog_item_exists() on the async session."""
+    known, generation = known_item(model, item_id)
+    if known:
+        return True
+    if (await session.execute(item_statement(model, item_id))).first() is None:
+        return False
+    remember_item(model, item_id, generation)
+    return True
+
+
+async def _user_id(session, email):
+    """lookups.user_id_for_email() on the async session."""
+    user_id, generation = cached_user_id(email)
+    if user_id is None:
+        user_id = (await session.execute(user_id_statement(email))).scalar()
+        remember_user_id(email, user_id, generation)
+    return user_id
+
+
+def _client_host(request):
+    return request.client.host if request.client else None
+
+
+async def _manage_favorite(request, item_type, item_id, labels):
+    """POST / DELETE of one favorite, same messages and status codes as app.py."""
+    model, pk_column, column = ITEM_TYPES[item_type]
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+
+    check_rate_limit(data.get("email") if isinstance(data, dict) else None, _client_host(request))
+
+    if data is None:
+        return HTMLResponse("Cuerpo de la solicitud vacío", 400)
+
+    if "email" not in data:
+        return HTMLResponse("Se debe especificar el email del usuario", 400)
+
+    async with Session() as session:
+        if not await _item_exists(session, model, item_id):
+            return HTMLResponse(labels["missing"].format(item_id), 400)
+
+        user_id = await _user_id(session, data["email"])
+        if user_id is None:
+            return HTMLResponse("El email enviado no fue encontrado", 400)
+
+        if request.method == "POST":
+            try:
+                await session.execute(insert(Favorite).values({"user_id": user_id, column: item_id}))
+                await session.run_sync(apply_deltas, {(item_type, item_id): 1})
+                await session.run_sync(record, [favorite_event(user_id, item_type, item_id, "added")])
+                if read_model_enabled():
+                    await session.run_sync(refresh_user, user_id)
+                await session.commit()
+            except IntegrityError:
+                await session.rollback()
+                # como en app.py: la cache pudo tener un usuario / item borrado
+                forget(data["email"], model, item_id)
+                if not await _item_exists(session, model, item_id):
+                    return HTMLResponse(labels["missing"].format(item_id), 400)
+                if await _user_id(session, data["email"]) is None:
+                    return HTMLResponse("El email enviado no fue encontrado", 400)
+                return HTMLResponse(labels["duplicate"].format(item_id, data["email"]), 400)
+            return HTMLResponse(labels["added"] + data["email"], 200)
+
+        result = await session.execute(
+            delete(Favorite).where(Favorite.user_id == user_id, getattr(Favorite, column) == item_id))
+        if result.rowcount:
+            await session.run_sync(apply_deltas, {(item_type, item_id): -1})
+            await session.run_sync(record, [favorite_event(user_id, item_type, item_id, "removed")])
+        if read_model_enabled() and result.rowcount:
+            await session.run_sync(refresh_user, user_id)
+        await session.commit()
+        if result.rowcount == 0:
+            return HTMLResponse(labels["not_found"].format(item_id, data["email"]), 400)
+        return HTMLResponse("Favorito eliminado exitosamente", 200)
+
+
+PLANET_LABELS = {
+    "missing": "El id de planeta {{ {} }} no se encontró",
+    "duplicate": "El Planeta: {} , ya es favorito del usuario: {}",
+    "added": "Planeta agregado como favorito al usuario: ",
+    "not_found": "El Planeta: {} , no fue encontrado para el usuario: {}",
+}
+
+PEOPLE_LABELS = {
+    "missing": "El id del caracter {{ {} }} no se encontró",
+    "duplicate": "People: {} , ya es favorito del usuario: {}",
+    "added": "People agregado como favorito al usuario: ",
+    "not_found": "People: {} , no fue encontrado para el usuario: {}",
+}
+
+
+async def manage_favorite_planet(request):
+    return await _manage_favorite(request, "planets", request.path_params["planet_id"], PLANET_LABELS)
+
+
+async def manage_favorite_people(request):
+    return await _manage_favorite(request, "people", request.path_params["people_id"], PEOPLE_LABELS)
+
+
+async def batch_favorites(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    check_rate_limit(data.get("email") if isinstance(data, dict) else None, _client_host(request))
+    email, add, remove = parse_batch(data)
+
+    async with Session() as session:
+        user_id = await _user_id(session, email)
+        if user_id is None:
+            raise APIException("El email enviado no fue encontrado", status_code=400)
+
+        valid = {}
+        for item_type, ids in requested_ids(add, remove).items():
+            valid[item_type] = set((await session.execute(existing_ids_statement(item_type, ids))).scalars()) if ids else set()
+        statement = user_favorites_statement(user_id, valid)
+        favorites = favorites_by_item(await session.execute(statement)) if statement is not None else {}
+
+        results, to_insert, to_delete = plan_batch(user_id, add, remove, valid, favorites)
+        try:
+            if to_insert:
+                await session.execute(insert(Favorite), to_insert)
+            if to_delete:
+                await session.execute(delete(Favorite).where(Favorite.id_fav.in_(to_delete)))
+            await session.run_sync(apply_deltas, batch_deltas(results))
+            await session.run_sync(record, batch_events(user_id, results))
+            if read_model_enabled() and (to_insert or to_delete):
+                await session.run_sync(refresh_user, user_id)
+            await session.commit()
+        except IntegrityError:
+            await session.rollback()
+            raise APIException(CONFLICT_MESSAGE, status_code=409)
+
+    return json_response({"user_id": user_id, "results": results})
+
+
+async def changes(request):
+    """Server-Sent Events of the favorite and catalog changes, see changefeed.py."""
+    if not change_feed_enabled():
+        return json_response({"msg": "Change feed disabled (CHANGE_FEED_ENABLED=1)"}, 404)
+    types, user_id = parse_filters(request.query_params)
+    check_capacity()
+    after, reset = change_feed.resume_point(
+        request.headers.get("last-event-id") or request.query_params.get("last_event_id"))
+    # X-Accel-Buffering: que nginx no acumule el stream
+    return StreamingResponse(stream_events(after, reset, types, user_id), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+async def handle_api_exception(request, error):
+    return json_response(error.to_dict(), error.status_code, error.headers)
+
+
+routes = [
+    Route("/people", get_all_people, methods=["GET"]),
+    Route("/people/{people_id:int}", get_people_by_id, methods=["GET"]),
+    Route("/planets", get_planets, methods=["GET"]),
+    Route("/planets/{planet_id:int}", get_planet_id, methods=["GET"]),
+    Route("/users", get_users, methods=["GET"]),
+    Route("/users/favorites/{user_id:int}", get_users_favorites, methods=["GET"]),
+    Route("/favorite/planet/{planet_id:int}", manage_favorite_planet, methods=["POST", "DELETE"]),
+    Route("/favorite/people/{people_id:int}", manage_favorite_people, methods=["POST", "DELETE"]),
+    Route("/favorites/batch", batch_favorites, methods=["POST"]),
+    Route("/changes", changes, methods=["GET"]),
+    # todo lo demas (sitemap, admin, metrics...) lo sigue sirviendo Flask
+    Mount("/", app=WSGIMiddleware(flask_app)),
+]
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # con CHANGE_FEED_BACKEND=postgres cada worker recibe los eventos de todos los procesos
+    listener = asyncio.create_task(listen()) if listen_enabled() else None
+    yield
+    if listener is not None:
+        listener.cancel()
+    await engine.dispose()
+    if read_engine is not None:
+        await read_engine.dispose()
+
+
+# Igual que CORS(app) en app.py, que por defecto permite cualquier origen
+middleware = [Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])]
+
+application = Starlette(routes=routes, middleware=middleware, lifespan=lifespan,
+                        exception_handlers={APIException: handle_api_exception})
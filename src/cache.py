@@ -0,0 +1,312 @@
+"""
+Read-through cache for the catalog endpoints (/planets, /people and their /<id> variants).
+
+Cached values are already serialized responses (body + status + headers), so a hit
+skips the database and serialize() entirely. Entries are invalidated by SQLAlchemy
+events on Planet / Character, which also covers the edits made from Flask-Admin
+because the ModelViews use the same db.session.
+
+Backends:
+    - LRUCache: in-process LRU with TTL (default).
+    - RedisCache: shared backend, needs the `redis` package and CACHE_REDIS_URL.
+    - LocalSharedCache: in-memory fake of a shared backend, useful for tests.
+
+With the in-process backend each gunicorn worker only sees its own invalidations, so
+edits made through another worker become visible after CACHE_TTL seconds. Use a shared
+backend when that is not acceptable.
+
+Settings (environment): CACHE_ENABLED (1/0), CACHE_BACKEND (memory, redis, local-shared),
+CACHE_TTL (seconds), CACHE_MAX_ENTRIES, CACHE_REDIS_URL.
+"""
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from functools import wraps
+
+from flask import current_app, request
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from conditional import add_validators
+from models import Planet, Character
+
+DEFAULT_TTL = 300
+DEFAULT_MAX_ENTRIES = 2048
+
+# Namespace de cache de cada modelo, coincide con la ruta de la API
+MODEL_NAMESPACES = {
+    Planet: "planets",
+    Character: "people",
+}
+
+
+# -----------------------------------Backends--------------------------------------------------
+
+class CacheBackend:
+    """Interface every backend implements. Values are opaque python objects."""
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def incr(self, key):
+        """Atomically increments an integer counter and returns the new value."""
+        raise NotImplementedError
+
+    def counter(self, key):
+        """Current value of a counter created with incr() (0 if it does not exist)."""
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class LRUCache(CacheBackend):
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        # los contadores van aparte para que el LRU nunca los expulse
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def incr(self, key):
+        with self._lock:
+            value = self._counters.get(key, 0) + 1
+            self._counters[key] = value
+            return value
+
+    def counter(self, key):
+        return self._counters.get(key, 0)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class LocalSharedCache(CacheBackend):
+    """
+    Fake of a shared (out of process) backend: values are pickled like they would be
+    on the wire, so tests catch anything that is not serializable.
+    """
+
+    def __init__(self):
+        self.store = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self.store.get(key)
+            if item is None:
+                return None
+            raw, expires = item
+            if expires is not None and expires < time.monotonic():
+                del self.store[key]
+                return None
+        return pickle.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self.store[key] = (pickle.dumps(value), expires)
+
+    def delete(self, key):
+        with self._lock:
+            self.store.pop(key, None)
+
+    def incr(self, key):
+        with self._lock:
+            raw, expires = self.store.get(key, (pickle.dumps(0), None))
+            value = pickle.loads(raw) + 1
+            self.store[key] = (pickle.dumps(value), None)
+            return value
+
+    def counter(self, key):
+        return self.get(key) or 0
+
+    def clear(self):
+        with self._lock:
+            self.store.clear()
+
+
+class RedisCache(CacheBackend):
+
+    def __init__(self, url, prefix="swapi:"):
+        import redis  # dependencia opcional, solo si se usa CACHE_BACKEND=redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        return None if raw is None else pickle.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=ttl or None)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def incr(self, key):
+        return int(self.client.incr(self.prefix + key))
+
+    def counter(self, key):
+        raw = self.client.get(self.prefix + key)
+        return int(raw) if raw is not None else 0
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + "*"):
+            self.client.delete(key)
+
+
+# -----------------------------------Response cache--------------------------------------------------
+
+class ResponseCache:
+
+    def __init__(self, backend=None, ttl=DEFAULT_TTL):
+        self.backend = backend or LRUCache(ttl=ttl)
+        self.ttl = ttl
+        self.enabled = True
+
+    def generation(self, namespace):
+        # Todas las claves de un namespace llevan su "generacion", invalidar es solo
+        # incrementar el contador (las entradas viejas se van por LRU/TTL). Asi un lector
+        # que termina despues de un commit nunca puede dejar datos viejos visibles.
+        return self.backend.counter("gen:" + namespace)
+
+    def key(self, namespace, item_id=None, query_string=""):
+        prefix = namespace + ":" + str(self.generation(namespace))
+        if item_id is not None:
+            return prefix + ":item:" + str(item_id)
+        return prefix + ":list?" + query_string
+
+    def get(self, key):
+        return self.backend.get(key) if self.enabled else None
+
+    def set(self, key, value):
+        if self.enabled:
+            self.backend.set(key, value, self.ttl)
+
+    def invalidate(self, namespace):
+        self.backend.incr("gen:" + namespace)
+
+    def clear(self):
+        self.backend.clear()
+
+
+response_cache = ResponseCache()
+
+
+def cached_response(namespace, id_arg=None):
+    """
+    Caches the 200 responses of a GET view. Streaming responses are never cached.
+    The key is the namespace plus the item id (id_arg) or the query string for lists.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            item_id = kwargs.get(id_arg) if id_arg else None
+            key = response_cache.key(namespace, item_id, request.query_string.decode())
+            entry = response_cache.get(key)
+            if entry is not None:
+                body, status, headers = entry
+                return current_app.response_class(body, status=status, headers=headers)
+
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                # validadores HTTP calculados una sola vez por entrada (ver conditional.py)
+                add_validators(response)
+                response.last_modified = datetime.now(timezone.utc)
+                headers = [(k, v) for k, v in response.headers.items() if k != "Content-Length"]
+                response_cache.set(key, (response.get_data(), response.status_code, headers))
+            return response
+        return wrapper
+    return decorator
+
+
+# -----------------------------------Invalidation--------------------------------------------------
+
+def _pending(session):
+    return session.info.setdefault("cache_invalidations", set())
+
+
+def _on_change(mapper, connection, target):
+    namespace = MODEL_NAMESPACES[mapper.class_]
+    # Invalidamos ya, y otra vez despues del commit para que un lector concurrente
+    # no guarde en cache lo que leyo entre el flush y el commit.
+    response_cache.invalidate(namespace)
+    session = object_session(target)
+    if session is not None:
+        _pending(session).add(namespace)
+
+
+def _after_commit(session):
+    for namespace in session.info.pop("cache_invalidations", ()):
+        response_cache.invalidate(namespace)
+
+
+def _after_rollback(session):
+    session.info.pop("cache_invalidations", None)
+
+
+def _register_events():
+    for model in MODEL_NAMESPACES:
+        for name in ("after_insert", "after_update", "after_delete"):
+            if not event.contains(model, name, _on_change):
+                event.listen(model, name, _on_change)
+    if not event.contains(Session, "after_commit", _after_commit):
+        event.listen(Session, "after_commit", _after_commit)
+        event.listen(Session, "after_rollback", _after_rollback)
+
+
+def make_backend(name):
+    if name == "redis":
+        return RedisCache(os.environ["CACHE_REDIS_URL"])
+    if name == "local-shared":
+        return LocalSharedCache()
+    return LRUCache(int(os.environ.get("CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)),
+                    int(os.environ.get("CACHE_TTL", DEFAULT_TTL)))
+
+
+def setup_cache(app):
+    response_cache.ttl = int(os.environ.get("CACHE_TTL", DEFAULT_TTL))
+    response_cache.backend = make_backend(os.environ.get("CACHE_BACKEND", "memory"))
+    response_cache.enabled = os.environ.get("CACHE_ENABLED", "1") != "0"
+    _register_events()
+    app.extensions["response_cache"] = response_cache
@@ -0,0 +1,478 @@
+"""
+Read-only snapshot of the planet and character catalogs in a memory-mapped file, shared
+by every worker process, that answers /planets/<id> and /people/<id> without the
+database or a per-worker cache.
+
+The file has, per catalog, the sorted ids (int64 array), the offsets of three strings per
+item (uint64 array: name, img_link and the JSON body of the /<id> response, the same
+bytes jsonify(serialize()) returns) and the strings themselves. A worker maps the file
+and reads it through memoryviews: a lookup is a binary search over the ids and a slice
+of the bodies, and the pages live once in the OS page cache for all the workers instead
+of a copy per process (benchmarks/snapshot_bench.py measures RSS / PSS per worker).
+
+Generations: every build writes a new file (catalog-<hash of DATABASE_URL>-<generation>.bin,
+written to a temporary name and renamed) and then replaces the pointer file
+catalog-<hash>.current, both with os.replace(), so a reader sees the old generation or the
+new one, never a partial file. Workers stat the pointer at most every
+CATALOG_SNAPSHOT_CHECK_INTERVAL seconds (1) and swap their mapping when it changed; the
+old mapping stays valid until its last reader drops it. Builds take a file lock, so
+the processes write one generation at a time, each from a read made after the
+previous one.
+
+A new generation is built (in a background thread of the worker):
+    - after a commit that inserts, updates or deletes a Planet / Character (the ORM,
+      Flask-Admin). Until it is mapped the worker that made the change answers those
+      routes from the database; the others see the change within the build time plus
+      the check interval.
+    - at the end of `flask catalog import`
+    - when the current one is older than CATALOG_SNAPSHOT_MAX_AGE seconds (300), which
+      bounds how long writes made outside the app stay invisible
+    - on the first request of a worker when there is no file yet.
+
+Ids that are not in the snapshot fall through to the database (an item created since the
+last generation is still found). Off unless CATALOG_SNAPSHOT_ENABLED=1; the files go to
+CATALOG_SNAPSHOT_DIR (the system temp directory / swapi-catalog).
+"""
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from functools import wraps
+
+from flask import current_app
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session, object_session
+
+from database import database_url
+from models import db, Planet, Character
+from serializers import PLANET, CHARACTER
+
+try:
+    import fcntl  # flock entre procesos: solo POSIX, en Windows el snapshot queda apagado
+except ImportError:
+    fcntl = None
+
+MAGIC = b"SWCAT001"
+DEFAULT_CHECK_INTERVAL = 1
+DEFAULT_MAX_AGE = 300
+BUILD_CHUNK_SIZE = 10000
+
+# tipo (igual que la ruta de la API) -> (modelo, primary key, proyeccion de /<id>)
+CATALOGS = {
+    "planets": (Planet, Planet.id_planet, PLANET),
+    "people": (Character, Character.id_character, CHARACTER),
+}
+MODEL_CATALOGS = {Planet: "planets", Character: "people"}
+
+# magic, generacion, built_at (time.time()), cantidad de catalogos
+HEADER = struct.Struct("<8sQdI4x")
+# nombre, cantidad de items, offset de los ids, de los offsets y de los strings, tamaño de los strings
+DIRECTORY_ENTRY = struct.Struct("<16sQQQQQ")
+
+# campos por item en la tabla de offsets
+FIELDS = ("name", "img_link", "body")
+
+_settings = {"enabled": False, "directory": None, "check_interval": DEFAULT_CHECK_INTERVAL,
+             "max_age": DEFAULT_MAX_AGE}
+
+_stats = {"builds": 0, "swaps": 0, "hits": 0, "misses": 0}
+
+
+def catalog_snapshot_enabled():
+    return _settings["enabled"]
+
+
+def _prefix():
+    return "catalog-" + hashlib.sha1(database_url().encode()).hexdigest()[:10]
+
+
+def _path(name):
+    return os.path.join(_settings["directory"], name)
+
+
+# -----------------------------------File format--------------------------------------------------
+
+def _align(size):
+    return (size + 7) & ~7
+
+
+def write_snapshot(path, catalogs, generation, built_at):
+    """
+    catalogs: {name: (array('q') of sorted ids, array('Q') of offsets, bytes of strings)}.
+    built_at: time.time() before reading the catalogs. Writes to a temporary file next
+    to path and renames it.
+    """
+    position = HEADER.size + DIRECTORY_ENTRY.size * len(catalogs)
+    entries = []
+    sections = []
+    for name, (ids, offsets, strings) in catalogs.items():
+        position = _align(position)
+        ids_offset = position
+        position = _align(position + len(ids) * ids.itemsize)
+        offsets_offset = position
+        position = _align(position + len(offsets) * offsets.itemsize)
+        strings_offset = position
+        position += len(strings)
+        entries.append(DIRECTORY_ENTRY.pack(name.encode(), len(ids), ids_offset, offsets_offset,
+                                            strings_offset, len(strings)))
+        sections += [(ids_offset, ids.tobytes()), (offsets_offset, offsets.tobytes()), (strings_offset, strings)]
+
+    temporary = path + ".tmp-" + str(os.getpid())
+    with open(temporary, "wb") as stream:
+        stream.write(HEADER.pack(MAGIC, generation, built_at, len(catalogs)))
+        stream.write(b"".join(entries))
+        for offset, data in sections:
+            stream.write(b"\0" * (offset - stream.tell()))
+            stream.write(data)
+        stream.flush()
+        os.fsync(stream.fileno())
+    os.replace(temporary, path)
+
+
+class CatalogView:
+    """One catalog of a mapped snapshot. Every read is a slice of the mapping, nothing is copied."""
+
+    __slots__ = ("ids", "offsets", "strings", "count")
+
+    def __init__(self, view, count, ids_offset, offsets_offset, strings_offset, strings_size):
+        self.count = count
+        self.ids = view[ids_offset:ids_offset + 8 * count].cast("q")
+        self.offsets = view[offsets_offset:offsets_offset + 8 * (len(FIELDS) * count + 1)].cast("Q")
+        self.strings = view[strings_offset:strings_offset + strings_size]
+
+    def position(self, item_id):
+        """Index of item_id, None if it is not in the snapshot."""
+        index = bisect_left(self.ids, item_id)
+        if index < self.count and self.ids[index] == item_id:
+            return index
+        return None
+
+    def field(self, index, field):
+        start = len(FIELDS) * index + FIELDS.index(field)
+        return self.strings[self.offsets[start]:self.offsets[start + 1]]
+
+    def body(self, index):
+        return self.field(index, "body")
+
+
+class MappedSnapshot:
+
+    __slots__ = ("path", "generation", "built_at", "size", "catalogs", "_mapping", "_view")
+
+    def __init__(self, path):
+        with open(path, "rb") as stream:
+            self._mapping = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mapping)
+        magic, self.generation, self.built_at, count = HEADER.unpack_from(self._view, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a catalog snapshot: " + path)
+        self.path = path
+        self.size = len(self._mapping)
+        self.catalogs = {}
+        for number in range(count):
+            name, *layout = DIRECTORY_ENTRY.unpack_from(self._view, HEADER.size + number * DIRECTORY_ENTRY.size)
+            self.catalogs[name.rstrip(b"\0").decode()] = CatalogView(self._view, *layout)
+
+    def body(self, catalog, item_id):
+        view = self.catalogs[catalog]
+        index = view.position(item_id)
+        return None if index is None else view.body(index)
+
+
+# -----------------------------------Build--------------------------------------------------
+
+def build_catalog(connection, catalog):
+    """(ids, offsets, strings) of one catalog, read in id order."""
+    model, pk_column, projection = CATALOGS[catalog]
+    ids = array("q")
+    offsets = array("Q", [0])
+    strings = bytearray()
+    rows = connection.execute(select(pk_column, model.name, model.img_link).order_by(pk_column)
+                              .execution_options(yield_per=BUILD_CHUNK_SIZE))
+    for partition in rows.partitions():
+        for item_id, name, img_link in partition:
+            ids.append(item_id)
+            for value in (name.encode(), (img_link or "").encode(),
+                          (projection.encode_row((item_id, name)) + "\n").encode()):
+                strings += value
+                offsets.append(len(strings))
+    return ids, offsets, bytes(strings)
+
+
+def read_header(path):
+    """(generation, built_at) of a snapshot file."""
+    with open(path, "rb") as stream:
+        magic, generation, built_at, count = HEADER.unpack(stream.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError("Not a catalog snapshot: " + path)
+    return generation, built_at
+
+
+def _read_pointer():
+    try:
+        with open(_path(_prefix() + ".current")) as stream:
+            return stream.read().strip() or None
+    except OSError:
+        return None
+
+
+def _remove_old_generations(keep):
+    prefix = _prefix() + "-"
+    for name in os.listdir(_settings["directory"]):
+        if name.startswith(prefix) and name.endswith(".bin") and name not in keep:
+            try:
+                # los workers que todavia la tienen mapeada la siguen leyendo
+                os.remove(_path(name))
+            except OSError:
+                pass
+
+
+def build_generation(newer_than=None):
+    """
+    Builds and publishes a new generation. With newer_than (time.time()), does nothing if
+    the published one was read after that moment (another process built it meanwhile).
+    Returns the path of the file.
+    """
+    os.makedirs(_settings["directory"], exist_ok=True)
+    with open(_path(_prefix() + ".lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            previous = _read_pointer()
+            if newer_than is not None and previous is not None:
+                try:
+                    if read_header(_path(previous))[1] > newer_than:
+                        return _path(previous)
+                except (OSError, ValueError):
+                    pass
+
+            built_at = time.time()
+            generation = time.time_ns()
+            name = _prefix() + "-" + str(generation) + ".bin"
+            with db.engine.connect() as connection:
+                catalogs = {catalog: build_catalog(connection, catalog) for catalog in CATALOGS}
+            write_snapshot(_path(name), catalogs, generation, built_at)
+
+            pointer = _path(_prefix() + ".current")
+            with open(pointer + ".tmp", "w") as stream:
+                stream.write(name)
+            os.replace(pointer + ".tmp", pointer)
+            _stats["builds"] += 1
+            _remove_old_generations({name, previous})
+            return _path(name)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+# -----------------------------------Worker state--------------------------------------------------
+
+class SnapshotReader:
+    """The generation mapped by this worker, swapped when the pointer file changes."""
+
+    def __init__(self):
+        self.app = None
+        self.current = None
+        self.dirty_since = None
+        self._pointer_stat = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+        self._builder_lock = threading.Lock()
+        self._rebuild = threading.Event()
+        self._wanted = 0
+        self._thread = None
+        self._pid = None
+
+    def _check(self):
+        try:
+            stat = os.stat(_path(_prefix() + ".current"))
+        except OSError:
+            stat = None
+        key = None if stat is None else (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if key != self._pointer_stat:
+            name = _read_pointer()
+            if name is not None:
+                try:
+                    # una sola asignacion: los requests en curso siguen con la generacion anterior
+                    self.current = MappedSnapshot(_path(name))
+                    _stats["swaps"] += 1
+                except (OSError, ValueError):
+                    return
+            self._pointer_stat = key
+
+        current = self.current
+        if current is None:
+            self.request_rebuild(0)
+        elif time.time() - current.built_at > _settings["max_age"]:
+            # cualquier generacion posterior a la que tenemos sirve
+            self.request_rebuild(current.built_at)
+        if current is not None and self.dirty_since is not None and current.built_at > self.dirty_since:
+            self.dirty_since = None
+
+    def snapshot(self):
+        """The mapped generation, None while there is none or this worker changed the catalog after it."""
+        now = time.monotonic()
+        if now - self._checked_at >= _settings["check_interval"]:
+            # un solo thread hace el stat, los demas usan lo que hay
+            if self._lock.acquire(blocking=False):
+                try:
+                    self._checked_at = now
+                    self._check()
+                finally:
+                    self._lock.release()
+        if self.dirty_since is not None:
+            return None
+        return self.current
+
+    def request_rebuild(self, newer_than):
+        """Asks the builder thread for a generation read after newer_than (time.time())."""
+        self._wanted = max(self._wanted, newer_than)
+        self._ensure_builder()
+        self._rebuild.set()
+
+    def _ensure_builder(self):
+        # un thread por proceso, no sobrevive al fork de gunicorn
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._builder_lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="catalog-snapshot", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._rebuild.wait()
+            self._rebuild.clear()
+            try:
+                with self.app.app_context():
+                    build_generation(newer_than=self._wanted)
+                # que el proximo request mapee la generacion nueva
+                self._checked_at = 0
+            except Exception:
+                self.app.logger.exception("catalog snapshot build failed")
+                time.sleep(_settings["check_interval"])
+
+reader = SnapshotReader()
+
+
+# -----------------------------------Serving--------------------------------------------------
+
+def snapshot_body(catalog, item_id):
+    """Response body of /<catalog>/<item_id> from the snapshot, None when it has to go to the database."""
+    if not _settings["enabled"]:
+        return None
+    snapshot = reader.snapshot()
+    if snapshot is None:
+        return None
+    body = snapshot.body(catalog, item_id)
+    if body is None:
+        _stats["misses"] += 1
+        return None
+    _stats["hits"] += 1
+    return bytes(body)
+
+
+def snapshot_response(catalog, id_arg):
+    """Serves the view from the snapshot when it has the item (put it above @cached_response)."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            body = snapshot_body(catalog, kwargs[id_arg])
+            if body is None:
+                return view(*args, **kwargs)
+            return current_app.response_class(body, mimetype="application/json")
+        return wrapper
+    return decorator
+
+
+# -----------------------------------Invalidation and metrics--------------------------------------------------
+
+def _on_change(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info["catalog_snapshot_changed"] = True
+
+
+def _after_commit(session):
+    if session.info.pop("catalog_snapshot_changed", False):
+        # hasta que se mapee una generacion posterior este worker responde desde la base
+        reader.dirty_since = time.time()
+        reader.request_rebuild(reader.dirty_since)
+
+
+def _after_rollback(session):
+    session.info.pop("catalog_snapshot_changed", None)
+
+
+def process_memory_kb():
+    """{"rss", "pss", "shared", "private"} of this process in KB (Linux, /proc/self/smaps_rollup)."""
+    fields = {"Rss:": "rss", "Pss:": "pss", "Shared_Clean:": "shared", "Shared_Dirty:": "shared",
+              "Private_Clean:": "private", "Private_Dirty:": "private"}
+    memory = {}
+    try:
+        with open("/proc/self/smaps_rollup") as stream:
+            for line in stream:
+                parts = line.split()
+                if parts and parts[0] in fields:
+                    key = fields[parts[0]]
+                    memory[key] = memory.get(key, 0) + int(parts[1])
+    except OSError:
+        pass
+    return memory
+
+
+def _collector():
+    current = reader.current
+    lines = [
+        "# HELP catalog_snapshot_generation Generation (build time in ns) of the catalog snapshot mapped by this worker",
+        "# TYPE catalog_snapshot_generation gauge",
+        "catalog_snapshot_generation " + str(current.generation if current is not None else 0),
+        "# HELP catalog_snapshot_bytes Size of the mapped catalog snapshot",
+        "# TYPE catalog_snapshot_bytes gauge",
+        "catalog_snapshot_bytes " + str(current.size if current is not None else 0),
+    ]
+    for name, help_text in (("builds", "Catalog snapshot generations built by this worker"),
+                            ("swaps", "Catalog snapshot generations mapped by this worker"),
+                            ("hits", "Item requests answered from the catalog snapshot"),
+                            ("misses", "Item requests not found in the catalog snapshot")):
+        lines.append("# HELP catalog_snapshot_" + name + "_total " + help_text)
+        lines.append("# TYPE catalog_snapshot_" + name + "_total counter")
+        lines.append("catalog_snapshot_" + name + "_total " + str(_stats[name]))
+
+    memory = process_memory_kb()
+    if memory:
+        lines.append("# HELP process_memory_kb Memory of the worker process (Rss, Pss, shared and private pages)")
+        lines.append("# TYPE process_memory_kb gauge")
+        for key in sorted(memory):
+            lines.append('process_memory_kb{kind="' + key + '"} ' + str(memory[key]))
+    return lines
+
+
+def setup_catalog_snapshot(app):
+    _settings["enabled"] = os.environ.get("CATALOG_SNAPSHOT_ENABLED", "0") == "1"
+    if _settings["enabled"] and fcntl is None:
+        app.logger.warning("CATALOG_SNAPSHOT_ENABLED=1 needs fcntl (POSIX), the catalog snapshot stays off")
+        _settings["enabled"] = False
+    if not _settings["enabled"]:
+        return
+    _settings["directory"] = os.environ.get("CATALOG_SNAPSHOT_DIR",
+                                            os.path.join(tempfile.gettempdir(), "swapi-catalog"))
+    _settings["check_interval"] = float(os.environ.get("CATALOG_SNAPSHOT_CHECK_INTERVAL", DEFAULT_CHECK_INTERVAL))
+    _settings["max_age"] = float(os.environ.get("CATALOG_SNAPSHOT_MAX_AGE", DEFAULT_MAX_AGE))
+    reader.app = app
+
+    for model in MODEL_CATALOGS:
+        for name in ("after_insert", "after_update", "after_delete"):
+            if not event.contains(model, name, _on_change):
+                event.listen(model, name, _on_change)
+    if not event.contains(Session, "after_commit", _after_commit):
+        event.listen(Session, "after_commit", _after_commit)
+        event.listen(Session, "after_rollback", _after_rollback)
+
+    if "metrics" in app.extensions:
+        app.extensions["metrics"].register_collector(_collector)
+    app.extensions["catalog_snapshot"] = reader
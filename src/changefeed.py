@@ -0,0 +1,424 @@
+"""
+Server-Sent Events feed of the favorite and catalog changes, so clients stop polling
+/users/favorites/<id>, /planets and /people to find out whether something changed.
+
+    GET /changes                               every event from now on
+    GET /changes?types=favorites&user_id=7     only the favorites of user 7
+    GET /changes?types=planets,people
+
+Events (the "data:" line is JSON, the SSE "event:" field is its type):
+
+    favorites  {"seq", "type", "action": "added" | "removed", "user_id", "item_type", "item_id"}
+    planets    {"seq", "type", "action": "created" | "updated" | "deleted", "id", "item"}
+    people     same as planets; action "imported" (no id) after `flask catalog import`
+    reset      the feed cannot resume from the client's position: fetch the lists again
+
+They are recorded by the favorite writes (favorites.py, writebehind.py, asgi.py), by ORM
+events on Planet / Character / Favorite (Flask-Admin) and by the catalog import, and
+published only when their transaction commits. Every event gets the next sequence
+number of the process and goes into a ring buffer of CHANGE_FEED_BUFFER events (10000).
+The SSE id is "<process epoch>-<seq>": a client that reconnects with Last-Event-ID (or
+?last_event_id=) gets what it missed from the buffer, and a "reset" event when its id
+is from another process or already left the buffer.
+
+The endpoint is served by the ASGI entry point (asgi.py) only: a subscriber is a
+coroutine waiting on one asyncio.Event shared by all the subscribers of the event loop,
+so thousands of idle connections cost a few KB each and no thread. A comment line is
+sent every CHANGE_FEED_HEARTBEAT seconds (15) to keep proxies from closing the stream.
+Beyond CHANGE_FEED_MAX_SUBSCRIBERS (10000) per process it answers 503.
+
+Backends (CHANGE_FEED_BACKEND):
+
+    - memory: events reach the subscribers of the process that committed them. Enough
+      with a single ASGI worker, the Flask routes and Flask-Admin run in that process.
+    - postgres (auto with PostgreSQL): the events are sent with pg_notify() in the
+      writing transaction (delivered at commit, in commit order) and every ASGI worker
+      LISTENs on one connection, so all workers see the writes of every process,
+      including sync gunicorn workers. PostgreSQL serializes the commits of the
+      transactions that NOTIFY, keep it in mind for write heavy loads (the group commit
+      of writebehind.py sends one NOTIFY per batch).
+
+Off unless CHANGE_FEED_ENABLED=1.
+"""
+import asyncio
+import json
+import os
+import threading
+import uuid
+from collections import deque
+
+from sqlalchemy import event, inspect, text
+from sqlalchemy.orm import Session
+
+from database import database_url
+from models import Planet, Character, Favorite
+from utils import APIException
+
+DEFAULT_BUFFER = 10000
+DEFAULT_HEARTBEAT = 15
+DEFAULT_MAX_SUBSCRIBERS = 10000
+
+CHANNEL = "swapi_changes"
+# NOTIFY acepta hasta 8000 bytes por mensaje
+MAX_NOTIFY_BYTES = 7500
+
+EVENT_TYPES = ("favorites", "planets", "people")
+
+# modelo -> (tipo de evento, nombre del atributo id)
+CATALOG_MODELS = {
+    Planet: ("planets", "id_planet"),
+    Character: ("people", "id_character"),
+}
+
+_settings = {"enabled": False, "backend": "memory", "heartbeat": DEFAULT_HEARTBEAT,
+             "max_subscribers": DEFAULT_MAX_SUBSCRIBERS}
+
+
+def change_feed_enabled():
+    return _settings["enabled"]
+
+
+def favorite_event(user_id, item_type, item_id, action):
+    return {"type": "favorites", "action": action, "user_id": user_id, "item_type": item_type, "item_id": item_id}
+
+
+# -----------------------------------Feed (ring buffer)--------------------------------------------------
+
+class ChangeFeed:
+
+    def __init__(self, size=DEFAULT_BUFFER):
+        self.epoch = uuid.uuid4().hex[:8]
+        self.subscribers = 0
+        self.published = 0
+        self._events = deque(maxlen=size)
+        self._seq = 0
+        self._lock = threading.Lock()
+        # un asyncio.Event por event loop, compartido por todos sus suscriptores
+        self._waiters = {}
+
+    def resize(self, size):
+        with self._lock:
+            self._events = deque(self._events, maxlen=size)
+
+    @property
+    def last_seq(self):
+        return self._seq
+
+    def event_id(self, seq):
+        return self.epoch + "-" + str(seq)
+
+    def publish(self, events):
+        """Numbers and buffers the events, then wakes the subscribers. Safe from any thread."""
+        if not events:
+            return
+        with self._lock:
+            for data in events:
+                self._seq += 1
+                data = dict(data, seq=self._seq)
+                self._events.append((self._seq, data["type"], data.get("user_id"),
+                                     json.dumps(data, sort_keys=True, separators=(",", ":"))))
+            self.published += len(events)
+            loops = list(self._waiters)
+        for loop in loops:
+            try:
+                loop.call_soon_threadsafe(self._wake, loop)
+            except RuntimeError:
+                # el loop ya se cerro
+                with self._lock:
+                    self._waiters.pop(loop, None)
+
+    def _wake(self, loop):
+        with self._lock:
+            waiter = self._waiters.pop(loop, None)
+        if waiter is not None:
+            waiter.set()
+
+    def resume_point(self, last_event_id):
+        """Sequence to continue after and whether the client must get a "reset" first."""
+        if not last_event_id:
+            return self._seq, False
+        epoch, _, seq = last_event_id.rpartition("-")
+        if epoch != self.epoch or not seq.isdigit() or int(seq) > self._seq:
+            return self._seq, True
+        return int(seq), False
+
+    def since(self, after):
+        """(events after `after` as (seq, type, user_id, json), True if some were already dropped)."""
+        found = []
+        with self._lock:
+            # los nuevos estan al final, recorremos solo esos
+            for item in reversed(self._events):
+                if item[0] <= after:
+                    break
+                found.append(item)
+            gap = bool(found) and found[-1][0] > after + 1
+        found.reverse()
+        return found, gap
+
+    async def wait(self, after, timeout):
+        """Returns when there is an event after `after` or after timeout seconds."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._seq > after:
+                return
+            waiter = self._waiters.get(loop)
+            if waiter is None:
+                waiter = self._waiters[loop] = asyncio.Event()
+        try:
+            await asyncio.wait_for(waiter.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def clear(self):
+        with self._lock:
+            self._events.clear()
+
+
+change_feed = ChangeFeed()
+
+
+# -----------------------------------Recording (writers)--------------------------------------------------
+
+def _notify(connection, events):
+    """pg_notify() of the events in chunks under the payload limit, part of the current transaction."""
+    chunk, size = [], 0
+    for data in events:
+        encoded = json.dumps(data, separators=(",", ":"))
+        if chunk and size + len(encoded) > MAX_NOTIFY_BYTES:
+            connection.execute(text("SELECT pg_notify(:channel, :payload)"),
+                               {"channel": CHANNEL, "payload": "[" + ",".join(chunk) + "]"})
+            chunk, size = [], 0
+        chunk.append(encoded)
+        size += len(encoded) + 1
+    if chunk:
+        connection.execute(text("SELECT pg_notify(:channel, :payload)"),
+                           {"channel": CHANNEL, "payload": "[" + ",".join(chunk) + "]"})
+
+
+def record(session, events):
+    """Queues events in the session's transaction: published when it commits, dropped on rollback."""
+    if not _settings["enabled"] or not events:
+        return
+    if _settings["backend"] == "postgres":
+        _notify(session.connection(), events)
+    else:
+        session.info.setdefault("change_feed", []).extend(events)
+
+
+def _after_commit(session):
+    events = session.info.pop("change_feed", None)
+    if events:
+        change_feed.publish(events)
+
+
+def _after_rollback(session):
+    session.info.pop("change_feed", None)
+
+
+# Las escrituras de la API usan INSERT / DELETE de Core y llaman a record() directamente;
+# estos eventos cubren lo que pasa por el ORM (Flask-Admin).
+
+def _record_orm(connection, target, events):
+    if _settings["backend"] == "postgres":
+        _notify(connection, events)
+    else:
+        Session.object_session(target).info.setdefault("change_feed", []).extend(events)
+
+
+def _catalog_event(target, action):
+    event_type, id_attribute = CATALOG_MODELS[type(target)]
+    data = {"type": event_type, "action": action, "id": getattr(target, id_attribute)}
+    if action != "deleted":
+        data["item"] = target.serialize()
+    return data
+
+
+def _catalog_inserted(mapper, connection, target):
+    _record_orm(connection, target, [_catalog_event(target, "created")])
+
+
+def _catalog_updated(mapper, connection, target):
+    # Flask-Admin guarda aunque no se haya cambiado nada
+    if not Session.object_session(target).is_modified(target, include_collections=False):
+        return
+    _record_orm(connection, target, [_catalog_event(target, "updated")])
+
+
+def _catalog_deleted(mapper, connection, target):
+    _record_orm(connection, target, [_catalog_event(target, "deleted")])
+
+
+def _favorite_items(planet_id, character_id):
+    items = []
+    if planet_id is not None:
+        items.append(("planets", planet_id))
+    if character_id is not None:
+        items.append(("people", character_id))
+    return items
+
+
+def _favorite_inserted(mapper, connection, target):
+    _record_orm(connection, target, [favorite_event(target.user_id, item_type, item_id, "added")
+                                     for item_type, item_id in _favorite_items(target.planet_id, target.character_id)])
+
+
+def _favorite_deleted(mapper, connection, target):
+    _record_orm(connection, target, [favorite_event(target.user_id, item_type, item_id, "removed")
+                                     for item_type, item_id in _favorite_items(target.planet_id, target.character_id)])
+
+
+def _favorite_updated(mapper, connection, target):
+    state = inspect(target)
+
+    def previous(attribute):
+        history = state.attrs[attribute].history
+        return history.deleted[0] if history.deleted else getattr(target, attribute)
+
+    before = (previous("user_id"), previous("planet_id"), previous("character_id"))
+    after = (target.user_id, target.planet_id, target.character_id)
+    if before == after:
+        return
+    events = [favorite_event(before[0], item_type, item_id, "removed") for item_type, item_id in _favorite_items(*before[1:])]
+    events += [favorite_event(after[0], item_type, item_id, "added") for item_type, item_id in _favorite_items(*after[1:])]
+    _record_orm(connection, target, events)
+
+
+# -----------------------------------PostgreSQL LISTEN (ASGI workers)--------------------------------------------------
+
+def listen_enabled():
+    return _settings["enabled"] and _settings["backend"] == "postgres"
+
+
+async def listen():
+    """
+    Receives the events of every process through LISTEN and publishes them in this one.
+    Runs for the life of the ASGI worker, reconnecting with backoff.
+    """
+    import asyncpg  # driver async de PostgreSQL, ya es dependencia de asgi.py
+    url = "postgresql://" + database_url().split("://", 1)[1]
+
+    def on_notification(connection, pid, channel, payload):
+        change_feed.publish(json.loads(payload))
+
+    delay = 1
+    while True:
+        try:
+            connection = await asyncpg.connect(url)
+        except (OSError, asyncpg.PostgresError):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+            continue
+        delay = 1
+        try:
+            await connection.add_listener(CHANNEL, on_notification)
+            # mientras estuvimos desconectados se pudieron perder eventos
+            change_feed.publish([{"type": "reset"}])
+            while not connection.is_closed():
+                await asyncio.sleep(DEFAULT_HEARTBEAT)
+                await connection.execute("SELECT 1")
+        except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError):
+            pass
+        finally:
+            if not connection.is_closed():
+                await connection.close(timeout=5)
+
+
+# -----------------------------------Endpoint (ASGI)--------------------------------------------------
+
+def parse_filters(params):
+    """(event types, user_id or None) from the query string of /changes."""
+    types = params.get("types")
+    if types:
+        types = tuple(name.strip() for name in types.split(","))
+        for name in types:
+            if name not in EVENT_TYPES:
+                raise APIException("'types' must be a list of: " + ", ".join(EVENT_TYPES), status_code=400)
+    else:
+        types = EVENT_TYPES
+
+    user_id = params.get("user_id")
+    if user_id is not None:
+        if not user_id.isdigit():
+            raise APIException("'user_id' must be an integer", status_code=400)
+        user_id = int(user_id)
+    return types, user_id
+
+
+def _frame(seq, event_type, data):
+    return "id: " + change_feed.event_id(seq) + "\nevent: " + event_type + "\ndata: " + data + "\n\n"
+
+
+async def stream_events(after, reset, types, user_id):
+    """Body of a /changes response, one subscriber. Ends when the client disconnects."""
+    change_feed.subscribers += 1
+    try:
+        yield "retry: 3000\n\n"
+        if reset:
+            yield _frame(after, "reset", json.dumps({"seq": after, "type": "reset"}))
+        while True:
+            events, gap = change_feed.since(after)
+            if gap:
+                yield _frame(events[0][0] - 1, "reset", json.dumps({"seq": events[0][0] - 1, "type": "reset"}))
+            frames = []
+            for seq, event_type, event_user_id, data in events:
+                # los "reset" del LISTEN van a todos
+                if event_type == "reset" or (event_type in types and
+                                             (user_id is None or event_type != "favorites" or event_user_id == user_id)):
+                    frames.append(_frame(seq, event_type, data))
+            if events:
+                after = events[-1][0]
+            if frames:
+                yield "".join(frames)
+            else:
+                # heartbeat: mantiene viva la conexion en los proxies
+                yield ": ping\n\n"
+            await change_feed.wait(after, _settings["heartbeat"])
+    finally:
+        change_feed.subscribers -= 1
+
+
+def check_capacity():
+    if change_feed.subscribers >= _settings["max_subscribers"]:
+        raise APIException("Demasiados suscriptores, intente de nuevo mas tarde", status_code=503,
+                           payload={"retry_after": 30}, headers={"Retry-After": "30"})
+
+
+# -----------------------------------Setup--------------------------------------------------
+
+def _collector():
+    return [
+        "# HELP change_feed_subscribers Open /changes streams in this process",
+        "# TYPE change_feed_subscribers gauge",
+        "change_feed_subscribers " + str(change_feed.subscribers),
+        "# HELP change_feed_events_total Events published to the change feed of this process",
+        "# TYPE change_feed_events_total counter",
+        "change_feed_events_total " + str(change_feed.published),
+    ]
+
+
+def setup_change_feed(app):
+    _settings["enabled"] = os.environ.get("CHANGE_FEED_ENABLED", "0") == "1"
+    if not _settings["enabled"]:
+        return
+
+    backend = os.environ.get("CHANGE_FEED_BACKEND", "auto")
+    if backend == "auto":
+        backend = "postgres" if database_url().startswith("postgresql") else "memory"
+    _settings["backend"] = backend
+    _settings["heartbeat"] = float(os.environ.get("CHANGE_FEED_HEARTBEAT", DEFAULT_HEARTBEAT))
+    _settings["max_subscribers"] = int(os.environ.get("CHANGE_FEED_MAX_SUBSCRIBERS", DEFAULT_MAX_SUBSCRIBERS))
+    change_feed.resize(int(os.environ.get("CHANGE_FEED_BUFFER", DEFAULT_BUFFER)))
+
+    listeners = [(model, name, listener) for model in CATALOG_MODELS
+                 for name, listener in (("after_insert", _catalog_inserted), ("after_update", _catalog_updated),
+                                        ("after_delete", _catalog_deleted))]
+    listeners += [(Favorite, "after_insert", _favorite_inserted), (Favorite, "after_delete", _favorite_deleted),
+                  (Favorite, "after_update", _favorite_updated),
+                  (Session, "after_commit", _after_commit), (Session, "after_rollback", _after_rollback)]
+    for target, name, listener in listeners:
+        if not event.contains(target, name, listener):
+            event.listen(target, name, listener)
+
+    if "metrics" in app.extensions:
+        app.extensions["metrics"].register_collector(_collector)
+    app.extensions["change_feed"] = change_feed
@@ -0,0 +1,245 @@
+"""
+Custom `flask` CLI commands, registered next to the `flask db` ones from Flask-Migrate.
+
+    flask catalog import planets planets.ndjson
+    flask catalog import people people.csv --batch-size 10000
+    flask catalog export planets planets.ndjson
+    flask catalog export people - --format csv      (stdout)
+    flask favorites rebuild                         (read model, see readmodel.py)
+    flask favorites check --repair
+    flask favorites recount [--check]               (favorite counters, see popularity.py)
+
+Files are read and written as streams, rows go to the database in chunks of
+--batch-size (one multi-row INSERT ... ON CONFLICT (name) DO UPDATE per chunk), so
+memory stays constant whatever the size of the file.
+"""
+import csv
+import json
+import sys
+import time
+from itertools import islice
+
+import click
+from sqlalchemy import select
+
+from cache import response_cache, MODEL_NAMESPACES
+from catalogsnapshot import build_generation, catalog_snapshot_enabled
+from changefeed import record
+from models import db, Planet, Character
+from popularity import recount
+from readmodel import DEFAULT_BATCH_SIZE as READ_MODEL_BATCH_SIZE, check_documents, rebuild_documents
+
+DEFAULT_BATCH_SIZE = 5000
+
+CATALOGS = {
+    "planets": (Planet, Planet.id_planet),
+    "people": (Character, Character.id_character),
+}
+
+FIELDS = ("name", "img_link")
+
+
+def _detect_format(path, fmt):
+    if fmt:
+        return fmt
+    if path.endswith(".csv"):
+        return "csv"
+    return "ndjson"
+
+
+def _read_rows(stream, fmt):
+    """Yields {"name", "img_link"} dicts one by one. Row ids in the file are ignored."""
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+    else:
+        reader = (json.loads(line) for line in stream if line.strip())
+
+    for line_number, row in enumerate(reader, start=1):
+        name = (row.get("name") or "").strip()
+        if not name:
+            raise click.ClickException("Row " + str(line_number) + " has no 'name'")
+        yield {"name": name, "img_link": row.get("img_link") or None}
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def upsert_statement(model):
+    """INSERT ... ON CONFLICT (name) DO UPDATE for the current database dialect."""
+    dialect = db.engine.dialect.name
+
+    if dialect in ("postgresql", "sqlite"):
+        if dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        stmt = dialect_insert(model)
+        return stmt.on_conflict_do_update(
+            index_elements=[model.name], set_={"img_link": stmt.excluded.img_link})
+
+    if dialect == "mysql":
+        from sqlalchemy.dialects.mysql import insert as dialect_insert
+        stmt = dialect_insert(model)
+        return stmt.on_duplicate_key_update(img_link=stmt.inserted.img_link)
+
+    raise click.ClickException("Upsert not supported for database: " + dialect)
+
+
+def _report(label, rows, elapsed):
+    rate = rows / elapsed if elapsed > 0 else 0
+    click.echo("{}: {} rows in {:.2f}s ({:.0f} rows/sec)".format(label, rows, elapsed, rate), err=True)
+
+
+def import_catalog(catalog, stream, fmt, batch_size=DEFAULT_BATCH_SIZE, progress_every=20):
+    model, pk_column = CATALOGS[catalog]
+    stmt = upsert_statement(model)
+    total = 0
+    started = time.perf_counter()
+
+    for number, chunk in enumerate(_chunks(_read_rows(stream, fmt), batch_size), start=1):
+        # Dentro de un mismo chunk un nombre repetido romperia el ON CONFLICT, gana el ultimo
+        chunk = list({row["name"]: row for row in chunk}.values())
+        db.session.execute(stmt, chunk)
+        db.session.commit()
+        total += len(chunk)
+        if progress_every and number % progress_every == 0:
+            _report("imported " + catalog, total, time.perf_counter() - started)
+
+    # Los INSERT de Core no disparan los eventos del ORM, invalidamos la cache a mano
+    response_cache.invalidate(MODEL_NAMESPACES[model])
+    # y avisamos a los clientes del change feed que vuelvan a leer el catalogo
+    record(db.session, [{"type": catalog, "action": "imported"}])
+    db.session.commit()
+    if catalog_snapshot_enabled():
+        build_generation()
+
+    return total, time.perf_counter() - started
+
+
+def export_catalog(catalog, stream, fmt, batch_size=DEFAULT_BATCH_SIZE):
+    model, pk_column = CATALOGS[catalog]
+    started = time.perf_counter()
+    total = 0
+
+    rows = db.session.execute(
+        select(pk_column, model.name, model.img_link).order_by(pk_column)
+        .execution_options(yield_per=batch_size))
+
+    writer = None
+    if fmt == "csv":
+        writer = csv.writer(stream)
+        writer.writerow(("id",) + FIELDS)
+
+    for partition in rows.partitions():
+        if writer is not None:
+            writer.writerows(partition)
+        else:
+            stream.write("".join(
+                json.dumps({"id": row[0], "name": row[1], "img_link": row[2]}) + "\n" for row in partition))
+        total += len(partition)
+
+    return total, time.perf_counter() - started
+
+
+@click.group("catalog", help="Bulk import/export of the planet and character catalogs.")
+def catalog_cli():
+    pass
+
+
+@catalog_cli.command("import")
+@click.argument("catalog", type=click.Choice(sorted(CATALOGS)))
+@click.argument("path")
+@click.option("--format", "fmt", type=click.Choice(["ndjson", "csv"]), default=None,
+              help="File format, detected from the extension by default.")
+@click.option("--batch-size", default=DEFAULT_BATCH_SIZE, show_default=True)
+def import_command(catalog, path, fmt, batch_size):
+    """Upserts (by name) the rows of PATH (or '-' for stdin) into CATALOG."""
+    fmt = _detect_format(path, fmt)
+    if path == "-":
+        total, elapsed = import_catalog(catalog, sys.stdin, fmt, batch_size)
+    else:
+        with open(path, newline="", encoding="utf-8") as stream:
+            total, elapsed = import_catalog(catalog, stream, fmt, batch_size)
+    _report("imported " + catalog, total, elapsed)
+
+
+@catalog_cli.command("export")
+@click.argument("catalog", type=click.Choice(sorted(CATALOGS)))
+@click.argument("path")
+@click.option("--format", "fmt", type=click.Choice(["ndjson", "csv"]), default=None,
+              help="File format, detected from the extension by default.")
+@click.option("--batch-size", default=DEFAULT_BATCH_SIZE, show_default=True)
+def export_command(catalog, path, fmt, batch_size):
+    """Streams CATALOG ordered by id into PATH (or '-' for stdout)."""
+    fmt = _detect_format(path, fmt)
+    if path == "-":
+        total, elapsed = export_catalog(catalog, sys.stdout, fmt, batch_size)
+    else:
+        with open(path, "w", newline="", encoding="utf-8") as stream:
+            total, elapsed = export_catalog(catalog, stream, fmt, batch_size)
+    _report("exported " + catalog, total, elapsed)
+
+
+@click.group("favorites", help="Maintenance of the per-user favorites read model and the favorite counters.")
+def favorites_cli():
+    pass
+
+
+@favorites_cli.command("rebuild")
+@click.option("--batch-size", default=READ_MODEL_BATCH_SIZE, show_default=True)
+def rebuild_command(batch_size):
+    """Recomputes the favorites document of every user."""
+    started = time.perf_counter()
+    total = rebuild_documents(batch_size)
+    _report("rebuilt favorites of users", total, time.perf_counter() - started)
+
+
+@favorites_cli.command("check")
+@click.option("--batch-size", default=READ_MODEL_BATCH_SIZE, show_default=True)
+@click.option("--repair", is_flag=True, help="Rewrite the missing and stale documents.")
+def check_command(batch_size, repair):
+    """Compares every stored document with the favorite table, exits with 1 if any differs."""
+    problems = check_documents(batch_size, repair)
+    for kind, user_ids in problems.items():
+        if user_ids:
+            shown = ", ".join(str(user_id) for user_id in user_ids[:20])
+            more = " ..." if len(user_ids) > 20 else ""
+            click.echo("{} documents: {} (users {}{})".format(kind, len(user_ids), shown, more), err=True)
+
+    if not any(problems.values()):
+        click.echo("read model is consistent", err=True)
+    elif repair:
+        click.echo("repaired", err=True)
+    else:
+        sys.exit(1)
+
+
+@favorites_cli.command("recount")
+@click.option("--check", is_flag=True, help="Only report the drift, exit with 1 if there is any.")
+def recount_command(check):
+    """Recomputes the favorite counter of every planet and character from the favorite table."""
+    started = time.perf_counter()
+    drift = recount(repair=not check)
+    for (item_type, item_id), delta in sorted(drift.items())[:20]:
+        click.echo("{} {}: {:+d}".format(item_type, item_id, delta), err=True)
+    if len(drift) > 20:
+        click.echo("...", err=True)
+
+    if not drift:
+        click.echo("favorite counters are consistent", err=True)
+    elif check:
+        click.echo("{} counters drifted".format(len(drift)), err=True)
+        sys.exit(1)
+    else:
+        _report("recounted favorite counters", len(drift), time.perf_counter() - started)
+
+
+def setup_commands(app):
+    app.cli.add_command(catalog_cli)
+    app.cli.add_command(favorites_cli)
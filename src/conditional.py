@@ -0,0 +1,58 @@
+"""
+HTTP conditional requests for the API GET endpoints.
+
+Every 200 GET response gets a strong ETag (sha1 of the body) and a Cache-Control
+header, then If-None-Match / If-Modified-Since are evaluated so unchanged resources
+are answered with an empty 304.
+
+Responses coming from the response cache (cache.py) already carry their ETag and
+Last-Modified, computed once when the entry was stored, so for the catalog endpoints
+the 304 is decided without touching the database, serialize() or hashing the body.
+The other GETs (/users, /users/favorites/<id>) are ETag-only: there is no modification
+time to send as Last-Modified, so they answer 304 to If-None-Match and ignore
+If-Modified-Since.
+
+The body is compressed (content_encoding.py) between the ETag and the 304 check, so each
+representation is validated against its own ETag.
+"""
+import os
+
+from flask import request
+
+DEFAULT_CACHE_CONTROL = "no-cache"
+
+# Rutas que no son de la API (html del admin, estaticos)
+SKIP_PREFIXES = ("/admin", "/static")
+
+# Funciones que cambian el cuerpo despues del ETag y antes del 304 (content_encoding.py)
+_body_filters = []
+
+
+def add_body_filter(function):
+    if function not in _body_filters:
+        _body_filters.append(function)
+
+
+def add_validators(response):
+    """Adds the ETag (if missing) to a 200 response. Used by the response cache when storing."""
+    if response.get_etag()[0] is None:
+        response.add_etag()
+    return response
+
+
+def _conditional_response(response):
+    if request.method not in ("GET", "HEAD") or response.status_code != 200:
+        return response
+    if response.is_streamed or request.path.startswith(SKIP_PREFIXES):
+        return response
+
+    add_validators(response)
+    if "Cache-Control" not in response.headers:
+        response.headers["Cache-Control"] = os.environ.get("HTTP_CACHE_CONTROL", DEFAULT_CACHE_CONTROL)
+    for body_filter in _body_filters:
+        body_filter(response)
+    return response.make_conditional(request)
+
+
+def setup_conditional(app):
+    app.after_request(_conditional_response)
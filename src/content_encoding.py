@@ -0,0 +1,151 @@
+"""
+Negotiated compression (Content-Encoding) of the API responses.
+
+The coding is chosen from Accept-Encoding among the available ones, in the server
+preference order of COMPRESS_ALGORITHMS (default "zstd,br,gzip"): gzip always, br with
+the `brotli` package, zstd with `zstandard` (or the stdlib compression.zstd of Python
+3.14+). Only 200 GET/HEAD JSON / text responses of at least COMPRESS_MIN_SIZE bytes
+(1024) are compressed; they always get Vary: Accept-Encoding.
+
+Compressed bodies are cached by (identity ETag, coding), COMPRESS_CACHE_ENTRIES entries
+(256). The ETag is the sha1 of the uncompressed body, or the one stored by the response
+cache (cache.py), so a repeated hit of a cached catalog skips the database, the
+serialization and the compression. The compressed representation gets its own ETag
+(identity ETag + "-" + coding), so If-None-Match keeps working per representation.
+
+Levels: COMPRESS_GZIP_LEVEL (6), COMPRESS_BROTLI_QUALITY (5), COMPRESS_ZSTD_LEVEL (3).
+Disable everything with COMPRESS_ENABLED=0 (e.g. when a proxy already compresses).
+benchmarks/compression_bench.py measures time vs size for each coding and level.
+"""
+import gzip
+import os
+
+from flask import request
+
+from cache import LRUCache
+from conditional import add_body_filter
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional dependency
+    brotli = None
+
+zstandard = stdlib_zstd = None
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dependency
+    try:
+        from compression import zstd as stdlib_zstd
+    except ImportError:
+        pass
+
+DEFAULT_MIN_SIZE = 1024
+DEFAULT_CACHE_ENTRIES = 256
+DEFAULT_LEVELS = {"gzip": 6, "br": 5, "zstd": 3}
+
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/")
+
+_settings = {
+    "enabled": True,
+    "min_size": DEFAULT_MIN_SIZE,
+    "levels": dict(DEFAULT_LEVELS),
+    "order": ("zstd", "br", "gzip"),
+}
+
+compressed_cache = LRUCache(DEFAULT_CACHE_ENTRIES, ttl=0)
+
+
+def _gzip(data, level):
+    # mtime=0: misma entrada -> mismos bytes, lo que permite cachear y comparar
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def _brotli(data, level):
+    return brotli.compress(data, quality=level)
+
+
+def _zstd(data, level):
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    return stdlib_zstd.compress(data, level=level)
+
+
+def available_codings():
+    """{coding: compress(data, level)} of the codings this process can produce."""
+    codings = {"gzip": _gzip}
+    if brotli is not None:
+        codings["br"] = _brotli
+    if zstandard is not None or stdlib_zstd is not None:
+        codings["zstd"] = _zstd
+    return codings
+
+
+CODINGS = available_codings()
+
+
+def compress(data, coding, level=None):
+    return CODINGS[coding](data, _settings["levels"][coding] if level is None else level)
+
+
+def negotiate():
+    """Best coding for the current request, None for identity."""
+    offered = [coding for coding in _settings["order"] if coding in CODINGS]
+    return request.accept_encodings.best_match(offered)
+
+
+def _compressible(response):
+    if response.status_code != 200 or response.is_streamed or response.direct_passthrough:
+        return False
+    if "Content-Encoding" in response.headers:
+        return False
+    return (response.mimetype or "").startswith(COMPRESSIBLE_TYPES)
+
+
+def compress_response(response):
+    """
+    Compresses a 200 response (must already have its ETag, see conditional.py) for the
+    current request. Called before make_conditional so the 304 check sees the final ETag.
+    """
+    if not _settings["enabled"] or not _compressible(response):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    if response.content_length is not None and response.content_length < _settings["min_size"]:
+        return response
+
+    coding = negotiate()
+    if coding is None:
+        return response
+
+    etag, weak = response.get_etag()
+    key = (etag, coding) if etag else None
+    body = compressed_cache.get(key) if key else None
+    if body is None:
+        data = response.get_data()
+        if len(data) < _settings["min_size"]:
+            return response
+        body = compress(data, coding)
+        if key:
+            compressed_cache.set(key, body)
+
+    response.set_data(body)
+    response.headers["Content-Encoding"] = coding
+    if etag:
+        response.set_etag(etag + "-" + coding, weak=weak)
+    return response
+
+
+def setup_compression(app):
+    _settings["enabled"] = os.environ.get("COMPRESS_ENABLED", "1") != "0"
+    _settings["min_size"] = int(os.environ.get("COMPRESS_MIN_SIZE", DEFAULT_MIN_SIZE))
+    _settings["levels"] = {
+        "gzip": int(os.environ.get("COMPRESS_GZIP_LEVEL", DEFAULT_LEVELS["gzip"])),
+        "br": int(os.environ.get("COMPRESS_BROTLI_QUALITY", DEFAULT_LEVELS["br"])),
+        "zstd": int(os.environ.get("COMPRESS_ZSTD_LEVEL", DEFAULT_LEVELS["zstd"])),
+    }
+    order = os.environ.get("COMPRESS_ALGORITHMS")
+    if order:
+        _settings["order"] = tuple(coding.strip() for coding in order.split(",") if coding.strip())
+    compressed_cache.max_entries = int(os.environ.get("COMPRESS_CACHE_ENTRIES", DEFAULT_CACHE_ENTRIES))
+    add_body_filter(compress_response)
+    app.extensions["compression"] = compressed_cache
@@ -0,0 +1,229 @@
+"""
+Database engine configuration: connection pool settings from the environment, an
+optional read replica for GET requests, pool metrics and health checks.
+
+Environment:
+    DB_POOL_SIZE (5), DB_MAX_OVERFLOW (10), DB_POOL_TIMEOUT (seconds to wait for a free
+    connection, 30), DB_POOL_RECYCLE (seconds, 1800), DB_POOL_PRE_PING (1/0, default 1)
+    DB_STATEMENT_TIMEOUT_MS     PostgreSQL statement_timeout for every connection
+    DATABASE_READ_URL           read replica, GET/HEAD requests read from it
+
+Reads on the replica can lag behind the primary: a client that writes and reads
+right away can see the previous data (and the response cache may keep it until
+CACHE_TTL). Call use_primary() in a handler that needs to read its own writes.
+"""
+import os
+import threading
+import time
+
+from flask import current_app, g, has_request_context, jsonify, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, exc, text
+from sqlalchemy.pool import QueuePool
+
+READ_METHODS = ("GET", "HEAD")
+
+# Aplicaciones configuradas en este proceso, para dispose_engines() despues de un fork
+_apps = []
+
+# Histogramas de espera por un connection del pool, por nombre de engine
+# se llenan desde TimedQueuePool y los lee instrumentation.py a traves del collector
+_pool_waits = {}
+_pool_timeouts = {}
+_lock = threading.Lock()
+
+WAIT_BUCKETS = (0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+
+# Espera reciente por engine, [promedio movil, monotonic de la ultima observacion], para
+# admission.py. El promedio pesa RECENT_WAIT_WEIGHT cada checkout nuevo y se reduce a la
+# mitad cada RECENT_WAIT_HALF_LIFE segundos sin checkouts.
+_recent_waits = {}
+RECENT_WAIT_WEIGHT = 0.2
+RECENT_WAIT_HALF_LIFE = 2.0
+
+
+def database_url():
+    db_url = os.getenv("DATABASE_URL")
+    if db_url is not None:
+        return db_url.replace("postgres://", "postgresql://")
+    return "sqlite:////tmp/test.db"
+
+
+def read_database_url():
+    url = os.getenv("DATABASE_READ_URL")
+    return url.replace("postgres://", "postgresql://") if url else None
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that measures how long each checkout waited for a connection."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            _pool_timeouts[self.logging_name] = _pool_timeouts.get(self.logging_name, 0) + 1
+            raise
+        finally:
+            _observe_wait(self.logging_name, time.perf_counter() - started)
+
+
+def _observe_wait(name, seconds):
+    histogram = _pool_waits.get(name)
+    if histogram is None:
+        # import aqui: instrumentation importa models, que importa este modulo
+        from instrumentation import Histogram
+        with _lock:
+            histogram = _pool_waits.setdefault(name, Histogram(WAIT_BUCKETS))
+    histogram.observe(seconds)
+
+    now = time.monotonic()
+    with _lock:
+        previous = _decayed_wait(_recent_waits.get(name), now)
+        _recent_waits[name] = [previous + (seconds - previous) * RECENT_WAIT_WEIGHT, now]
+
+
+def _decayed_wait(state, now):
+    if state is None:
+        return 0.0
+    value, updated = state
+    return value * 0.5 ** ((now - updated) / RECENT_WAIT_HALF_LIFE)
+
+
+def recent_pool_wait(name="primary"):
+    """Moving average (seconds) of the recent waits for a connection of an engine's pool."""
+    return _decayed_wait(_recent_waits.get(name), time.monotonic())
+
+
+def engine_options(url, name="primary"):
+    """Options for create_engine / SQLALCHEMY_ENGINE_OPTIONS read from the environment."""
+    options = {
+        "pool_pre_ping": os.environ.get("DB_POOL_PRE_PING", "1") != "0",
+    }
+    if url.startswith("sqlite") and ":memory:" in url:
+        return options
+
+    options.update({
+        "poolclass": TimedQueuePool,
+        "pool_logging_name": name,
+        "pool_size": int(os.environ.get("DB_POOL_SIZE", 5)),
+        "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+        "pool_timeout": float(os.environ.get("DB_POOL_TIMEOUT", 30)),
+        "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+    })
+
+    statement_timeout = os.environ.get("DB_STATEMENT_TIMEOUT_MS")
+    if statement_timeout and url.startswith("postgresql"):
+        options["connect_args"] = {"options": "-c statement_timeout=" + str(int(statement_timeout))}
+    return options
+
+
+def use_primary():
+    """Sends the rest of the current request to the primary database (read your own writes)."""
+    g.use_primary = True
+
+
+class RoutingSession(Session):
+    """
+    db.session class: during GET/HEAD requests queries go to the read replica (when
+    DATABASE_READ_URL is set), everything else and any flush go to the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_request_context():
+            read_engine = current_app.extensions.get("read_engine")
+            if read_engine is not None and request.method in READ_METHODS and not g.get("use_primary"):
+                return read_engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+# -----------------------------------Metrics and health--------------------------------------------------
+
+def _engines(app):
+    engines = {"primary": app.extensions["sqlalchemy"].engines[None]}
+    if app.extensions.get("read_engine") is not None:
+        engines["replica"] = app.extensions["read_engine"]
+    return engines
+
+
+def _pool_collector(app):
+    def collect():
+        lines = [
+            "# HELP db_pool_connections Connections of the pool by state",
+            "# TYPE db_pool_connections gauge",
+        ]
+        for name, engine in _engines(app).items():
+            pool = engine.pool
+            if not isinstance(pool, QueuePool):
+                continue
+            lines.append('db_pool_connections{engine="' + name + '",state="checked_out"} ' + str(pool.checkedout()))
+            lines.append('db_pool_connections{engine="' + name + '",state="idle"} ' + str(pool.checkedin()))
+            lines.append('db_pool_connections{engine="' + name + '",state="overflow"} ' + str(max(pool.overflow(), 0)))
+            lines.append('db_pool_connections{engine="' + name + '",state="size"} ' + str(pool.size()))
+
+        lines.append("# HELP db_pool_checkout_wait_seconds Time waited for a free connection")
+        lines.append("# TYPE db_pool_checkout_wait_seconds histogram")
+        for name, histogram in sorted(_pool_waits.items()):
+            cumulative = 0
+            for index, count in enumerate(histogram.counts):
+                cumulative += count
+                le = str(histogram.buckets[index]) if index < len(histogram.buckets) else "+Inf"
+                lines.append('db_pool_checkout_wait_seconds_bucket{engine="' + name + '",le="' + le + '"} ' + str(cumulative))
+            lines.append('db_pool_checkout_wait_seconds_sum{engine="' + name + '"} ' + repr(histogram.total))
+            lines.append('db_pool_checkout_wait_seconds_count{engine="' + name + '"} ' + str(histogram.count))
+
+        lines.append("# HELP db_pool_checkout_timeouts_total Checkouts that gave up waiting (pool exhausted)")
+        lines.append("# TYPE db_pool_checkout_timeouts_total counter")
+        for name, count in sorted(_pool_timeouts.items()):
+            lines.append('db_pool_checkout_timeouts_total{engine="' + name + '"} ' + str(count))
+        return lines
+    return collect
+
+
+def dispose_engines():
+    """
+    Forgets the pooled connections inherited from the parent process (gunicorn with
+    preload_app forks the workers after create_app()), without closing them: the
+    sockets belong to the parent. Each worker then opens its own connections.
+    """
+    for app in _apps:
+        with app.app_context():
+            for engine in _engines(app).values():
+                engine.dispose(close=False)
+
+
+def _health():
+    return jsonify({"status": "ok"}), 200
+
+
+def _health_ready():
+    checks = {}
+    healthy = True
+    for name, engine in _engines(current_app).items():
+        started = time.perf_counter()
+        try:
+            with engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+            checks[name] = {"status": "ok", "ms": round((time.perf_counter() - started) * 1000, 2)}
+        except Exception as error:
+            healthy = False
+            checks[name] = {"status": "error", "error": error.__class__.__name__}
+    return jsonify({"status": "ok" if healthy else "error", "databases": checks}), 200 if healthy else 503
+
+
+def setup_database(app):
+    """Call after db.init_app(app)."""
+    _apps.append(app)
+    read_url = read_database_url()
+    if read_url:
+        app.extensions["read_engine"] = create_engine(read_url, **engine_options(read_url, "replica"))
+        if "metrics" in app.extensions:
+            from instrumentation import instrument_engine
+            instrument_engine(app.extensions["read_engine"])
+
+    if "metrics" in app.extensions:
+        app.extensions["metrics"].register_collector(_pool_collector(app))
+
+    # /health: el proceso responde, /health/ready: ademas las bases de datos responden
+    app.add_url_rule("/health", "health", _health, methods=["GET"])
+    app.add_url_rule("/health/ready", "health_ready", _health_ready, methods=["GET"])
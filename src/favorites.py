@@ -0,0 +1,210 @@
+"""
+Favorite write operations shared by the API handlers.
+
+apply_batch() adds/removes many planets and characters for one user with a fixed
+number of statements: one IN query per item type to validate the ids, one query for
+the user's existing favorites among them, one executemany INSERT, one DELETE, one
+upsert of the favorite counters and a single commit.
+
+Body validation (parse_batch), the statements and the planning step (plan_batch) do
+not touch a session, so the async entry point (asgi.py) runs exactly the same logic on
+its own engine.
+
+add_favorite() / remove_favorite() are the single-item toggles: with the user and the
+item already resolved (lookups.py) each one is one INSERT or DELETE and the commit
+(plus the favorite counter of the item, popularity.py, the change feed event,
+changefeed.py, and the refresh of the user's document when the read model is enabled,
+readmodel.py).
+"""
+from sqlalchemy import delete, insert, or_, select
+from sqlalchemy.exc import IntegrityError
+
+from changefeed import favorite_event, record
+from models import db, Planet, Character, Favorite
+from popularity import apply_deltas, batch_deltas
+from readmodel import read_model_enabled, refresh_user
+from utils import APIException
+
+MAX_BATCH_ITEMS = 1000
+
+# tipo en la API -> (modelo, primary key del modelo, columna en favorite)
+ITEM_TYPES = {
+    "planets": (Planet, Planet.id_planet, "planet_id"),
+    "people": (Character, Character.id_character, "character_id"),
+}
+
+CONFLICT_MESSAGE = "Los favoritos cambiaron durante la solicitud, intente de nuevo"
+
+
+def parse_batch(data):
+    """Validates the body of POST /favorites/batch, returns (email, add, remove)."""
+    if data is None:
+        raise APIException("Cuerpo de la solicitud vacío", status_code=400)
+
+    if "email" not in data:
+        raise APIException("Se debe especificar el email del usuario", status_code=400)
+
+    operations = {}
+    total = 0
+    for action in ("add", "remove"):
+        items = data.get(action) or {}
+        if not isinstance(items, dict):
+            raise APIException("'" + action + "' debe ser un objeto con las listas 'planets' y/o 'people'", status_code=400)
+        for item_type, ids in items.items():
+            if item_type not in ITEM_TYPES:
+                raise APIException("Tipo de favorito desconocido: " + str(item_type), status_code=400)
+            if not isinstance(ids, list) or not all(isinstance(x, int) and not isinstance(x, bool) for x in ids):
+                raise APIException("'" + action + "." + item_type + "' debe ser una lista de ids enteros", status_code=400)
+            total += len(ids)
+        operations[action] = items
+
+    if total > MAX_BATCH_ITEMS:
+        raise APIException("Maximo " + str(MAX_BATCH_ITEMS) + " items por solicitud", status_code=400)
+
+    return data["email"], operations["add"], operations["remove"]
+
+
+def requested_ids(add, remove):
+    """{item_type: set of ids} mentioned in add or remove."""
+    return {item_type: set(add.get(item_type, ())) | set(remove.get(item_type, ()))
+            for item_type in ITEM_TYPES}
+
+
+def existing_ids_statement(item_type, ids):
+    pk_column = ITEM_TYPES[item_type][1]
+    return select(pk_column).where(pk_column.in_(ids))
+
+
+def user_favorites_statement(user_id, valid):
+    """SELECT of the user's favorites among the valid ids, None if there is nothing to look for."""
+    conditions = []
+    for item_type, ids in valid.items():
+        if ids:
+            column = getattr(Favorite, ITEM_TYPES[item_type][2])
+            conditions.append(column.in_(ids))
+    if not conditions:
+        return None
+    return (select(Favorite.id_fav, Favorite.planet_id, Favorite.character_id)
+            .where(Favorite.user_id == user_id, or_(*conditions)))
+
+
+def favorites_by_item(rows):
+    """{(item_type, item_id): id_fav} from the rows of user_favorites_statement()."""
+    found = {}
+    for id_fav, planet_id, character_id in rows:
+        if planet_id is not None:
+            found[("planets", planet_id)] = id_fav
+        if character_id is not None:
+            found[("people", character_id)] = id_fav
+    return found
+
+
+def plan_batch(user_id, add, remove, valid, favorites):
+    """
+    Decides what to do with every requested item.
+    Returns (results, rows to insert, id_fav to delete).
+    """
+    conflicts = {item_type: set(add.get(item_type, ())) & set(remove.get(item_type, ()))
+                 for item_type in ITEM_TYPES}
+
+    results = []
+    to_insert = []
+    to_delete = []
+    seen = set()
+
+    for action, items in (("add", add), ("remove", remove)):
+        for item_type in ITEM_TYPES:
+            column = ITEM_TYPES[item_type][2]
+            for item_id in items.get(item_type, ()):
+                result = {"type": item_type, "id": item_id, "action": action}
+                results.append(result)
+                key = (item_type, item_id)
+
+                if item_id in conflicts[item_type]:
+                    # el mismo id en add y remove: no hacemos ninguna de las dos
+                    result["status"] = "conflict"
+                elif key in seen:
+                    result["status"] = "duplicate"
+                elif item_id not in valid[item_type]:
+                    result["status"] = "not_found"
+                elif action == "add" and key in favorites:
+                    result["status"] = "already_favorite"
+                elif action == "add":
+                    to_insert.append({"user_id": user_id, column: item_id})
+                    result["status"] = "added"
+                elif key not in favorites:
+                    result["status"] = "not_favorite"
+                else:
+                    to_delete.append(favorites[key])
+                    result["status"] = "removed"
+                seen.add(key)
+
+    return results, to_insert, to_delete
+
+
+def batch_events(user_id, results):
+    """Change feed events (changefeed.py) of the items added / removed by plan_batch()."""
+    return [favorite_event(user_id, result["type"], result["id"], result["status"])
+            for result in results if result["status"] in ("added", "removed")]
+
+
+def apply_batch(user_id, add, remove):
+    """
+    add / remove: {"planets": [ids], "people": [ids]} (already validated by parse_batch).
+    Returns one result dict per requested item (adds first, then removes), the whole
+    batch is applied in a single transaction.
+    """
+    valid = {}
+    for item_type, ids in requested_ids(add, remove).items():
+        valid[item_type] = set(db.session.execute(existing_ids_statement(item_type, ids)).scalars()) if ids else set()
+
+    statement = user_favorites_statement(user_id, valid)
+    favorites = favorites_by_item(db.session.execute(statement)) if statement is not None else {}
+
+    results, to_insert, to_delete = plan_batch(user_id, add, remove, valid, favorites)
+
+    try:
+        if to_insert:
+            db.session.execute(insert(Favorite), to_insert)
+        if to_delete:
+            db.session.execute(delete(Favorite).where(Favorite.id_fav.in_(to_delete)))
+        apply_deltas(db.session, batch_deltas(results))
+        record(db.session, batch_events(user_id, results))
+        if read_model_enabled() and (to_insert or to_delete):
+            refresh_user(db.session, user_id)
+        db.session.commit()
+    except IntegrityError:
+        # otra solicitud agrego el mismo favorito mientras tanto, no se aplica nada del lote
+        db.session.rollback()
+        raise APIException(CONFLICT_MESSAGE, status_code=409)
+
+    return results
+
+
+def add_favorite(user_id, item_type, item_id):
+    """INSERT of one favorite. False if the insert was rejected (it already was a favorite)."""
+    column = ITEM_TYPES[item_type][2]
+    try:
+        db.session.execute(insert(Favorite).values({"user_id": user_id, column: item_id}))
+        apply_deltas(db.session, {(item_type, item_id): 1})
+        record(db.session, [favorite_event(user_id, item_type, item_id, "added")])
+        if read_model_enabled():
+            refresh_user(db.session, user_id)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return False
+    return True
+
+
+def remove_favorite(user_id, item_type, item_id):
+    """DELETE of one favorite. False if it was not a favorite."""
+    column = getattr(Favorite, ITEM_TYPES[item_type][2])
+    result = db.session.execute(delete(Favorite).where(Favorite.user_id == user_id, column == item_id))
+    if result.rowcount:
+        apply_deltas(db.session, {(item_type, item_id): -1})
+        record(db.session, [favorite_event(user_id, item_type, item_id, "removed")])
+    if read_model_enabled() and result.rowcount:
+        refresh_user(db.session, user_id)
+    db.session.commit()
+    return result.rowcount > 0
@@ -0,0 +1,222 @@
+"""
+Per-request performance instrumentation.
+
+For every request we record the wall time, how many SQL statements ran and the time
+spent in them (SQLAlchemy before/after_cursor_execute events on db.engine). That is
+returned in a `Server-Timing` header and aggregated per endpoint into histograms that
+GET /metrics exposes in Prometheus text format, with p50/p95/p99 estimated from the
+buckets. Statements slower than SLOW_QUERY_MS are logged to the "sql.slow" logger.
+
+The metrics live in the memory of each worker process (each gunicorn worker reports
+its own numbers, scrape them per instance or aggregate them in Prometheus).
+
+Settings (environment): METRICS_ENABLED (1/0), METRICS_TOKEN (/metrics needs
+`Authorization: Bearer <token>`), SLOW_QUERY_MS (default 200). Without METRICS_TOKEN the
+/metrics route is only registered in debug (FLASK_DEBUG): the per-route latencies and
+SQL counts are not published on a public URL. The Server-Timing header and the
+collectors of the other modules work either way.
+"""
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from flask import request, abort
+from sqlalchemy import event
+
+from models import db
+
+slow_query_log = logging.getLogger("sql.slow")
+
+# Buckets en segundos, de 1ms a 10s
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+QUANTILES = (0.5, 0.95, 0.99)
+
+# [numero de statements, segundos en SQL] de la solicitud actual
+_request_sql = ContextVar("request_sql", default=None)
+
+_settings = {"slow_query_ms": 200.0, "token": None}
+
+
+class Histogram:
+
+    __slots__ = ("buckets", "counts", "total", "count", "_lock")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # el ultimo es +Inf
+        self.total = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.total += value
+            self.count += 1
+
+    def quantile(self, q):
+        """Estimates the q quantile interpolating linearly inside the bucket (like histogram_quantile)."""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for index, bucket_count in enumerate(self.counts):
+            upper = self.buckets[index] if index < len(self.buckets) else self.buckets[-1]
+            if bucket_count and seen + bucket_count >= rank:
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+            lower = upper
+        return self.buckets[-1]
+
+
+class Metrics:
+
+    def __init__(self):
+        self.durations = {}
+        self.sql_counts = {}
+        self.sql_seconds = {}
+        self.slow_queries = 0
+        self.collectors = []
+        self._lock = threading.Lock()
+
+    def _get(self, family, key, buckets):
+        histogram = family.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = family.setdefault(key, Histogram(buckets))
+        return histogram
+
+    def record(self, endpoint, method, seconds, statements, sql_seconds):
+        key = (endpoint, method)
+        self._get(self.durations, key, DURATION_BUCKETS).observe(seconds)
+        self._get(self.sql_counts, key, STATEMENT_BUCKETS).observe(statements)
+        self._get(self.sql_seconds, key, DURATION_BUCKETS).observe(sql_seconds)
+
+    def register_collector(self, collector):
+        """collector() returns extra lines (already in Prometheus text format) for /metrics."""
+        self.collectors.append(collector)
+
+    def render(self):
+        lines = []
+        _render_histogram(lines, "http_request_duration_seconds",
+                          "Wall time of the request handler", self.durations)
+        _render_quantiles(lines, "http_request_duration_quantile_seconds",
+                          "p50/p95/p99 of the request wall time (estimated from the buckets)", self.durations)
+        _render_histogram(lines, "http_request_sql_statements",
+                          "SQL statements executed per request", self.sql_counts)
+        _render_histogram(lines, "http_request_sql_seconds",
+                          "Time spent in SQL per request", self.sql_seconds)
+        _render_quantiles(lines, "http_request_sql_quantile_seconds",
+                          "p50/p95/p99 of the SQL time per request (estimated from the buckets)", self.sql_seconds)
+        lines.append("# HELP db_slow_queries_total Statements slower than SLOW_QUERY_MS")
+        lines.append("# TYPE db_slow_queries_total counter")
+        lines.append("db_slow_queries_total " + str(self.slow_queries))
+        for collector in self.collectors:
+            lines.extend(collector())
+        return "\n".join(lines) + "\n"
+
+
+def _labels(endpoint, method, **extra):
+    pairs = [("endpoint", endpoint), ("method", method)] + sorted(extra.items())
+    return "{" + ",".join(k + '="' + str(v) + '"' for k, v in pairs) + "}"
+
+
+def _render_histogram(lines, name, help_text, family):
+    lines.append("# HELP " + name + " " + help_text)
+    lines.append("# TYPE " + name + " histogram")
+    for (endpoint, method), histogram in sorted(family.items()):
+        cumulative = 0
+        for index, bucket_count in enumerate(histogram.counts):
+            cumulative += bucket_count
+            le = str(histogram.buckets[index]) if index < len(histogram.buckets) else "+Inf"
+            lines.append(name + "_bucket" + _labels(endpoint, method, le=le) + " " + str(cumulative))
+        lines.append(name + "_sum" + _labels(endpoint, method) + " " + repr(histogram.total))
+        lines.append(name + "_count" + _labels(endpoint, method) + " " + str(histogram.count))
+
+
+def _render_quantiles(lines, name, help_text, family):
+    lines.append("# HELP " + name + " " + help_text)
+    lines.append("# TYPE " + name + " gauge")
+    for (endpoint, method), histogram in sorted(family.items()):
+        for q in QUANTILES:
+            lines.append(name + _labels(endpoint, method, quantile=q) + " " + repr(histogram.quantile(q)))
+
+
+metrics = Metrics()
+
+
+# -----------------------------------SQLAlchemy events--------------------------------------------------
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._instrumentation_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._instrumentation_start
+    stats = _request_sql.get()
+    if stats is not None:
+        stats[0] += 1
+        stats[1] += elapsed
+    if elapsed * 1000 >= _settings["slow_query_ms"]:
+        metrics.slow_queries += 1
+        slow_query_log.warning("slow query (%.1f ms): %s", elapsed * 1000, statement[:1000])
+
+
+def instrument_engine(engine):
+    if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+# -----------------------------------Flask hooks--------------------------------------------------
+
+def _before_request():
+    request._instrumentation_start = time.perf_counter()
+    _request_sql.set([0, 0.0])
+
+
+def _after_request(response):
+    start = getattr(request, "_instrumentation_start", None)
+    stats = _request_sql.get()
+    if start is None or stats is None:
+        return response
+
+    elapsed = time.perf_counter() - start
+    statements, sql_seconds = stats
+    response.headers.add(
+        "Server-Timing",
+        'app;dur={:.2f}, db;dur={:.2f};desc="{} queries"'.format(elapsed * 1000, sql_seconds * 1000, statements))
+
+    endpoint = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+    metrics.record(endpoint, request.method, elapsed, statements, sql_seconds)
+    return response
+
+
+def _metrics_view():
+    token = _settings["token"]
+    if token and request.headers.get("Authorization") != "Bearer " + token:
+        abort(401)
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+def setup_instrumentation(app):
+    if os.environ.get("METRICS_ENABLED", "1") == "0":
+        return
+    _settings["slow_query_ms"] = float(os.environ.get("SLOW_QUERY_MS", 200))
+    _settings["token"] = os.environ.get("METRICS_TOKEN")
+
+    with app.app_context():
+        instrument_engine(db.engine)
+
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    # sin token solo en desarrollo, si no cualquiera leeria las metricas
+    if _settings["token"] or app.debug:
+        app.add_url_rule("/metrics", "metrics", _metrics_view, methods=["GET"])
+    app.extensions["metrics"] = metrics
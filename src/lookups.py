@@ -0,0 +1,179 @@
+"""
+Small caches for the favorites write path.
+
+    - email -> user id
+    - planet / character id -> exists
+
+Only hits are cached (a new user or planet is visible right away). Entries expire
+after LOOKUP_CACHE_TTL seconds (default 60) and are dropped by SQLAlchemy events when a
+user is deleted or changes email and when a planet or character is deleted, which
+includes the edits made from Flask-Admin.
+
+The entries live in each worker, but every entry carries the generation of its cache, a
+counter in the backend of the response cache (cache.py, CACHE_BACKEND): those events
+increment it, right away and again after the commit, and an entry of an older
+generation is a miss. With a shared backend (redis) the change reaches every worker
+before its next lookup, at the cost of reading the counter on each lookup; with the
+in-process backend the other workers find out when the entry expires, and the write
+handlers re-check the database if an insert fails (see favorites.add_favorite).
+
+Settings (environment): LOOKUP_CACHE_TTL, LOOKUP_CACHE_SIZE (entries per cache, 10000).
+"""
+import os
+
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session, object_session
+
+from cache import LRUCache, response_cache
+from models import db, User, Planet, Character
+
+DEFAULT_TTL = 60
+DEFAULT_SIZE = 10000
+
+
+class LookupCache:
+    """
+    Local LRU whose entries are valid while the generation counter in the response
+    cache backend does not change. Read the generation before querying the database and
+    store the result with it: a change committed in between makes the entry a miss.
+    """
+
+    def __init__(self, name, max_entries=DEFAULT_SIZE, ttl=DEFAULT_TTL):
+        self.generation_key = "gen:lookups:" + name
+        self.local = LRUCache(max_entries, ttl)
+
+    def generation(self):
+        return response_cache.backend.counter(self.generation_key)
+
+    def get(self, key, generation):
+        entry = self.local.get(key)
+        if entry is None or entry[0] != generation:
+            return None
+        return entry[1]
+
+    def set(self, key, value, generation):
+        self.local.set(key, (generation, value))
+
+    def delete(self, key):
+        self.local.delete(key)
+
+    def invalidate(self):
+        response_cache.backend.incr(self.generation_key)
+
+
+user_ids = LookupCache("users")
+catalog_ids = LookupCache("catalog")
+
+CATALOG_PKS = {
+    Planet: Planet.id_planet,
+    Character: Character.id_character,
+}
+
+
+def user_id_statement(email):
+    return select(User.id).where(User.email == email)
+
+
+def item_statement(model, item_id):
+    pk_column = CATALOG_PKS[model]
+    return select(pk_column).where(pk_column == item_id)
+
+
+# get / remember: los usa tambien asgi.py, que consulta con su propia sesion async
+def cached_user_id(email):
+    """(user id or None, generation): pass the generation to remember_user_id() after the query."""
+    generation = user_ids.generation()
+    return user_ids.get(email, generation), generation
+
+
+def remember_user_id(email, user_id, generation):
+    if user_id is not None:
+        user_ids.set(email, user_id, generation)
+
+
+def known_item(model, item_id):
+    """(True if the item is known to exist, generation): pass the generation to remember_item()."""
+    generation = catalog_ids.generation()
+    return catalog_ids.get((model.__tablename__, item_id), generation) is not None, generation
+
+
+def remember_item(model, item_id, generation):
+    catalog_ids.set((model.__tablename__, item_id), True, generation)
+
+
+def user_id_for_email(email):
+    """Id of the user with this email (None if there is none), from the cache when possible."""
+    user_id, generation = cached_user_id(email)
+    if user_id is None:
+        user_id = db.session.execute(user_id_statement(email)).scalar()
+        remember_user_id(email, user_id, generation)
+    return user_id
+
+
+def catalog_item_exists(model, item_id):
+    known, generation = known_item(model, item_id)
+    if known:
+        return True
+    if db.session.execute(item_statement(model, item_id)).first() is None:
+        return False
+    remember_item(model, item_id, generation)
+    return True
+
+
+def forget(email, model, item_id):
+    """Drops both entries, the next lookup goes to the database."""
+    user_ids.delete(email)
+    catalog_ids.delete((model.__tablename__, item_id))
+
+
+# -----------------------------------Invalidation--------------------------------------------------
+
+def _invalidate(target, lookup_cache):
+    # ya, y otra vez despues del commit: un lector que consulto antes del commit no deja la entrada vieja
+    lookup_cache.invalidate()
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault("lookup_invalidations", set()).add(lookup_cache)
+
+
+def _user_updated(mapper, connection, target):
+    # el email anterior sigue en la cache apuntando a este usuario
+    deleted = inspect(target).attrs.email.history.deleted
+    for old_email in deleted:
+        user_ids.delete(old_email)
+    if deleted:
+        _invalidate(target, user_ids)
+
+
+def _user_deleted(mapper, connection, target):
+    user_ids.delete(target.email)
+    _invalidate(target, user_ids)
+
+
+def _catalog_deleted(mapper, connection, target):
+    catalog_ids.delete((mapper.class_.__tablename__, getattr(target, CATALOG_PKS[mapper.class_].key)))
+    _invalidate(target, catalog_ids)
+
+
+def _after_commit(session):
+    for lookup_cache in session.info.pop("lookup_invalidations", ()):
+        lookup_cache.invalidate()
+
+
+def _after_rollback(session):
+    session.info.pop("lookup_invalidations", None)
+
+
+def setup_lookups(app):
+    ttl = int(os.environ.get("LOOKUP_CACHE_TTL", DEFAULT_TTL))
+    size = int(os.environ.get("LOOKUP_CACHE_SIZE", DEFAULT_SIZE))
+    for lookup_cache in (user_ids, catalog_ids):
+        lookup_cache.local.ttl = ttl
+        lookup_cache.local.max_entries = size
+
+    listeners = [(User, "after_update", _user_updated), (User, "after_delete", _user_deleted)]
+    listeners += [(model, "after_delete", _catalog_deleted) for model in CATALOG_PKS]
+    listeners += [(Session, "after_commit", _after_commit), (Session, "after_rollback", _after_rollback)]
+    for target, name, listener in listeners:
+        if not event.contains(target, name, listener):
+            event.listen(target, name, listener)
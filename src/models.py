@@ -1,8 +1,10 @@
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import String, ForeignKey, Boolean
+from sqlalchemy import String, ForeignKey, Boolean, Index, Text, text
 from sqlalchemy.orm import Mapped, mapped_column, relationship
+from database import RoutingSession
 
-db = SQLAlchemy()
+# RoutingSession envia las lecturas de los GET a la replica si DATABASE_READ_URL esta configurada
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 
 # -----------------------------------User--------------------------------------------------
 
@@ -77,6 +79,21 @@ class Favorite(db.Model):
 
     __tablename__ = 'favorite'
 
+    # Indices: todas las consultas de favoritos filtran por user_id (y planet_id / character_id).
+    # Los indices unicos parciales evitan favoritos duplicados y a la vez sirven para las
+    # busquedas (planet_id, user_id) y (character_id, user_id) del DELETE.
+    __table_args__ = (
+        Index('ix_favorite_user_id', 'user_id'),
+        Index('ix_favorite_planet_id', 'planet_id'),
+        Index('ix_favorite_character_id', 'character_id'),
+        Index('uq_favorite_user_planet', 'user_id', 'planet_id', unique=True,
+              postgresql_where=text('planet_id IS NOT NULL'),
+              sqlite_where=text('planet_id IS NOT NULL')),
+        Index('uq_favorite_user_character', 'user_id', 'character_id', unique=True,
+              postgresql_where=text('character_id IS NOT NULL'),
+              sqlite_where=text('character_id IS NOT NULL')),
+    )
+
     # Atributos de la clase
     id_fav: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
 
@@ -103,3 +120,30 @@ class Favorite(db.Model):
     # De igual forma en caracter esto permite que se pueda hacer desde user:
     # Se pueda acceder a datos de caracter desde user.favorites.character.name por ejemplo.
     character = relationship('Character')
+
+
+# ---------------------------------Favoritos por usuario (read model)--------------------------------------------------------
+class UserFavorites(db.Model):
+
+    # Documento JSON con los favoritos del usuario, tal cual lo devuelve /users/favorites/<id>.
+    # Se mantiene desde readmodel.py, no se edita a mano
+    __tablename__ = 'user_favorites'
+
+    user_id: Mapped[int] = mapped_column(ForeignKey('user.id'), primary_key=True)
+    document: Mapped[str] = mapped_column(Text, nullable=False)
+
+
+# ---------------------------------Cantidad de favoritos por item--------------------------------------------------------
+class FavoriteCount(db.Model):
+
+    # Cuantos usuarios tienen a cada planeta / character como favorito, lo mantiene popularity.py
+    # en la misma transaccion que cada escritura de favorite. El indice sirve el ranking por tipo
+    __tablename__ = 'favorite_count'
+    __table_args__ = (
+        Index('ix_favorite_count_type_count', 'item_type', 'count'),
+    )
+
+    # "planets" o "people", igual que en la API
+    item_type: Mapped[str] = mapped_column(String(10), primary_key=True)
+    item_id: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    count: Mapped[int] = mapped_column(nullable=False, default=0)
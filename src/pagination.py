@@ -0,0 +1,116 @@
+"""
+Keyset (cursor) pagination and streaming helpers for the list endpoints.
+
+Pages are ordered by the primary key, the cursor is simply the last key that
+was returned, so every page is an index range scan (`WHERE id > :after LIMIT n`)
+no matter how deep the client goes into the table.
+"""
+from flask import Response, request, stream_with_context, url_for
+from serializers import json_rows_response
+from utils import APIException
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+STREAM_CHUNK_SIZE = 1000
+
+STREAM_FORMATS = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+}
+
+
+def _int_arg(name, minimum):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        raise APIException("'" + name + "' must be an integer", status_code=400)
+    if value < minimum:
+        raise APIException("'" + name + "' must be >= " + str(minimum), status_code=400)
+    return value
+
+
+def wants_page():
+    """True when the client asked for a page instead of the whole table."""
+    return "limit" in request.args or "after" in request.args
+
+
+def wants_stream():
+    """Returns the requested stream format ('json' / 'ndjson') or None."""
+    fmt = request.args.get("stream")
+    if fmt is None:
+        return None
+    if fmt in ("", "1", "true"):
+        return "json"
+    if fmt not in STREAM_FORMATS:
+        raise APIException("'stream' must be one of: " + ", ".join(STREAM_FORMATS), status_code=400)
+    return fmt
+
+
+def page_args():
+    limit = _int_arg("limit", 1)
+    limit = DEFAULT_LIMIT if limit is None else min(limit, MAX_LIMIT)
+    after = _int_arg("after", 0)
+    return after, limit
+
+
+def keyset_page(query, key_column, after, limit):
+    """
+    Returns (rows, next_cursor). We fetch one extra row to know whether there
+    is a next page without running a COUNT(*).
+    """
+    if after is not None:
+        query = query.filter(key_column > after)
+    rows = query.order_by(key_column).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = getattr(rows[-1], key_column.key)
+    return rows, next_cursor
+
+
+def page_response(projection, rows, endpoint, next_cursor, limit):
+    """JSON array body (same shape as the unpaginated endpoint) plus a Link header to the next page."""
+    response = json_rows_response(projection, rows)
+    if next_cursor is not None:
+        next_url = url_for(endpoint, after=next_cursor, limit=limit)
+        response.headers["Link"] = '<' + next_url + '>; rel="next"'
+        response.headers["X-Next-Cursor"] = str(next_cursor)
+    return response
+
+
+def stream_response(projection, key_column, fmt, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Streams the whole projection as a JSON array or NDJSON. Rows come from a
+    server-side cursor (`yield_per`) and are flushed to the client one chunk
+    at a time, so the table is never fully held in memory.
+    """
+    dumps = projection.encode_row
+    rows = projection.query().order_by(key_column).yield_per(chunk_size)
+
+    def generate():
+        buffer = []
+        first = True
+        if fmt == "json":
+            yield "["
+        for row in rows:
+            item = dumps(row)
+            if fmt == "ndjson":
+                buffer.append(item + "\n")
+            elif first:
+                buffer.append(item)
+                first = False
+            else:
+                buffer.append("," + item)
+            if len(buffer) >= chunk_size:
+                yield "".join(buffer)
+                buffer = []
+        if buffer:
+            yield "".join(buffer)
+        if fmt == "json":
+            yield "]\n"
+
+    return Response(stream_with_context(generate()), status=200, mimetype=STREAM_FORMATS[fmt])
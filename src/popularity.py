@@ -0,0 +1,306 @@
+"""
+Favorite counters per planet / character and the "most favorited" leaderboard.
+
+    GET /favorites/top                     planets and people, merged by favorites
+    GET /favorites/top?type=people&limit=20
+
+favorite_count has one row per item with its number of favorites, updated in the same
+transaction as every write of the favorite table: the single toggles and the batch
+endpoint (favorites.py), the group commit queue (writebehind.py), the async routes
+(asgi.py) and, through ORM events, Flask-Admin. A transaction adds up its changes per
+item and writes them with one upsert (count = count + delta), rows in key order so two
+batches never wait on each other in opposite order. The endpoint never runs the
+GROUP BY over favorite.
+
+The leaderboard is an in-memory snapshot per worker of the LEADERBOARD_SIZE (100) most
+favorited items of each type, sorted by favorites then id: one query on the
+(item_type, count) index joined with the names, repeated at most every LEADERBOARD_TTL
+seconds (5). While one thread refreshes it the others keep answering from the old one.
+
+Writes that bypass the app (SQL by hand, a restored dump) make the counters drift;
+recompute them from the favorite table with:
+
+    flask favorites recount [--check]
+"""
+import os
+import threading
+import time
+from collections import Counter
+from heapq import merge
+
+from flask import jsonify, request
+from sqlalchemy import delete, event, func, inspect, select, update
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+
+from models import db, Planet, Character, Favorite, FavoriteCount
+from utils import APIException
+
+DEFAULT_LIMIT = 10
+DEFAULT_SIZE = 100
+DEFAULT_TTL = 5
+
+# tipo en la API -> (modelo, primary key, columna en favorite)
+ITEMS = {
+    "planets": (Planet, Planet.id_planet, Favorite.planet_id),
+    "people": (Character, Character.id_character, Favorite.character_id),
+}
+
+_settings = {"size": DEFAULT_SIZE, "ttl": DEFAULT_TTL}
+
+_table = FavoriteCount.__table__
+
+
+# -----------------------------------Counters--------------------------------------------------
+
+def _counter_upsert(dialect):
+    """INSERT ... ON CONFLICT DO UPDATE SET count = count + excluded.count, None if the dialect has no upsert."""
+    if dialect in ("postgresql", "sqlite"):
+        if dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        stmt = dialect_insert(_table)
+        return stmt.on_conflict_do_update(index_elements=[_table.c.item_type, _table.c.item_id],
+                                          set_={"count": _table.c.count + stmt.excluded["count"]})
+
+    if dialect == "mysql":
+        from sqlalchemy.dialects.mysql import insert as dialect_insert
+        stmt = dialect_insert(_table)
+        return stmt.on_duplicate_key_update(count=_table.c.count + stmt.inserted["count"])
+
+    return None
+
+
+def apply_deltas(connection, deltas):
+    """
+    Adds {(item_type, item_id): delta} to the counters, inside the caller's transaction.
+    connection is a Connection or a session (its connection joins the transaction).
+    """
+    rows = [{"item_type": item_type, "item_id": item_id, "count": delta}
+            for (item_type, item_id), delta in sorted(deltas.items()) if delta]
+    if not rows:
+        return
+    if not isinstance(connection, Connection):
+        connection = connection.connection()
+
+    stmt = _counter_upsert(connection.dialect.name)
+    if stmt is not None:
+        connection.execute(stmt, rows)
+        return
+
+    # sin upsert: UPDATE y, si la fila no existia, INSERT
+    for row in rows:
+        result = connection.execute(update(_table)
+                                    .where(_table.c.item_type == row["item_type"], _table.c.item_id == row["item_id"])
+                                    .values(count=_table.c.count + row["count"]))
+        if result.rowcount == 0:
+            connection.execute(_table.insert().values(row))
+
+
+def batch_deltas(results):
+    """Deltas of a favorites.plan_batch() result list (added: +1, removed: -1)."""
+    deltas = Counter()
+    for result in results:
+        if result["status"] == "added":
+            deltas[(result["type"], result["id"])] += 1
+        elif result["status"] == "removed":
+            deltas[(result["type"], result["id"])] -= 1
+    return deltas
+
+
+# -----------------------------------Leaderboard--------------------------------------------------
+
+class Snapshot:
+
+    __slots__ = ("entries", "built_at")
+
+    def __init__(self, rows):
+        # (favoritos, id, nombre) de mayor a menor, a igual cantidad por id
+        self.entries = [(count, item_id, name) for item_id, count, name in rows]
+        self.built_at = time.monotonic()
+
+
+def top_statement(item_type, size):
+    model, pk_column, column = ITEMS[item_type]
+    return (select(FavoriteCount.item_id, FavoriteCount.count, model.name)
+            .join(model, pk_column == FavoriteCount.item_id)
+            .where(FavoriteCount.item_type == item_type, FavoriteCount.count > 0)
+            .order_by(FavoriteCount.count.desc(), FavoriteCount.item_id)
+            .limit(size))
+
+
+class Leaderboard:
+
+    def __init__(self):
+        self._snapshots = {}
+        self._lock = threading.Lock()
+
+    def _fresh(self, snapshot):
+        return snapshot is not None and time.monotonic() - snapshot.built_at < _settings["ttl"]
+
+    def snapshot(self, item_type):
+        current = self._snapshots.get(item_type)
+        if self._fresh(current):
+            return current
+
+        # solo un thread consulta, si ya hay un ranking los demas siguen usando el viejo
+        if not self._lock.acquire(blocking=current is None):
+            return current
+        try:
+            current = self._snapshots.get(item_type)
+            if not self._fresh(current):
+                rows = db.session.execute(top_statement(item_type, _settings["size"])).all()
+                current = self._snapshots[item_type] = Snapshot(rows)
+            return current
+        finally:
+            self._lock.release()
+
+    def top(self, types, limit):
+        """[(item_type, item_id, name, favorites)] of the most favorited items of the types."""
+        streams = [[(-count, item_type, item_id, name) for count, item_id, name in self.snapshot(item_type).entries]
+                   for item_type in types]
+        return [(item_type, item_id, name, -count) for count, item_type, item_id, name in merge(*streams)][:limit]
+
+    def clear(self):
+        self._snapshots.clear()
+
+
+leaderboard = Leaderboard()
+
+
+# -----------------------------------Endpoint--------------------------------------------------
+
+def top_favorites():
+    """
+    Most favorited planets and people
+    ---
+    parameters:
+      - {name: type, in: query, type: string, enum: [planets, people]}
+      - {name: limit, in: query, type: integer, minimum: 1, maximum: 100, default: 10}
+    responses:
+      200:
+        description: "{type, limit, results: [{type, id, name, favorites}]}"
+      400:
+        description: Invalid parameter
+    """
+    item_type = request.args.get("type")
+    if item_type is not None and item_type not in ITEMS:
+        raise APIException("'type' must be one of: " + ", ".join(ITEMS), status_code=400)
+    types = [item_type] if item_type else list(ITEMS)
+
+    limit = request.args.get("limit", DEFAULT_LIMIT)
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise APIException("'limit' must be an integer", status_code=400)
+    if limit < 1 or limit > _settings["size"]:
+        raise APIException("'limit' must be between 1 and " + str(_settings["size"]), status_code=400)
+
+    results = [{"type": result_type, "id": item_id, "name": name, "favorites": count}
+               for result_type, item_id, name, count in leaderboard.top(types, limit)]
+    return jsonify({"type": item_type, "limit": limit, "results": results}), 200
+
+
+# -----------------------------------Reconciliation--------------------------------------------------
+
+def expected_counts(connection):
+    """{(item_type, item_id): favorites} computed with GROUP BY over the favorite table."""
+    counts = {}
+    for item_type, (model, pk_column, column) in ITEMS.items():
+        rows = connection.execute(select(column, func.count()).where(column.isnot(None)).group_by(column))
+        counts.update(((item_type, item_id), count) for item_id, count in rows)
+    return counts
+
+
+def stored_counts(connection):
+    rows = connection.execute(select(_table.c.item_type, _table.c.item_id, _table.c.count))
+    return {(item_type, item_id): count for item_type, item_id, count in rows}
+
+
+def recount(repair=True):
+    """
+    Compares the counters with the favorite table. Returns the drift {(item_type, item_id): delta}
+    and, with repair, adds it to the counters and deletes the rows left at zero.
+    """
+    with db.engine.connect() as connection:
+        # las dos lecturas ven el mismo estado (en PostgreSQL, una transaccion REPEATABLE READ)
+        if connection.dialect.name == "postgresql":
+            connection.execution_options(isolation_level="REPEATABLE READ")
+        expected = expected_counts(connection)
+        stored = stored_counts(connection)
+        connection.rollback()
+
+    drift = {}
+    for key in expected.keys() | stored.keys():
+        delta = expected.get(key, 0) - stored.get(key, 0)
+        if delta:
+            drift[key] = delta
+
+    if repair:
+        # deltas y no valores absolutos: lo que se escribio despues de la lectura ya esta en los contadores
+        with db.engine.begin() as connection:
+            apply_deltas(connection, drift)
+            connection.execute(delete(_table).where(_table.c.count == 0))
+        leaderboard.clear()
+    return drift
+
+
+# -----------------------------------ORM events (Flask-Admin and other ORM writes)--------------------------------------------------
+# Las escrituras de la API usan INSERT / DELETE de Core y llaman a apply_deltas directamente.
+
+def _item_keys(planet_id, character_id):
+    keys = []
+    if planet_id is not None:
+        keys.append(("planets", planet_id))
+    if character_id is not None:
+        keys.append(("people", character_id))
+    return keys
+
+
+def _pending(target):
+    session = Session.object_session(target)
+    return session.info.setdefault("popularity", Counter())
+
+
+def _favorite_inserted(mapper, connection, target):
+    for key in _item_keys(target.planet_id, target.character_id):
+        _pending(target)[key] += 1
+
+
+def _favorite_deleted(mapper, connection, target):
+    for key in _item_keys(target.planet_id, target.character_id):
+        _pending(target)[key] -= 1
+
+
+def _favorite_updated(mapper, connection, target):
+    state = inspect(target)
+    for attribute, item_type in (("planet_id", "planets"), ("character_id", "people")):
+        history = state.attrs[attribute].history
+        if not history.has_changes():
+            continue
+        for item_id in history.deleted:
+            if item_id is not None:
+                _pending(target)[(item_type, item_id)] -= 1
+        for item_id in history.added:
+            if item_id is not None:
+                _pending(target)[(item_type, item_id)] += 1
+
+
+def _after_flush(session, flush_context):
+    deltas = session.info.pop("popularity", None)
+    if deltas:
+        apply_deltas(session.connection(), deltas)
+
+
+def setup_popularity(app):
+    _settings["size"] = int(os.environ.get("LEADERBOARD_SIZE", DEFAULT_SIZE))
+    _settings["ttl"] = float(os.environ.get("LEADERBOARD_TTL", DEFAULT_TTL))
+
+    listeners = [(Favorite, "after_insert", _favorite_inserted), (Favorite, "after_delete", _favorite_deleted),
+                 (Favorite, "after_update", _favorite_updated), (Session, "after_flush", _after_flush)]
+    for target, name, listener in listeners:
+        if not event.contains(target, name, listener):
+            event.listen(target, name, listener)
+
+    app.add_url_rule("/favorites/top", "top_favorites", top_favorites, methods=["GET"])
@@ -0,0 +1,505 @@
+"""
+On-demand profiling of the Flask app, to see where the time of a slow route goes (ORM
+hydration, serialize(), jsonify, the driver...).
+
+Everything needs PROFILING_ENABLED=1 and `Authorization: Bearer <PROFILING_TOKEN>`; without
+a token the module stays off. Two profilers:
+
+- sample: a thread of the worker reads the stack of the profiled threads every
+  PROFILING_SAMPLE_INTERVAL_MS (5) with sys._current_frames(). Low overhead, exported as
+  collapsed stacks ("a;b;c 12" lines) for flamegraph.pl, speedscope or inferno.
+- cprofile: cProfile while the request runs, every function call is measured (slower,
+  the request takes longer). Exported as a pstats file (`python -m pstats`, snakeviz) or
+  as text. From Python 3.12 cProfile sits on sys.monitoring, which is process-wide: the
+  profile also records whatever the other threads of the worker run meanwhile, and only
+  one cProfile capture can run per worker (another one answers 409).
+
+One request:
+
+    curl -H "Authorization: Bearer $PROFILING_TOKEN" -H "X-Profile: sample" /people
+    curl -H "Authorization: Bearer $PROFILING_TOKEN" "/people?profile=cprofile"
+
+answers as usual with an `X-Profile-Id` header. A time window of the worker:
+
+    POST /profiling/window?seconds=10                 the requests that run in the window
+    POST /profiling/window?seconds=10&threads=all     every thread of the worker
+
+Windows are always sampled (cProfile would slow down every request of the worker). It
+answers 202 with the id, the profile is listed once the window ends. With
+PROFILING_SLOW_MS > 0 every request is sampled and the ones slower than that are kept in
+a ring of PROFILING_SLOW_RING (20) profiles; the requested ones and the windows go to
+another ring of PROFILING_RING (20).
+
+    GET /profiling/profiles                                list of both rings
+    GET /profiling/profiles/<id>?format=collapsed|pstats|text
+
+The profiles live in the memory of the worker that recorded them (the id starts with its
+pid): with several workers, repeat the GET until it lands on that worker or profile a
+single instance. The async routes of asgi.py do not go through these hooks.
+"""
+import cProfile
+import hmac
+import io
+import itertools
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter, deque
+from functools import lru_cache
+
+from flask import Response, abort, g, jsonify, request
+
+from utils import APIException
+
+DEFAULT_SAMPLE_INTERVAL_MS = 5
+DEFAULT_RING = 20
+DEFAULT_MAX_WINDOW = 60
+DEFAULT_WINDOW = 10
+TEXT_LINES = 60
+
+MODES = ("sample", "cprofile")
+FORMATS = {
+    "sample": ("collapsed",),
+    "cprofile": ("pstats", "text"),
+}
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_settings = {"enabled": False, "token": None, "slow_ms": 0.0, "max_window": DEFAULT_MAX_WINDOW}
+
+_stats = {"samples": 0, "requests": 0, "slow": 0, "windows": 0}
+
+_ids = itertools.count(1)
+
+
+# -----------------------------------Profiles--------------------------------------------------
+
+class Profile:
+
+    __slots__ = ("id", "mode", "reason", "label", "created", "seconds", "status", "samples", "stats")
+
+    def __init__(self, mode, reason, label, seconds, status=None, samples=None, stats=None):
+        self.id = str(os.getpid()) + "-" + str(next(_ids))
+        self.mode = mode
+        self.reason = reason
+        self.label = label
+        self.created = time.time()
+        self.seconds = seconds
+        self.status = status
+        # sample: {"a;b;c": muestras}; cprofile: el dict de pstats.Stats
+        self.samples = samples
+        self.stats = stats
+
+    def summary(self):
+        return {
+            "id": self.id,
+            "mode": self.mode,
+            "reason": self.reason,
+            "label": self.label,
+            "created": self.created,
+            "duration_ms": round(self.seconds * 1000, 2),
+            "status": self.status,
+            "samples": sum(self.samples.values()) if self.samples is not None else None,
+            "formats": list(FORMATS[self.mode]),
+        }
+
+
+class Rings:
+
+    def __init__(self, size=DEFAULT_RING, slow_size=DEFAULT_RING):
+        self.recent = deque(maxlen=size)
+        self.slow = deque(maxlen=slow_size)
+
+    def add(self, profile):
+        (self.slow if profile.reason == "slow" else self.recent).append(profile)
+
+    def get(self, profile_id):
+        for profile in itertools.chain(list(self.recent), list(self.slow)):
+            if profile.id == profile_id:
+                return profile
+        return None
+
+
+rings = Rings()
+
+
+@lru_cache(maxsize=8192)
+def _frame_label(code):
+    path = code.co_filename
+    if path.startswith(SRC_DIR):
+        path = os.path.relpath(path, SRC_DIR)
+    elif "site-packages" + os.sep in path:
+        path = path.rsplit("site-packages" + os.sep, 1)[1]
+    # co_qualname existe desde 3.11, render.yaml todavia despliega 3.10
+    return getattr(code, "co_qualname", code.co_name) + " (" + path + ":" + str(code.co_firstlineno) + ")"
+
+
+def collapse(samples):
+    """{(code, ...): count} -> {"root;...;leaf": count}, the collapsed stack format."""
+    folded = Counter()
+    for codes, count in samples.items():
+        folded[";".join(_frame_label(code) for code in codes)] += count
+    return folded
+
+
+class _StatsHolder:
+    """What pstats.Stats accepts besides a file or a cProfile.Profile."""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def profiler_stats(profiler):
+    return pstats.Stats(profiler).stats
+
+
+# -----------------------------------Sampler--------------------------------------------------
+
+def _stack(frame):
+    codes = []
+    while frame is not None:
+        codes.append(frame.f_code)
+        frame = frame.f_back
+    codes.reverse()
+    return tuple(codes)
+
+
+class Sampler:
+    """One thread per worker that samples the stacks of the tracked threads."""
+
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL_MS / 1000):
+        self.interval = interval
+        self._targets = {}
+        self._all_threads = None
+        self._condition = threading.Condition()
+        self._thread = None
+        self._pid = None
+
+    def _ensure_thread(self):
+        # los threads no sobreviven al fork (gunicorn con preload_app): uno por proceso
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._condition:
+            if self._thread is None or self._pid != os.getpid():
+                self._targets = {}
+                self._all_threads = None
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="profiling-sampler", daemon=True)
+                self._thread.start()
+
+    def track(self, ident):
+        """Starts sampling a thread, returns the Counter its stacks go to."""
+        self._ensure_thread()
+        samples = Counter()
+        with self._condition:
+            self._targets[ident] = samples
+            self._condition.notify()
+        return samples
+
+    def untrack(self, ident):
+        with self._condition:
+            return self._targets.pop(ident, None)
+
+    def track_all(self):
+        """Samples every thread of the process (except this one) until untrack_all()."""
+        self._ensure_thread()
+        samples = Counter()
+        with self._condition:
+            self._all_threads = samples
+            self._condition.notify()
+        return samples
+
+    def untrack_all(self):
+        with self._condition:
+            samples, self._all_threads = self._all_threads, None
+            return samples
+
+    def _run(self):
+        me = threading.get_ident()
+        while True:
+            with self._condition:
+                while not self._targets and self._all_threads is None:
+                    self._condition.wait()
+            time.sleep(self.interval)
+
+            frames = sys._current_frames()
+            for ident, samples in list(self._targets.items()):
+                frame = frames.get(ident)
+                if frame is not None:
+                    samples[_stack(frame)] += 1
+                    _stats["samples"] += 1
+            all_threads = self._all_threads
+            if all_threads is not None:
+                for ident, frame in frames.items():
+                    if ident != me:
+                        all_threads[_stack(frame)] += 1
+                        _stats["samples"] += 1
+            del frames
+
+
+sampler = Sampler()
+
+
+# -----------------------------------Windows--------------------------------------------------
+
+class Window:
+
+    def __init__(self, threads, seconds):
+        self.threads = threads
+        self.seconds = seconds
+        self.started = time.perf_counter()
+        self.profile = Profile("sample", "window", "window (" + threads + ")", seconds)
+        self.samples = Counter()
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def add_request(self, samples):
+        with self._lock:
+            self.requests += 1
+            self.samples.update(samples)
+
+
+_window = {"current": None}
+_window_lock = threading.Lock()
+
+
+def start_window(threads, seconds):
+    with _window_lock:
+        if _window["current"] is not None:
+            raise APIException("A profiling window is already running in this worker", status_code=409)
+        window = _window["current"] = Window(threads, seconds)
+    if threads == "all":
+        window.samples = sampler.track_all()
+    timer = threading.Timer(seconds, finish_window, args=(window,))
+    timer.daemon = True
+    timer.start()
+    _stats["windows"] += 1
+    return window
+
+
+def finish_window(window):
+    with _window_lock:
+        _window["current"] = None
+    if window.threads == "all":
+        sampler.untrack_all()
+    profile = window.profile
+    profile.seconds = time.perf_counter() - window.started
+    if window.threads == "requests":
+        profile.label += ", " + str(window.requests) + " requests"
+    with window._lock:
+        profile.samples = collapse(window.samples)
+    rings.add(profile)
+
+
+# -----------------------------------Flask hooks--------------------------------------------------
+
+def _authorized():
+    token = _settings["token"]
+    header = request.headers.get("Authorization", "")
+    return hmac.compare_digest(header.encode(), ("Bearer " + token).encode())
+
+
+def _requested_mode():
+    mode = request.headers.get("X-Profile") or request.args.get("profile")
+    if not mode or not _authorized():
+        return None
+    if mode not in MODES:
+        raise APIException("'profile' must be one of: " + ", ".join(MODES), status_code=400)
+    return mode
+
+
+# cProfile usa sys.monitoring desde 3.12: un solo profiler activo por proceso
+_cprofile_lock = threading.Lock()
+
+
+class RequestProfiling:
+
+    __slots__ = ("mode", "started", "ident", "samples", "profiler", "window", "running")
+
+    def __init__(self, mode, window):
+        self.mode = mode
+        self.started = time.perf_counter()
+        self.ident = threading.get_ident()
+        self.samples = None
+        self.profiler = None
+        self.window = window
+        self.running = False
+
+    def start(self, sample, profile):
+        if profile:
+            if not _cprofile_lock.acquire(blocking=False):
+                raise APIException("A cProfile capture is already running in this worker", status_code=409)
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # otra herramienta (debugger, coverage) ya tiene el profiler del proceso
+                _cprofile_lock.release()
+                raise APIException("Another profiling tool is active in this worker", status_code=409)
+            self.profiler = profiler
+            self.running = True
+        if sample:
+            self.samples = sampler.track(self.ident)
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.profiler.disable()
+            _cprofile_lock.release()
+        if self.samples is not None:
+            sampler.untrack(self.ident)
+
+
+def _before_request():
+    mode = _requested_mode()
+    window = _window["current"]
+    if window is not None and window.threads != "requests":
+        window = None
+    sample = mode == "sample" or window is not None or _settings["slow_ms"] > 0
+    profile = mode == "cprofile"
+    if not sample and not profile:
+        return
+    state = RequestProfiling(mode, window)
+    state.start(sample, profile)
+    g.profiling = state
+
+
+def _after_request(response):
+    state = g.pop("profiling", None)
+    if state is None:
+        return response
+    state.stop()
+    seconds = time.perf_counter() - state.started
+    label = request.method + " " + request.full_path.rstrip("?")
+    _stats["requests"] += 1
+
+    if state.mode == "sample":
+        profile = Profile("sample", "request", label, seconds, response.status_code, samples=collapse(state.samples))
+    elif state.mode == "cprofile":
+        profile = Profile("cprofile", "request", label, seconds, response.status_code,
+                          stats=profiler_stats(state.profiler))
+    else:
+        profile = None
+    if profile is not None:
+        rings.add(profile)
+        response.headers["X-Profile-Id"] = profile.id
+
+    if state.window is not None:
+        state.window.add_request(state.samples)
+
+    if _settings["slow_ms"] > 0 and seconds * 1000 >= _settings["slow_ms"] and state.samples is not None:
+        _stats["slow"] += 1
+        rings.add(Profile("sample", "slow", label, seconds, response.status_code, samples=collapse(state.samples)))
+    return response
+
+
+def _teardown_request(exception=None):
+    # si after_request no llego a correr, no dejamos el profiler ni el thread en el sampler
+    state = g.pop("profiling", None)
+    if state is not None:
+        state.stop()
+
+
+# -----------------------------------Endpoints--------------------------------------------------
+
+def _require_token():
+    if not _authorized():
+        abort(401)
+
+
+def list_profiles():
+    _require_token()
+    window = _window["current"]
+    return jsonify({
+        "pid": os.getpid(),
+        "window": None if window is None else {"id": window.profile.id, "threads": window.threads,
+                                               "seconds": window.seconds},
+        "recent": [profile.summary() for profile in reversed(rings.recent)],
+        "slow": [profile.summary() for profile in reversed(rings.slow)],
+    }), 200
+
+
+def download_profile(profile_id):
+    _require_token()
+    profile = rings.get(profile_id)
+    if profile is None:
+        raise APIException("Profile not found in this worker (pid " + str(os.getpid()) + ")", status_code=404)
+    output = request.args.get("format", FORMATS[profile.mode][0])
+    if output not in FORMATS[profile.mode]:
+        raise APIException("A " + profile.mode + " profile has the formats: " + ", ".join(FORMATS[profile.mode]),
+                           status_code=400)
+
+    if output == "collapsed":
+        body = "".join(stack + " " + str(count) + "\n" for stack, count in sorted(profile.samples.items()))
+        return Response(body, mimetype="text/plain", headers={
+            "Content-Disposition": "attachment; filename=profile-" + profile.id + ".collapsed"})
+    if output == "pstats":
+        # el mismo contenido que pstats.Stats.dump_stats()
+        return Response(marshal.dumps(profile.stats), mimetype="application/octet-stream", headers={
+            "Content-Disposition": "attachment; filename=profile-" + profile.id + ".pstats"})
+
+    stream = io.StringIO()
+    stream.write(profile.label + "\n")
+    pstats.Stats(_StatsHolder(profile.stats), stream=stream).sort_stats("cumulative").print_stats(TEXT_LINES)
+    return Response(stream.getvalue(), mimetype="text/plain")
+
+
+def profile_window():
+    _require_token()
+    if request.args.get("mode", "sample") != "sample":
+        raise APIException("Windows are sampled only, use ?profile=cprofile on a single request", status_code=400)
+    threads = request.args.get("threads", "requests")
+    if threads not in ("requests", "all"):
+        raise APIException("'threads' must be 'requests' or 'all'", status_code=400)
+    try:
+        seconds = float(request.args.get("seconds", DEFAULT_WINDOW))
+    except ValueError:
+        raise APIException("'seconds' must be a number", status_code=400)
+    if seconds <= 0 or seconds > _settings["max_window"]:
+        raise APIException("'seconds' must be between 0 and " + str(_settings["max_window"]), status_code=400)
+
+    window = start_window(threads, seconds)
+    return jsonify({"id": window.profile.id, "mode": "sample", "threads": threads, "seconds": seconds}), 202
+
+
+def _collector():
+    lines = []
+    for name, help_text in (("samples", "Stacks read by the sampling profiler"),
+                            ("requests", "Requests profiled (requested, in a window or for the slow ring)"),
+                            ("slow", "Slow request profiles kept"),
+                            ("windows", "Profiling windows started")):
+        lines.append("# HELP profiling_" + name + "_total " + help_text)
+        lines.append("# TYPE profiling_" + name + "_total counter")
+        lines.append("profiling_" + name + "_total " + str(_stats[name]))
+    return lines
+
+
+def setup_profiling(app):
+    _settings["enabled"] = os.environ.get("PROFILING_ENABLED", "0") == "1"
+    _settings["token"] = os.environ.get("PROFILING_TOKEN") or None
+    if not _settings["enabled"]:
+        return
+    if _settings["token"] is None:
+        app.logger.warning("PROFILING_ENABLED=1 without PROFILING_TOKEN, profiling stays off")
+        _settings["enabled"] = False
+        return
+    _settings["slow_ms"] = float(os.environ.get("PROFILING_SLOW_MS", 0))
+    _settings["max_window"] = float(os.environ.get("PROFILING_MAX_WINDOW", DEFAULT_MAX_WINDOW))
+    sampler.interval = float(os.environ.get("PROFILING_SAMPLE_INTERVAL_MS", DEFAULT_SAMPLE_INTERVAL_MS)) / 1000
+    rings.recent = deque(maxlen=int(os.environ.get("PROFILING_RING", DEFAULT_RING)))
+    rings.slow = deque(maxlen=int(os.environ.get("PROFILING_SLOW_RING", DEFAULT_RING)))
+
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    app.add_url_rule("/profiling/profiles", "list_profiles", list_profiles, methods=["GET"])
+    app.add_url_rule("/profiling/profiles/<profile_id>", "download_profile", download_profile, methods=["GET"])
+    app.add_url_rule("/profiling/window", "profile_window", profile_window, methods=["POST"])
+    if "metrics" in app.extensions:
+        app.extensions["metrics"].register_collector(_collector)
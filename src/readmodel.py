@@ -0,0 +1,237 @@
+"""
+Read model for /users/favorites/<user_id>: the response of every user stored already
+serialized in the user_favorites table, so the endpoint is a single primary key fetch
+instead of the favorite / planet / character join.
+
+Documents are kept up to date in the same transaction as the change:
+
+    - the favorite handlers, the batch endpoint and favorites edited from Flask-Admin
+      recompute the document of that user (lock the user row, one join, replace the row)
+    - renaming a planet or character patches the documents that contain it
+    - deleting a user deletes its document
+
+Users without a document (created after the last rebuild) are answered from the join.
+It is off unless READ_MODEL_ENABLED=1; after enabling it (or after writing favorites
+outside the app) fill the table with:
+
+    flask favorites rebuild
+    flask favorites check [--repair]
+"""
+import json
+import os
+
+from flask import current_app
+from sqlalchemy import bindparam, delete, event, insert, inspect, select, update
+from sqlalchemy.orm import Session
+
+from models import db, User, Planet, Character, Favorite, UserFavorites
+from serializers import PLANET, CHARACTER, can_use_fast_path
+
+DEFAULT_BATCH_SIZE = 1000
+
+_settings = {"enabled": False}
+
+_table = UserFavorites.__table__
+
+# tipo de item -> (clave en el documento, clave del id, columna en favorite, proyeccion)
+ITEMS = {
+    Planet: ("planet", "id_planet", Favorite.planet_id, PLANET),
+    Character: ("character", "id_characater", Favorite.character_id, CHARACTER),
+}
+
+
+def read_model_enabled():
+    return _settings["enabled"]
+
+
+# -----------------------------------Documents--------------------------------------------------
+
+def favorites_statement(user_ids):
+    """Favorites of the users with only the columns of the response, ordered by user and id_fav."""
+    return (select(Favorite.id_fav, Favorite.user_id, Planet.id_planet, Planet.name,
+                   Character.id_character, Character.name)
+            .outerjoin(Planet, Planet.id_planet == Favorite.planet_id)
+            .outerjoin(Character, Character.id_character == Favorite.character_id)
+            .where(Favorite.user_id.in_(user_ids))
+            .order_by(Favorite.user_id, Favorite.id_fav))
+
+
+def render_favorites(rows):
+    """{user_id: [favorite dicts]} from the rows of favorites_statement()."""
+    documents = {}
+    for id_fav, user_id, planet_id, planet_name, character_id, character_name in rows:
+        data = {"id_favorite": id_fav, "user_id": user_id}
+        if planet_id:
+            data["planet"] = PLANET.to_dict((planet_id, planet_name))
+        if character_id:
+            data["character"] = CHARACTER.to_dict((character_id, character_name))
+        documents.setdefault(user_id, []).append(data)
+    return documents
+
+
+def encode_document(favorites):
+    # mismo texto que jsonify() (claves ordenadas, separadores compactos) sin el "\n" final
+    return json.dumps(favorites, sort_keys=True, separators=(",", ":"))
+
+
+def expected_documents(connection, user_ids):
+    """{user_id: document} computed from the favorite table."""
+    favorites = render_favorites(connection.execute(favorites_statement(user_ids)))
+    return {user_id: encode_document(favorites.get(user_id, [])) for user_id in user_ids}
+
+
+def stored_documents(connection, user_ids):
+    rows = connection.execute(select(_table.c.user_id, _table.c.document).where(_table.c.user_id.in_(user_ids)))
+    return dict(rows.all())
+
+
+def write_documents(connection, documents):
+    """Replaces the documents of {user_id: document}."""
+    if not documents:
+        return
+    connection.execute(delete(_table).where(_table.c.user_id.in_(list(documents))))
+    connection.execute(insert(_table), [{"user_id": user_id, "document": document}
+                                        for user_id, document in documents.items()])
+
+
+def refresh_user(connection, user_id):
+    """
+    Recomputes the document of one user inside the caller's transaction (a Session or a
+    Connection). The user row is locked first (SELECT ... FOR UPDATE, ignored by SQLite),
+    so two transactions changing favorites of the same user refresh one after the other
+    and the last one sees both changes.
+    """
+    if connection.execute(select(User.id).where(User.id == user_id).with_for_update()).first() is None:
+        connection.execute(delete(_table).where(_table.c.user_id == user_id))
+        return
+    write_documents(connection, expected_documents(connection, [user_id]))
+
+
+def patch_item(connection, model, item_id, serialized):
+    """Replaces a renamed planet / character in every document that contains it."""
+    key, id_key, column, projection = ITEMS[model]
+    rows = connection.execute(
+        select(_table.c.user_id, _table.c.document)
+        .where(_table.c.user_id.in_(select(Favorite.user_id).where(column == item_id)))).all()
+
+    changes = []
+    for user_id, document in rows:
+        favorites = json.loads(document)
+        for favorite in favorites:
+            if key in favorite and favorite[key][id_key] == item_id:
+                favorite[key] = serialized
+        changes.append({"b_user_id": user_id, "b_document": encode_document(favorites)})
+
+    if changes:
+        connection.execute(
+            update(_table).where(_table.c.user_id == bindparam("b_user_id")).values(document=bindparam("b_document")),
+            changes)
+
+
+def read_document(user_id):
+    return db.session.execute(select(UserFavorites.document).where(UserFavorites.user_id == user_id)).scalar()
+
+
+def document_response(document):
+    if not can_use_fast_path():
+        return current_app.json.response(json.loads(document))
+    return current_app.response_class(document + "\n", mimetype=current_app.json.mimetype)
+
+
+# -----------------------------------Rebuild / check--------------------------------------------------
+
+def _user_id_chunks(connection, batch_size):
+    last = None
+    while True:
+        statement = select(User.id).order_by(User.id).limit(batch_size)
+        if last is not None:
+            statement = statement.where(User.id > last)
+        user_ids = list(connection.execute(statement).scalars())
+        if not user_ids:
+            return
+        yield user_ids
+        last = user_ids[-1]
+
+
+def rebuild_documents(batch_size=DEFAULT_BATCH_SIZE):
+    """Rewrites the document of every user, one transaction per chunk. Returns the number of users."""
+    total = 0
+    with db.engine.connect() as connection:
+        for user_ids in _user_id_chunks(connection, batch_size):
+            write_documents(connection, expected_documents(connection, user_ids))
+            connection.commit()
+            total += len(user_ids)
+    return total
+
+
+def check_documents(batch_size=DEFAULT_BATCH_SIZE, repair=False):
+    """Compares the stored documents with the favorite table. Returns {"missing": [...], "stale": [...]}."""
+    problems = {"missing": [], "stale": []}
+    with db.engine.connect() as connection:
+        for user_ids in _user_id_chunks(connection, batch_size):
+            expected = expected_documents(connection, user_ids)
+            stored = stored_documents(connection, user_ids)
+            wrong = {}
+            for user_id, document in expected.items():
+                if user_id not in stored:
+                    problems["missing"].append(user_id)
+                elif stored[user_id] != document:
+                    problems["stale"].append(user_id)
+                else:
+                    continue
+                wrong[user_id] = document
+            if repair:
+                write_documents(connection, wrong)
+            connection.commit()
+    return problems
+
+
+# -----------------------------------ORM events (Flask-Admin and other ORM writes)--------------------------------------------------
+# Las escrituras de la API usan INSERT / DELETE de Core (favorites.py) y llaman a refresh_user
+# directamente; estos eventos cubren lo que pasa por el ORM.
+
+def _pending(target):
+    session = Session.object_session(target)
+    return session.info.setdefault("read_model", {"users": set(), "items": {}})
+
+
+def _favorite_changed(mapper, connection, target):
+    users = _pending(target)["users"]
+    users.add(target.user_id)
+    # si se movio el favorito a otro usuario, el anterior tambien cambia
+    users.update(inspect(target).attrs.user_id.history.deleted)
+
+
+def _item_updated(mapper, connection, target):
+    if inspect(target).attrs.name.history.deleted:
+        key, id_key, column, projection = ITEMS[mapper.class_]
+        item_id = getattr(target, projection.columns[0].key)
+        _pending(target)["items"][(mapper.class_, item_id)] = target.serialize()
+
+
+def _user_deleted(mapper, connection, target):
+    connection.execute(delete(_table).where(_table.c.user_id == target.id))
+
+
+def _after_flush(session, flush_context):
+    pending = session.info.pop("read_model", None)
+    if not pending:
+        return
+    connection = session.connection()
+    for (model, item_id), serialized in pending["items"].items():
+        patch_item(connection, model, item_id, serialized)
+    for user_id in sorted(pending["users"]):
+        refresh_user(connection, user_id)
+
+
+def setup_read_model(app):
+    _settings["enabled"] = os.environ.get("READ_MODEL_ENABLED", "0") == "1"
+    if not _settings["enabled"]:
+        return
+
+    listeners = [(Favorite, name, _favorite_changed) for name in ("after_insert", "after_update", "after_delete")]
+    listeners += [(model, "after_update", _item_updated) for model in ITEMS]
+    listeners += [(User, "before_delete", _user_deleted), (Session, "after_flush", _after_flush)]
+    for target, name, listener in listeners:
+        if not event.contains(target, name, listener):
+            event.listen(target, name, listener)
@@ -0,0 +1,296 @@
+"""
+Name search over planets and characters.
+
+    GET /search?q=tat                      prefix match, planets and people
+    GET /search?q=skywlker&match=fuzzy     trigram similarity (typos, words in any order)
+    GET /search?q=lu&type=people&limit=10&offset=10
+
+Results are ranked (prefix: alphabetical, so an exact match comes first; fuzzy: by
+similarity, then name) and paginated with limit / offset. The response has "next_offset"
+when there are more results.
+
+Two backends, chosen with SEARCH_BACKEND (auto, database, memory):
+
+    - database: PostgreSQL with the pg_trgm extension and the indexes of migration
+      9d4f2c6a8e13 (lower(name) COLLATE "C" for prefixes, GIN gin_trgm_ops for fuzzy)
+    - memory: in-process index per type, used by auto when the database is not
+      PostgreSQL or pg_trgm is missing. Names are kept sorted, so a prefix lookup is a
+      binary search plus a slice (no database query, well under a millisecond with
+      hundreds of thousands of names), and fuzzy matching uses an inverted index of
+      trigrams with the same similarity as pg_trgm, built on the first fuzzy search
+      after each rebuild (a few seconds for ~300k names, use PostgreSQL beyond that).
+
+The memory index is rebuilt when the response cache generation of its catalog changes
+(cache.py bumps it on every insert / update / delete and on `flask catalog import`) or
+after SEARCH_INDEX_TTL seconds (300), which bounds how long another worker's edits take
+to show up. While one thread rebuilds, the others keep answering from the old index.
+"""
+import os
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from heapq import merge
+
+from flask import jsonify, request
+from sqlalchemy import func, select, text
+
+from cache import response_cache
+from models import db, Planet, Character
+from utils import APIException
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+MAX_OFFSET = 1000
+FUZZY_THRESHOLD = 0.3
+DEFAULT_INDEX_TTL = 300
+
+# tipo en la API (igual al namespace de la cache) -> (modelo, primary key)
+SEARCH_TYPES = {
+    "planets": (Planet, Planet.id_planet),
+    "people": (Character, Character.id_character),
+}
+
+MATCH_MODES = ("prefix", "fuzzy")
+
+_settings = {"backend": "auto", "index_ttl": DEFAULT_INDEX_TTL}
+
+_WORD = re.compile(r"[^\W_]+")
+
+
+def trigrams(value):
+    """Set of trigrams of a string, computed like pg_trgm (lowercase words padded with spaces)."""
+    grams = set()
+    for word in _WORD.findall(value.lower()):
+        padded = "  " + word + " "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+# -----------------------------------Memory backend--------------------------------------------------
+
+class NameIndex:
+    """Sorted names of one catalog plus an inverted trigram index (built on the first fuzzy search)."""
+
+    __slots__ = ("keys", "ids", "names", "sizes", "postings", "generation", "built_at", "_lock")
+
+    def __init__(self, rows, generation):
+        entries = sorted((name.lower(), item_id, name) for item_id, name in rows)
+        self.keys = [entry[0] for entry in entries]
+        self.ids = array("q", (entry[1] for entry in entries))
+        self.names = [entry[2] for entry in entries]
+        self.sizes = None
+        self.postings = None
+        self.generation = generation
+        self.built_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _build_trigrams(self):
+        sizes = array("H")
+        postings = {}
+        for position, key in enumerate(self.keys):
+            grams = trigrams(key)
+            sizes.append(min(len(grams), 65535))
+            for gram in grams:
+                posting = postings.get(gram)
+                if posting is None:
+                    posting = postings[gram] = array("I")
+                posting.append(position)
+        self.sizes = sizes
+        self.postings = postings
+
+    def prefix(self, prefix, count):
+        """First `count` positions whose name starts with prefix, in index order."""
+        start = bisect_left(self.keys, prefix)
+        positions = []
+        for position in range(start, min(start + count, len(self.keys))):
+            if not self.keys[position].startswith(prefix):
+                break
+            positions.append(position)
+        return positions
+
+    def fuzzy(self, query, threshold):
+        """[(score, position)] with similarity >= threshold."""
+        grams = trigrams(query)
+        if not grams:
+            return []
+        if self.postings is None:
+            with self._lock:
+                if self.postings is None:
+                    self._build_trigrams()
+        shared = Counter()
+        for gram in grams:
+            posting = self.postings.get(gram)
+            if posting is not None:
+                shared.update(posting)
+        matches = []
+        for position, count in shared.items():
+            score = count / (len(grams) + self.sizes[position] - count)
+            if score >= threshold:
+                matches.append((score, position))
+        return matches
+
+
+class MemoryBackend:
+
+    def __init__(self):
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def index(self, item_type):
+        current = self._indexes.get(item_type)
+        generation = response_cache.generation(item_type)
+        if current is not None and current.generation == generation \
+                and time.monotonic() - current.built_at < _settings["index_ttl"]:
+            return current
+
+        # solo un thread reconstruye, si ya hay un indice los demas siguen usando el viejo
+        if not self._lock.acquire(blocking=current is None):
+            return current
+        try:
+            current = self._indexes.get(item_type)
+            if current is None or current.generation != generation \
+                    or time.monotonic() - current.built_at >= _settings["index_ttl"]:
+                model, pk_column = SEARCH_TYPES[item_type]
+                rows = db.session.execute(select(pk_column, model.name))
+                current = self._indexes[item_type] = NameIndex(rows, generation)
+            return current
+        finally:
+            self._lock.release()
+
+    def search(self, query, types, mode, count):
+        query = query.lower()
+        if mode == "prefix":
+            streams = []
+            for item_type in types:
+                index = self.index(item_type)
+                streams.append([(index.keys[p], index.ids[p], item_type, index.names[p], None)
+                                for p in index.prefix(query, count)])
+            return [row[1:] for row in merge(*streams)][:count]
+
+        found = []
+        for item_type in types:
+            index = self.index(item_type)
+            for score, p in index.fuzzy(query, FUZZY_THRESHOLD):
+                found.append((-score, index.keys[p], index.ids[p], item_type, index.names[p], score))
+        found.sort()
+        return [row[2:] for row in found[:count]]
+
+    def clear(self):
+        self._indexes.clear()
+
+
+# -----------------------------------PostgreSQL backend--------------------------------------------------
+
+class DatabaseBackend:
+
+    def search(self, query, types, mode, count):
+        query = query.lower()
+        found = []
+        for item_type in types:
+            model, pk_column = SEARCH_TYPES[item_type]
+            key = func.lower(model.name)
+            if mode == "prefix":
+                ordered_key = key.collate("C")
+                statement = (select(ordered_key, pk_column, model.name)
+                             .where(ordered_key.startswith(query, autoescape=True))
+                             .order_by(ordered_key, pk_column).limit(count))
+                found.extend((row[0], row[1], item_type, row[2], None) for row in db.session.execute(statement))
+            else:
+                score = func.similarity(key, query)
+                statement = (select(score, key, pk_column, model.name)
+                             .where(key.op("%")(query))
+                             .order_by(score.desc(), key, pk_column).limit(count))
+                found.extend((-row[0], row[1], row[2], item_type, row[3], row[0])
+                             for row in db.session.execute(statement))
+        found.sort()
+        if mode == "prefix":
+            return [row[1:] for row in found[:count]]
+        return [row[2:] for row in found[:count]]
+
+
+memory_backend = MemoryBackend()
+database_backend = DatabaseBackend()
+
+
+def current_backend():
+    if _settings["backend"] == "auto":
+        # pg_trgm lo crea la migracion, sin la extension usamos el indice en memoria
+        use_database = db.engine.dialect.name == "postgresql" and db.session.execute(
+            text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).first() is not None
+        _settings["backend"] = "database" if use_database else "memory"
+    return database_backend if _settings["backend"] == "database" else memory_backend
+
+
+# -----------------------------------Endpoint--------------------------------------------------
+
+def _int_arg(name, default, minimum, maximum):
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise APIException("'" + name + "' must be an integer", status_code=400)
+    if value < minimum or value > maximum:
+        raise APIException("'" + name + "' must be between " + str(minimum) + " and " + str(maximum), status_code=400)
+    return value
+
+
+def search():
+    """
+    Ranked search of planets and people by name
+    ---
+    parameters:
+      - {name: q, in: query, required: true, type: string}
+      - {name: match, in: query, type: string, enum: [prefix, fuzzy], default: prefix}
+      - {name: type, in: query, type: string, enum: [planets, people]}
+      - {name: limit, in: query, type: integer, minimum: 1, maximum: 100, default: 20}
+      - {name: offset, in: query, type: integer, minimum: 0, maximum: 1000, default: 0}
+    responses:
+      200:
+        description: "{query, match, results: [{type, id, name, score}], next_offset}"
+      400:
+        description: Invalid parameter
+    """
+    query = (request.args.get("q") or "").strip()
+    if not query:
+        raise APIException("'q' is required", status_code=400)
+
+    mode = request.args.get("match", "prefix")
+    if mode not in MATCH_MODES:
+        raise APIException("'match' must be one of: " + ", ".join(MATCH_MODES), status_code=400)
+
+    item_type = request.args.get("type")
+    if item_type is not None and item_type not in SEARCH_TYPES:
+        raise APIException("'type' must be one of: " + ", ".join(SEARCH_TYPES), status_code=400)
+    types = [item_type] if item_type else list(SEARCH_TYPES)
+
+    limit = _int_arg("limit", DEFAULT_LIMIT, 1, MAX_LIMIT)
+    offset = _int_arg("offset", 0, 0, MAX_OFFSET)
+
+    # un resultado de mas para saber si hay otra pagina
+    rows = current_backend().search(query, types, mode, offset + limit + 1)
+    page = rows[offset:offset + limit]
+
+    results = []
+    for item_id, result_type, name, score in page:
+        result = {"type": result_type, "id": item_id, "name": name}
+        if score is not None:
+            result["score"] = round(score, 4)
+        results.append(result)
+
+    return jsonify({
+        "query": query,
+        "match": mode,
+        "results": results,
+        "next_offset": offset + limit if len(rows) > offset + limit else None,
+    }), 200
+
+
+def setup_search(app):
+    _settings["backend"] = os.environ.get("SEARCH_BACKEND", "auto")
+    _settings["index_ttl"] = int(os.environ.get("SEARCH_INDEX_TTL", DEFAULT_INDEX_TTL))
+    app.add_url_rule("/search", "search", search, methods=["GET"])
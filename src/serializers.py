@@ -0,0 +1,95 @@
+"""
+Columnar-projection serialization for the list endpoints.
+
+Instead of loading full ORM objects and calling serialize() on each one, the list
+endpoints select only the exposed columns as plain row tuples and turn them into JSON
+with precomputed key templates. The output is byte for byte what jsonify() returns for
+the serialize() dicts (sorted keys, compact separators, ASCII escaping), including the
+historical "id_characater" key, so clients see no difference.
+
+orjson is used when installed; the stdlib fallback writes each row from a template.
+"""
+import json
+from json.encoder import encode_basestring_ascii
+
+from flask import current_app
+
+from models import db, User, Planet, Character
+
+try:
+    import orjson
+except ImportError:  # dependencia opcional
+    orjson = None
+
+
+def _encode_value(value):
+    if value is None:
+        return "null"
+    if value is True:
+        return "true"
+    if value is False:
+        return "false"
+    if isinstance(value, int):
+        return int.__repr__(value)
+    if isinstance(value, str):
+        return encode_basestring_ascii(value)
+    return json.dumps(value, sort_keys=True, separators=(",", ":"))
+
+
+class Projection:
+    """Columns to select and the output key for each one (same keys as Model.serialize())."""
+
+    __slots__ = ("columns", "keys", "_order", "_prefixes")
+
+    def __init__(self, columns, keys):
+        self.columns = tuple(columns)
+        self.keys = tuple(keys)
+        # jsonify ordena las claves, precalculamos ese orden y los fragmentos '{"key":' / ',"key":'
+        self._order = tuple(sorted(range(len(self.keys)), key=lambda i: self.keys[i]))
+        self._prefixes = tuple(
+            ("{" if n == 0 else ",") + encode_basestring_ascii(self.keys[i]) + ":"
+            for n, i in enumerate(self._order))
+
+    def query(self):
+        return db.session.query(*self.columns)
+
+    def to_dict(self, row):
+        return dict(zip(self.keys, row))
+
+    def encode_row(self, row):
+        parts = []
+        for prefix, i in zip(self._prefixes, self._order):
+            parts.append(prefix)
+            parts.append(_encode_value(row[i]))
+        parts.append("}")
+        return "".join(parts)
+
+    def encode(self, rows):
+        """JSON array of the rows, identical to jsonify([serialize(x) ...]) without the trailing newline."""
+        if orjson is not None:
+            keys = self.keys
+            body = orjson.dumps([dict(zip(keys, row)) for row in rows], option=orjson.OPT_SORT_KEYS)
+            # orjson no escapa los caracteres no ASCII como hace json.dumps, en ese caso usamos el otro camino
+            if body.isascii() and b"\x7f" not in body:
+                return body.decode("ascii")
+        return "[" + ",".join([self.encode_row(row) for row in rows]) + "]"
+
+
+USER = Projection((User.id, User.email), ("id", "email"))
+PLANET = Projection((Planet.id_planet, Planet.name), ("id_planet", "planet_name"))
+CHARACTER = Projection((Character.id_character, Character.name), ("id_characater", "character_name"))
+
+
+def can_use_fast_path():
+    # En modo debug jsonify indenta la salida, ahi no intentamos igualarla
+    compact = current_app.json.compact
+    return compact or (compact is None and not current_app.debug)
+
+
+def json_rows_response(projection, rows, status=200):
+    if not can_use_fast_path():
+        response = current_app.json.response([projection.to_dict(row) for row in rows])
+        response.status_code = status
+        return response
+    return current_app.response_class(
+        projection.encode(rows) + "\n", status=status, mimetype=current_app.json.mimetype)
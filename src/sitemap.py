@@ -0,0 +1,134 @@
+"""
+Site map and route metadata, computed once per application instead of on every request.
+
+    GET /               html with the links of the GET routes without parameters
+    GET /sitemap.json   the same links plus every route: path, endpoint, methods, parameters
+    GET /openapi.json   Swagger 2.0 (OpenAPI 2) document built by flask_swagger
+
+create_app() calls setup_sitemap(app) after every route is registered: the html and the
+json are rendered there. The OpenAPI document is built on its first request, so
+flask_swagger (and yaml) stay out of the worker startup (benchmarks/startup_bench.py).
+Every route is in it with its path parameters; a view can describe its query parameters
+and responses with a flask_swagger YAML block (after "---") in its docstring, see search.py.
+
+Each body keeps its ETag, so conditional.py answers If-None-Match without hashing and the
+compressed variants are cached by it (content_encoding.py).
+"""
+import hashlib
+import json
+import re
+import threading
+
+from flask import current_app
+
+from conditional import SKIP_PREFIXES
+from utils import UNLISTED_PREFIXES, generate_sitemap, has_no_empty_params, sitemap_links
+
+IGNORED_METHODS = {"HEAD", "OPTIONS"}
+
+# conversor de werkzeug -> tipo de parametro en OpenAPI
+PARAMETER_TYPES = {"int": "integer", "float": "number"}
+
+_ARGUMENT = re.compile(r"<(?:([^<>:]*):)?([^<>]*)>")
+
+_lock = threading.Lock()
+
+
+class Document:
+
+    __slots__ = ("body", "mimetype", "etag")
+
+    def __init__(self, body, mimetype):
+        self.body = body.encode() if isinstance(body, str) else body
+        self.mimetype = mimetype
+        self.etag = hashlib.sha1(self.body).hexdigest()
+
+
+def _json_body(data):
+    # mismo formato que jsonify()
+    return json.dumps(data, sort_keys=True, separators=(",", ":")) + "\n"
+
+
+def route_metadata(app):
+    """Every route of the app except the admin and static files, sorted by path."""
+    routes = []
+    for rule in app.url_map.iter_rules():
+        if rule.rule.startswith(SKIP_PREFIXES):
+            continue
+        parameters = [{"name": name, "type": PARAMETER_TYPES.get(converter, "string")}
+                      for converter, name in _ARGUMENT.findall(rule.rule)]
+        routes.append({
+            "path": rule.rule,
+            "endpoint": rule.endpoint,
+            "methods": sorted(rule.methods - IGNORED_METHODS),
+            "parameters": parameters,
+            "navigable": ("GET" in rule.methods and has_no_empty_params(rule)
+                          and not rule.rule.startswith(UNLISTED_PREFIXES)),
+        })
+    routes.sort(key=lambda route: (route["path"], route["endpoint"]))
+    return routes
+
+
+def openapi_template(app, routes):
+    """Paths for flask_swagger: every route, overridden by the views with a YAML docstring."""
+    paths = {}
+    for route in routes:
+        path = _ARGUMENT.sub(lambda match: "{" + match.group(2) + "}", route["path"])
+        view = app.view_functions[route["endpoint"]]
+        summary = (view.__doc__ or "").strip().split("\n", 1)[0] or route["endpoint"]
+        parameters = [{"name": parameter["name"], "in": "path", "required": True, "type": parameter["type"]}
+                      for parameter in route["parameters"]]
+        for method in route["methods"]:
+            operation = {
+                "operationId": route["endpoint"] + "." + method.lower(),
+                "summary": summary,
+                "responses": {"200": {"description": "OK"}},
+            }
+            if parameters:
+                operation["parameters"] = parameters
+            paths.setdefault(path, {})[method.lower()] = operation
+    return {"info": {"title": "Star Wars API", "version": "1.0"}, "paths": paths}
+
+
+def build_openapi(app):
+    from flask_swagger import swagger  # import diferido, ver el docstring
+    routes = app.extensions["sitemap"]["routes"]
+    return Document(_json_body(swagger(app, template=openapi_template(app, routes))), "application/json")
+
+
+def document_response(name):
+    documents = current_app.extensions["sitemap"]
+    document = documents.get(name)
+    if document is None:
+        with _lock:
+            document = documents.get(name)
+            if document is None:
+                document = documents[name] = build_openapi(current_app)
+    response = current_app.response_class(document.body, mimetype=document.mimetype)
+    response.set_etag(document.etag)
+    return response
+
+
+def _sitemap_json():
+    return document_response("json")
+
+
+def _openapi():
+    return document_response("openapi")
+
+
+def setup_sitemap(app):
+    """Call after registering every blueprint and url rule."""
+    app.add_url_rule("/sitemap.json", "sitemap_json", _sitemap_json, methods=["GET"])
+    app.add_url_rule("/openapi.json", "openapi", _openapi, methods=["GET"])
+
+    routes = route_metadata(app)
+    # url_for necesita un request, usamos uno de prueba una sola vez
+    with app.test_request_context():
+        links = sitemap_links(app)
+    app.extensions["sitemap"] = {
+        "routes": routes,
+        "html": Document(generate_sitemap(app, links), "text/html"),
+        "json": Document(_json_body({"links": links, "routes": routes}), "application/json"),
+        "openapi": None,
+    }
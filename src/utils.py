@@ -3,12 +3,13 @@ from flask import jsonify, url_for
 class APIException(Exception):
     status_code = 400
 
-    def __init__(self, message, status_code=None, payload=None):
+    def __init__(self, message, status_code=None, payload=None, headers=None):
         Exception.__init__(self)
         self.message = message
         if status_code is not None:
             self.status_code = status_code
         self.payload = payload
+        self.headers = headers
 
     def to_dict(self):
         rv = dict(self.payload or ())
@@ -20,16 +21,25 @@ def has_no_empty_params(rule):
     arguments = rule.arguments if rule.arguments is not None else ()
     return len(defaults) >= len(arguments)
 
-def generate_sitemap(app):
-    links = ['/admin/']
+# operacion (health checks, metricas, profiling): no son paginas para navegar ni indexar
+UNLISTED_PREFIXES = ("/health", "/metrics", "/profiling")
+
+def sitemap_links(app):
+    """Links of the site map, url_for needs a request context (see sitemap.py)."""
+    # el admin solo existe si create_app() lo monto (ADMIN_ENABLED)
+    links = ['/admin/'] if 'admin' in app.extensions else []
     for rule in app.url_map.iter_rules():
         # Filter out rules we can't navigate to in a browser
         # and rules that require parameters
         if "GET" in rule.methods and has_no_empty_params(rule):
             url = url_for(rule.endpoint, **(rule.defaults or {}))
-            if "/admin/" not in url:
+            if "/admin/" not in url and not url.startswith(UNLISTED_PREFIXES):
                 links.append(url)
+    return links
 
+def generate_sitemap(app, links=None):
+    if links is None:
+        links = sitemap_links(app)
     links_html = "".join(["<li><a href='" + y + "'>" + y + "</a></li>" for y in links])
     return """
         <div style="text-align: center;">
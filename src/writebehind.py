@@ -0,0 +1,345 @@
+"""
+Group commit of the single favorite toggles (POST / DELETE /favorite/planet|people/<id>).
+
+With WRITE_BEHIND_ENABLED=1, add_favorite() / remove_favorite() do not commit on their
+own: the operation goes to a queue of the worker process, a flusher thread applies the
+operations queued at that moment in one transaction, and every caller is answered
+after that commit (the acknowledgement is as durable as before, a failed commit is an
+error for every caller of the batch). A batch is flushed when it has
+WRITE_BEHIND_MAX_BATCH operations (200) or WRITE_BEHIND_MAX_DELAY_MS (2) after its
+first operation (right away when the previous batch had a single operation, there is no
+one to wait for); operations that arrive while a batch commits wait for the next one,
+so under load batches grow by themselves. More than WRITE_BEHIND_MAX_PENDING (5000)
+queued operations answer 503 with Retry-After. A caller waits at most WRITE_BEHIND_TIMEOUT
+seconds (10): if its operation was still queued it is taken out and committed on its own,
+if its batch was already being written it answers 503 (the toggle may or may not have
+been applied, retrying it is safe). If the flusher thread dies, the next toggle starts a
+new one.
+
+Operations on the same (user, item) pair are coalesced: each caller gets the answer it
+would have had one after the other (add on a favorite -> "already a favorite"), but only
+the net change is written (add then remove inserts and deletes nothing). Before writing,
+the batch reads the current state of its pairs with one SELECT; if another writer
+changed them in the meantime (duplicate insert, delete of a row that is gone) the batch
+is rolled back and its operations are applied one by one with the direct path.
+
+Batching needs concurrent requests in the same process: threaded / gevent gunicorn
+workers (a sync worker has one request at a time, it only adds the delay). The load
+shedding of admission.py caps the concurrent writes, and so the batch size, at
+WRITE_MAX_CONCURRENCY: raise it with this mode, a queued toggle does not hold a database
+connection. The async routes (asgi.py) keep their own transactions. benchmarks/groupcommit_bench.py compares
+commits/sec and latency of both modes.
+"""
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import delete, insert, or_, select
+from sqlalchemy.exc import IntegrityError
+
+import favorites
+from changefeed import favorite_event, record
+from favorites import ITEM_TYPES
+from models import db, Favorite
+from popularity import apply_deltas
+from readmodel import read_model_enabled, refresh_user
+from utils import APIException
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_BATCH = 200
+DEFAULT_MAX_DELAY_MS = 2
+DEFAULT_MAX_PENDING = 5000
+DEFAULT_TIMEOUT = 10
+
+_settings = {"enabled": False}
+
+_stats = {"batches": 0, "operations": 0, "coalesced": 0, "fallbacks": 0, "timeouts": 0}
+
+
+class Operation:
+
+    __slots__ = ("user_id", "item_type", "item_id", "action", "result", "error", "done")
+
+    def __init__(self, user_id, item_type, item_id, action):
+        self.user_id = user_id
+        self.item_type = item_type
+        self.item_id = item_id
+        self.action = action
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    @property
+    def key(self):
+        return (self.user_id, self.item_type, self.item_id)
+
+
+class Conflict(Exception):
+    """The favorites of the batch changed between the SELECT and the writes."""
+
+
+def _current_favorites(operations):
+    """{(user_id, item_type, item_id): id_fav} of the pairs of the batch that are favorites now."""
+    keys = {operation.key for operation in operations}
+    user_ids = {key[0] for key in keys}
+    conditions = []
+    for item_type, (model, pk_column, column) in ITEM_TYPES.items():
+        ids = {key[2] for key in keys if key[1] == item_type}
+        if ids:
+            conditions.append(getattr(Favorite, column).in_(ids))
+
+    # superconjunto (usuarios x items), nos quedamos con los pares pedidos
+    rows = db.session.execute(select(Favorite.id_fav, Favorite.user_id, Favorite.planet_id, Favorite.character_id)
+                              .where(Favorite.user_id.in_(user_ids), or_(*conditions)))
+    found = {}
+    for id_fav, user_id, planet_id, character_id in rows:
+        for key in ((user_id, "planets", planet_id), (user_id, "people", character_id)):
+            if key in keys:
+                found[key] = id_fav
+    return found
+
+
+def plan(operations, current):
+    """
+    Replays the operations in order over the current state. Sets the result of each
+    one and returns the net change: (rows to insert, id_fav to delete, changed user ids,
+    favorite counter deltas, change feed events).
+    """
+    present = {}
+    for operation in operations:
+        key = operation.key
+        is_favorite = present.get(key, key in current)
+        if operation.action == "add":
+            operation.result = not is_favorite
+            present[key] = True
+        else:
+            operation.result = is_favorite
+            present[key] = False
+
+    to_insert = []
+    to_delete = []
+    changed = set()
+    deltas = {}
+    events = []
+    for (user_id, item_type, item_id), is_favorite in present.items():
+        was_favorite = (user_id, item_type, item_id) in current
+        if is_favorite and not was_favorite:
+            to_insert.append({"user_id": user_id, ITEM_TYPES[item_type][2]: item_id})
+            delta = 1
+        elif was_favorite and not is_favorite:
+            to_delete.append(current[(user_id, item_type, item_id)])
+            delta = -1
+        else:
+            continue
+        changed.add(user_id)
+        deltas[(item_type, item_id)] = deltas.get((item_type, item_id), 0) + delta
+        events.append(favorite_event(user_id, item_type, item_id, "added" if delta > 0 else "removed"))
+    return to_insert, to_delete, changed, deltas, events
+
+
+def apply_operations(operations):
+    """Applies a batch in one transaction. Returns the number of rows written."""
+    to_insert, to_delete, changed, deltas, events = plan(operations, _current_favorites(operations))
+    try:
+        if to_insert:
+            db.session.execute(insert(Favorite), to_insert)
+        if to_delete:
+            result = db.session.execute(delete(Favorite).where(Favorite.id_fav.in_(to_delete)))
+            if result.rowcount != len(to_delete):
+                raise Conflict()
+        apply_deltas(db.session, deltas)
+        record(db.session, events)
+        if read_model_enabled():
+            for user_id in sorted(changed):
+                refresh_user(db.session, user_id)
+        db.session.commit()
+    except (IntegrityError, Conflict):
+        db.session.rollback()
+        raise Conflict()
+    return len(to_insert) + len(to_delete)
+
+
+def apply_one_by_one(operations):
+    for operation in operations:
+        try:
+            if operation.action == "add":
+                operation.result = favorites.add_favorite(operation.user_id, operation.item_type, operation.item_id)
+            else:
+                operation.result = favorites.remove_favorite(operation.user_id, operation.item_type, operation.item_id)
+        except Exception as error:
+            db.session.rollback()
+            operation.error = error
+
+
+# -----------------------------------Queue--------------------------------------------------
+
+class GroupCommitQueue:
+
+    def __init__(self, max_batch=DEFAULT_MAX_BATCH, max_delay=DEFAULT_MAX_DELAY_MS / 1000,
+                 max_pending=DEFAULT_MAX_PENDING):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.app = None
+        self._pending = []
+        self._condition = threading.Condition()
+        self._thread = None
+        self._pid = None
+        self._last_size = 0
+        self.timeout = DEFAULT_TIMEOUT
+
+    def _flusher_alive(self):
+        return self._thread is not None and self._pid == os.getpid() and self._thread.is_alive()
+
+    def _ensure_flusher(self):
+        # los threads no sobreviven al fork (gunicorn con preload_app): uno por proceso,
+        # y si el thread murio se arranca otro
+        if self._flusher_alive():
+            return
+        with self._condition:
+            if not self._flusher_alive():
+                if self._pid != os.getpid():
+                    self._pending = []
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="favorites-group-commit", daemon=True)
+                self._thread.start()
+
+    def submit(self, user_id, item_type, item_id, action):
+        """Queues one operation and waits for the commit of its batch. Returns its result."""
+        self._ensure_flusher()
+        operation = Operation(user_id, item_type, item_id, action)
+        with self._condition:
+            if len(self._pending) >= self.max_pending:
+                raise APIException("Servidor ocupado, intente de nuevo en 1 segundos", status_code=503,
+                                   payload={"retry_after": 1}, headers={"Retry-After": "1"})
+            self._pending.append(operation)
+            self._condition.notify()
+
+        if not operation.done.wait(self.timeout):
+            return self._timed_out(operation)
+        if operation.error is not None:
+            raise operation.error
+        return operation.result
+
+    def _timed_out(self, operation):
+        """The batch did not commit in time: the operation leaves the queue, or 503 if it is already being written."""
+        with self._condition:
+            queued = operation in self._pending
+            if queued:
+                self._pending.remove(operation)
+        _stats["timeouts"] += 1
+        if not queued:
+            raise APIException("Servidor ocupado, intente de nuevo en 1 segundos", status_code=503,
+                               payload={"retry_after": 1}, headers={"Retry-After": "1"})
+        # todavia no estaba en un lote: lo aplicamos con el camino directo, en este thread
+        apply_one_by_one([operation])
+        if operation.error is not None:
+            raise operation.error
+        return operation.result
+
+    def _next_batch(self):
+        with self._condition:
+            while not self._pending:
+                self._condition.wait()
+            # ventana: esperamos mas operaciones hasta max_delay o hasta llenar el lote. Si el
+            # lote anterior tuvo una sola operacion no hay concurrencia, no tiene sentido esperar
+            deadline = time.monotonic() + (self.max_delay if self._last_size > 1 else 0)
+            while len(self._pending) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            batch = self._pending[:self.max_batch]
+            del self._pending[:self.max_batch]
+            self._last_size = len(batch)
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self.flush(batch)
+            except Exception as error:
+                # un error fuera de la transaccion (app context, metricas...) no puede matar el thread
+                log.exception("group commit flush failed")
+                for operation in batch:
+                    if not operation.done.is_set():
+                        operation.error = error
+                        operation.done.set()
+
+    def flush(self, batch):
+        with self.app.app_context():
+            try:
+                written = apply_operations(batch)
+                _stats["coalesced"] += len(batch) - written
+            except Conflict:
+                _stats["fallbacks"] += 1
+                apply_one_by_one(batch)
+            except Exception as error:
+                db.session.rollback()
+                for operation in batch:
+                    operation.error = error
+            finally:
+                db.session.remove()
+        _stats["batches"] += 1
+        _stats["operations"] += len(batch)
+        for operation in batch:
+            operation.done.set()
+
+
+write_queue = GroupCommitQueue()
+
+
+# -----------------------------------API (same contract as favorites.py)--------------------------------------------------
+
+def write_behind_enabled():
+    return _settings["enabled"]
+
+
+def _submit(user_id, item_type, item_id, action):
+    # el request no necesita su conexion mientras espera el commit del lote
+    db.session.close()
+    return write_queue.submit(user_id, item_type, item_id, action)
+
+
+def add_favorite(user_id, item_type, item_id):
+    """favorites.add_favorite(), through the group commit queue when it is enabled."""
+    if not _settings["enabled"]:
+        return favorites.add_favorite(user_id, item_type, item_id)
+    return _submit(user_id, item_type, item_id, "add")
+
+
+def remove_favorite(user_id, item_type, item_id):
+    """favorites.remove_favorite(), through the group commit queue when it is enabled."""
+    if not _settings["enabled"]:
+        return favorites.remove_favorite(user_id, item_type, item_id)
+    return _submit(user_id, item_type, item_id, "remove")
+
+
+def _collector():
+    lines = []
+    for name, help_text in (("batches", "Transactions committed by the group commit queue"),
+                            ("operations", "Favorite toggles applied through the group commit queue"),
+                            ("coalesced", "Toggles that wrote no row (cancelled in their batch or no-ops)"),
+                            ("fallbacks", "Batches applied one by one after a conflict"),
+                            ("timeouts", "Toggles that waited more than WRITE_BEHIND_TIMEOUT for their batch")):
+        lines.append("# HELP write_behind_" + name + "_total " + help_text)
+        lines.append("# TYPE write_behind_" + name + "_total counter")
+        lines.append("write_behind_" + name + "_total " + str(_stats[name]))
+    return lines
+
+
+def setup_write_behind(app):
+    _settings["enabled"] = os.environ.get("WRITE_BEHIND_ENABLED", "0") == "1"
+    if not _settings["enabled"]:
+        return
+    write_queue.app = app
+    write_queue.max_batch = int(os.environ.get("WRITE_BEHIND_MAX_BATCH", DEFAULT_MAX_BATCH))
+    write_queue.max_delay = float(os.environ.get("WRITE_BEHIND_MAX_DELAY_MS", DEFAULT_MAX_DELAY_MS)) / 1000
+    write_queue.max_pending = int(os.environ.get("WRITE_BEHIND_MAX_PENDING", DEFAULT_MAX_PENDING))
+    write_queue.timeout = float(os.environ.get("WRITE_BEHIND_TIMEOUT", DEFAULT_TIMEOUT))
+    if "metrics" in app.extensions:
+        app.extensions["metrics"].register_collector(_collector)
+    app.extensions["write_behind"] = write_queue
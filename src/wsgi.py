@@ -1,7 +1,10 @@
 # This file was created to run the application on heroku using gunicorn.
 # Read more about it here: https://devcenter.heroku.com/articles/python-gunicorn
 
-from app import app as application
+from app import create_app
+
+# Los comandos `flask db` no corren en el servidor web, sin Flask-Migrate arranca mas rapido
+application = create_app(migrations=False)
 
 if __name__ == "__main__":
     application.run()
@@ -0,0 +1,51 @@
+"""
+Fixtures shared by the tests: the app of create_app() on a fresh SQLite file per test.
+
+    python -m pytest -q
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+# los modos opcionales quedan apagados: cada test activa lo que necesita
+OPTIONAL_SETTINGS = ("DATABASE_READ_URL", "READ_MODEL_ENABLED", "WRITE_BEHIND_ENABLED", "CACHE_BACKEND",
+                     "RATE_LIMIT_BACKEND", "CHANGE_FEED_ENABLED", "CATALOG_SNAPSHOT_ENABLED", "PROFILING_ENABLED",
+                     "ADMIN_ENABLED", "DB_STATEMENT_TIMEOUT_MS", "TRUSTED_PROXY_HOPS", "METRICS_TOKEN",
+                     "FLASK_DEBUG")
+
+
+@pytest.fixture(autouse=True)
+def environment(tmp_path, monkeypatch):
+    # autouse: corre antes que los fixtures de cada test, que pueden activar sus settings
+    monkeypatch.setenv("DATABASE_URL", "sqlite:///" + str(tmp_path / "test.db"))
+    for name in OPTIONAL_SETTINGS:
+        monkeypatch.delenv(name, raising=False)
+
+
+@pytest.fixture
+def app():
+    from app import create_app
+    from cache import response_cache
+    from lookups import catalog_ids, user_ids
+    from models import db
+
+    app = create_app(admin=False, migrations=False)
+    app.config["TESTING"] = True
+    # caches de modulo: no arrastrar entradas de la base del test anterior
+    response_cache.clear()
+    for lookup_cache in (user_ids, catalog_ids):
+        lookup_cache.local.clear()
+    with app.app_context():
+        db.create_all()
+    yield app
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
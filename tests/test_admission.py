@@ -0,0 +1,98 @@
+"""Token buckets of the rate limit (LocalSharedBuckets stands in for Redis)."""
+import pytest
+
+import admission
+from admission import LocalSharedBuckets, MemoryBuckets
+from utils import APIException
+
+
+class FakeClock:
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.mark.parametrize("backend_class", [LocalSharedBuckets, MemoryBuckets])
+def test_bucket_drains_and_refills(backend_class):
+    clock = FakeClock()
+    buckets = backend_class(clock=clock)
+
+    for _ in range(3):
+        assert buckets.take("client", rate=2, burst=3) == (True, 0.0)
+    allowed, retry_after = buckets.take("client", rate=2, burst=3)
+    assert not allowed
+    assert retry_after == pytest.approx(0.5)
+
+    clock.now += 0.5
+    assert buckets.take("client", rate=2, burst=3)[0]
+    assert not buckets.take("client", rate=2, burst=3)[0]
+
+    # nunca se llena por encima del burst
+    clock.now += 60
+    assert [buckets.take("client", rate=2, burst=3)[0] for _ in range(4)] == [True, True, True, False]
+
+
+def test_shared_buckets_are_seen_by_every_worker():
+    clock = FakeClock()
+    shared = LocalSharedBuckets(clock=clock)
+    # dos workers usan el mismo store: el segundo ve los tokens que gasto el primero
+    assert shared.take("client", rate=1, burst=1)[0]
+    assert not shared.take("client", rate=1, burst=1)[0]
+    assert shared.take("other", rate=1, burst=1)[0]
+
+
+@pytest.fixture
+def limiter(monkeypatch):
+    buckets = MemoryBuckets(clock=FakeClock())
+    monkeypatch.setattr(admission, "buckets", buckets)
+    monkeypatch.setitem(admission._settings, "rate_limit", True)
+    monkeypatch.setitem(admission._settings, "rate", 1.0)
+    monkeypatch.setitem(admission._settings, "burst", 2)
+    monkeypatch.setitem(admission._settings, "ip_factor", 2)
+    return buckets
+
+
+def test_rate_limit_is_keyed_by_address_and_email(limiter):
+    admission.check_rate_limit("luke@example.com", "10.0.0.1")
+    admission.check_rate_limit("luke@example.com", "10.0.0.1")
+    with pytest.raises(APIException) as error:
+        admission.check_rate_limit("luke@example.com", "10.0.0.1")
+    assert error.value.status_code == 429
+    assert error.value.headers["Retry-After"] == "1"
+
+    # otro cliente con el mismo email no queda bloqueado
+    admission.check_rate_limit("luke@example.com", "10.0.0.2")
+
+
+def test_changing_the_email_does_not_skip_the_limit(limiter):
+    for number in range(4):
+        admission.check_rate_limit("user" + str(number) + "@example.com", "10.0.0.1")
+    with pytest.raises(APIException):
+        admission.check_rate_limit("user99@example.com", "10.0.0.1")
+
+
+@pytest.fixture
+def proxied_client(request, monkeypatch):
+    # un solo proxy delante de la app, buckets de un token que no se rellenan durante el test
+    monkeypatch.setenv("TRUSTED_PROXY_HOPS", "1")
+    monkeypatch.setenv("RATE_LIMIT_ENABLED", "1")
+    monkeypatch.setenv("RATE_LIMIT_BACKEND", "memory")
+    monkeypatch.setenv("RATE_LIMIT_RATE", "0.001")
+    monkeypatch.setenv("RATE_LIMIT_BURST", "1")
+    monkeypatch.setenv("RATE_LIMIT_IP_FACTOR", "1")
+    return request.getfixturevalue("app").test_client()
+
+
+def test_forwarded_clients_behind_one_proxy_get_separate_buckets(proxied_client):
+    def post(forwarded_for):
+        return proxied_client.post("/favorite/planet/1", json={"email": "luke@example.com"},
+                                   headers={"X-Forwarded-For": forwarded_for},
+                                   environ_base={"REMOTE_ADDR": "10.0.0.1"})
+
+    assert post("203.0.113.1").status_code != 429
+    assert post("203.0.113.1").status_code == 429
+    # mismo proxy, otro cliente: su propio bucket
+    assert post("203.0.113.2").status_code != 429
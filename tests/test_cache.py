@@ -0,0 +1,60 @@
+"""Response cache: invalidation through a shared backend (LocalSharedCache stands in for Redis)."""
+from cache import LocalSharedCache, LRUCache, ResponseCache, response_cache
+from models import db, Planet
+
+
+def test_invalidation_reaches_every_instance_of_a_shared_backend():
+    shared = LocalSharedCache()
+    worker_a = ResponseCache(shared)
+    worker_b = ResponseCache(shared)
+    entry = (b'{"name":"Tatooine"}', 200, [("Content-Type", "application/json")])
+
+    worker_a.set(worker_a.key("planets", 1), entry)
+    assert worker_b.get(worker_b.key("planets", 1)) == entry
+
+    worker_b.invalidate("planets")
+    assert worker_a.get(worker_a.key("planets", 1)) is None
+    assert worker_b.get(worker_b.key("planets", 1)) is None
+
+
+def test_invalidation_is_per_namespace():
+    shared = LocalSharedCache()
+    worker_a = ResponseCache(shared)
+    worker_b = ResponseCache(shared)
+    worker_a.set(worker_a.key("people", query_string="limit=2"), (b"[]", 200, []))
+
+    worker_b.invalidate("planets")
+    assert worker_a.get(worker_a.key("people", query_string="limit=2")) == (b"[]", 200, [])
+
+
+def test_in_process_backends_do_not_share_invalidations():
+    worker_a = ResponseCache(LRUCache())
+    worker_b = ResponseCache(LRUCache())
+    worker_a.set(worker_a.key("planets", 1), (b"{}", 200, []))
+
+    worker_b.invalidate("planets")
+    assert worker_a.get(worker_a.key("planets", 1)) == (b"{}", 200, [])
+
+
+def test_shared_backend_stores_copies():
+    shared = LocalSharedCache()
+    headers = [("X-Test", "1")]
+    shared.set("key", headers)
+    headers.append(("X-Other", "2"))
+    assert shared.get("key") == [("X-Test", "1")]
+
+
+def test_orm_update_invalidates_the_cached_response(app, client, monkeypatch):
+    monkeypatch.setattr(response_cache, "backend", LocalSharedCache())
+    with app.app_context():
+        planet = Planet(name="Tatooine")
+        db.session.add(planet)
+        db.session.commit()
+        planet_id = planet.id_planet
+
+    url = "/planets/" + str(planet_id)
+    assert "Tatooine" in client.get(url).get_data(as_text=True)
+    with app.app_context():
+        db.session.get(Planet, planet_id).name = "Naboo"
+        db.session.commit()
+    assert "Naboo" in client.get(url).get_data(as_text=True)
@@ -0,0 +1,54 @@
+"""Conditional GETs: 304 for If-None-Match / If-Modified-Since (see conditional.py)."""
+from models import db, User, Planet, Favorite
+
+
+def seed_favorite(app):
+    with app.app_context():
+        user = User(email="leia@example.com", password="secret", is_active=True)
+        planet = Planet(name="Alderaan")
+        db.session.add_all([user, planet])
+        db.session.flush()
+        db.session.add(Favorite(user_id=user.id, planet_id=planet.id_planet))
+        db.session.commit()
+        return user.id, planet.id_planet
+
+
+def test_user_favorites_answer_304_to_if_none_match(app, client):
+    user_id, _ = seed_favorite(app)
+    url = "/users/favorites/" + str(user_id)
+
+    response = client.get(url)
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+
+    not_modified = client.get(url, headers={"If-None-Match": etag})
+    assert not_modified.status_code == 304
+    assert not_modified.get_data() == b""
+    assert not_modified.headers["ETag"] == etag
+
+    assert client.get(url, headers={"If-None-Match": '"other"'}).status_code == 200
+
+
+def test_user_favorites_are_etag_only(app, client):
+    user_id, _ = seed_favorite(app)
+    url = "/users/favorites/" + str(user_id)
+
+    response = client.get(url)
+    assert "Last-Modified" not in response.headers
+    # sin Last-Modified no hay fecha contra la que comparar: respuesta completa
+    response = client.get(url, headers={"If-Modified-Since": "Sat, 01 Jan 2100 00:00:00 GMT"})
+    assert response.status_code == 200
+    assert len(response.get_json()) == 1
+
+
+def test_cached_catalog_answers_304_to_if_modified_since(app, client):
+    _, planet_id = seed_favorite(app)
+    url = "/planets/" + str(planet_id)
+
+    response = client.get(url)
+    assert response.status_code == 200
+    last_modified = response.headers["Last-Modified"]
+
+    not_modified = client.get(url, headers={"If-Modified-Since": last_modified})
+    assert not_modified.status_code == 304
+    assert client.get(url, headers={"If-Modified-Since": "Thu, 01 Jan 1970 00:00:00 GMT"}).status_code == 200
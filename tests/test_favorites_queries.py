@@ -0,0 +1,53 @@
+"""GET /users/favorites/<id> runs a fixed number of SQL statements, whatever the number of favorites."""
+from sqlalchemy import event
+
+from models import db, User, Planet, Character, Favorite
+
+
+def seed_user(email, planets, characters):
+    user = User(email=email, password="secret", is_active=True)
+    db.session.add(user)
+    db.session.flush()
+    db.session.add_all([Favorite(user_id=user.id, planet_id=planet.id_planet) for planet in planets])
+    db.session.add_all([Favorite(user_id=user.id, character_id=character.id_character) for character in characters])
+    return user
+
+
+def count_statements(app, client, url):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        response = client.get(url)
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    return response, len(statements)
+
+
+def test_user_favorites_statement_count_does_not_grow(app, client):
+    size = 5
+    with app.app_context():
+        planets = [Planet(name="planet" + str(i)) for i in range(10 * size)]
+        characters = [Character(name="character" + str(i)) for i in range(10 * size)]
+        db.session.add_all(planets + characters)
+        db.session.flush()
+        small = seed_user("small@example.com", planets[:size], characters[:size])
+        large = seed_user("large@example.com", planets, characters)
+        warmup = seed_user("warmup@example.com", planets[:1], [])
+        db.session.commit()
+        small_id, large_id, warmup_id = small.id, large.id, warmup.id
+
+    client.get("/users/favorites/" + str(warmup_id))
+    small_response, small_statements = count_statements(app, client, "/users/favorites/" + str(small_id))
+    large_response, large_statements = count_statements(app, client, "/users/favorites/" + str(large_id))
+
+    assert small_response.status_code == 200
+    assert large_response.status_code == 200
+    assert len(small_response.get_json()) == 2 * size
+    assert len(large_response.get_json()) == 20 * size
+    assert small_statements == large_statements
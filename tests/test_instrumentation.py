@@ -0,0 +1,25 @@
+"""GET /metrics is only published with METRICS_TOKEN (or in debug), see instrumentation.py."""
+
+
+def test_metrics_are_not_published_without_a_token(client):
+    assert client.get("/metrics").status_code == 404
+    # la medicion sigue activa
+    assert "Server-Timing" in client.get("/people").headers
+
+
+def test_metrics_need_the_token(request, monkeypatch):
+    monkeypatch.setenv("METRICS_TOKEN", "secret")
+    client = request.getfixturevalue("client")
+
+    assert client.get("/metrics").status_code == 401
+    assert client.get("/metrics", headers={"Authorization": "Bearer other"}).status_code == 401
+    response = client.get("/metrics", headers={"Authorization": "Bearer secret"})
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain")
+
+
+def test_metrics_are_open_in_debug(request, monkeypatch):
+    monkeypatch.setenv("FLASK_DEBUG", "1")
+    client = request.getfixturevalue("client")
+
+    assert client.get("/metrics").status_code == 200
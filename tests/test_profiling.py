@@ -0,0 +1,24 @@
+"""Collapsed stacks of the sampling profiler (see profiling.py)."""
+import sys
+
+from profiling import collapse
+
+
+def outer():
+    return inner()
+
+
+def inner():
+    return sys._getframe().f_code
+
+
+def test_collapse_labels_every_frame_root_first():
+    stack = (outer.__code__, inner())
+    folded = collapse({stack: 3})
+
+    (line, count), = folded.items()
+    assert count == 3
+    root, leaf = line.split(";")
+    assert root.startswith("outer (")
+    assert leaf.startswith("inner (")
+    assert "test_profiling.py:" in leaf